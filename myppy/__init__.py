@@ -56,6 +56,80 @@ and you can install them using e.g.::
 This would build and install a custom wxPython version that is patched to 
 be more portable.
 
+Recipes that don't depend on each other can be built at the same time by
+passing a "--jobs" option to the "init", "install", "reinstall" or "update"
+commands::
+
+    #> myppy PATH/TO/ENV install --jobs=4 py_wxpython py_pyside
+
+All builds share a single GNU make jobserver, so the total number of compile
+jobs stays at the number of CPUs however many recipes are building.  Set the
+MYPPY_MAKE_JOBS environment variable to use a different limit.
+
+Source downloads for all the recipes being installed are started up front,
+several at a time (MYPPY_FETCH_JOBS, default 4), so builds don't have to wait
+on the network.  To download everything needed for some recipes without
+building them, e.g. before going offline, use::
+
+    #> myppy PATH/TO/ENV fetch py_wxpython
+
+Sources are downloaded from their upstream sites by default.  To use other
+mirrors first, set MYPPY_MIRRORS to a space-separated list of base URLs or
+local directories holding the source files.  Mirrors that fail are skipped
+and tried last from then on; otherwise the fastest mirrors are preferred.
+These stats are kept in the env's database, so they carry over between runs.
+To populate a local mirror directory with everything needed for some
+recipes, use::
+
+    #> myppy PATH/TO/ENV mirror PATH/TO/MIRROR py_wxpython
+
+Interrupted downloads are resumed where they left off.  To split large
+downloads into several parallel requests, set MYPPY_DOWNLOAD_SEGMENTS to the
+number of pieces to use.  Tarballs are unpacked while they're still being
+downloaded, so a build can start as soon as the last of its source arrives.
+They're decompressed with pigz, pbzip2, lbzip2 or multi-threaded xz if those
+are available, and in-process otherwise; set MYPPY_DECOMPRESSOR to the name
+of one of these, or "python", to prefer it.  The throughput of each is shown
+in the build output.
+
+Each source tarball is unpacked just once, into a pristine tree under the
+build directory, and every build that uses it gets a fresh copy of that tree.
+Copies are copy-on-write clones where the filesystem supports them.  Set
+MYPPY_SOURCE_CHECKOUT=hardlink to use hard links instead, which is faster
+still but lets a build script that modifies files in place corrupt the
+pristine tree, or MYPPY_SOURCE_CHECKOUT=copy to always make full copies.
+
+If a build fails part-way through, running the install again carries on from
+the failed step: the unpack, patch and configure steps are skipped if they
+completed with the same inputs, and make picks up where it stopped.  Changing
+a recipe or the compiler flags re-runs the affected steps.
+
+To bring an existing env up to date after changing its recipes, use::
+
+    #> myppy PATH/TO/ENV update
+
+This rebuilds each installed recipe whose source, patches, build settings or
+dependencies have changed since it was installed, along with everything that
+depends on it.  Use "update --dry-run" to just list what would be rebuilt.
+
+If you build many identical envs, set MYPPY_ARTIFACT_CACHE to a directory
+where prebuilt recipes can be shared between them.  Each recipe's installed
+files are cached under a hash of everything that went into building it, and
+unpacked directly into later envs instead of being rebuilt.  The cache is
+limited to MYPPY_ARTIFACT_CACHE_SIZE megabytes (default 10240), discarding
+the least recently used artifacts first.
+
+Binaries installed on Linux are stripped of their symbols and debug info.
+To keep the debug info so that crashes can still be symbolised, set
+MYPPY_DEBUG_STORE to a directory to save it in; point gdb's
+debug-file-directory at that directory to use it.
+
+Set MYPPY_LINK_PROFILE=startup to link Linux binaries for faster startup,
+with less work for the dynamic loader at load time, or "startup-now" to also
+bind all functions at load time rather than on first use.  Compare the
+results with scripts/bench_startup.py, which times "python -c pass" and
+"import PySide.QtGui" in the envs given to it.
+
 
 Using a myppy environment
 -------------------------
@@ -143,6 +217,15 @@ def main(argv):
     cmd = argv[2]
     args = argv[3:]
 
+    # Commands that build recipes can build several of them at once.
+    jobs = None
+    if cmd in _JOBS_COMMANDS:
+        try:
+            (jobs,args) = _extract_jobs_option(args)
+        except ValueError, e:
+            print "Invalid option:", e
+            return 1
+
     # Default architecture - 32bit on 32-bit linux and 64bit on 64-bit linux.
     architecture = util.python_architecture()
     # User is allowed to specify architecture of myppy python environment.
@@ -153,6 +236,8 @@ def main(argv):
         args = []
     # We need to pass 32bit or 64bit to MyppyEnv.
     target = MyppyEnv(argv[1], architecture)
+    if jobs is not None:
+        target.jobs = jobs
 
     if cmd == "help":
         print ""
@@ -176,6 +261,40 @@ def main(argv):
         return 1
     res = cmd.run(target,args) or 0
     return res
+
+
+_JOBS_COMMANDS = ("init","install","reinstall","update",)
+
+def _extract_jobs_option(args):
+    """Pull a "-jN" or "--jobs=N" option out of the command arguments.
+
+    Returns a tuple (jobs,args) where jobs is None if no option was given.
+    A missing or malformed value raises ValueError.
+    """
+    jobs = None
+    remaining = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in ("-j","--jobs"):
+            if not args:
+                raise ValueError("%s needs a number of jobs" % (arg,))
+            jobs = _parse_jobs(arg,args.pop(0))
+        elif arg.startswith("--jobs="):
+            jobs = _parse_jobs("--jobs",arg.split("=",1)[1])
+        elif arg.startswith("-j"):
+            jobs = _parse_jobs("-j",arg[2:])
+        else:
+            remaining.append(arg)
+    return (jobs,remaining)
+
+
+def _parse_jobs(option,value):
+    """Parse the value of a jobs option, which must be a positive integer."""
+    if not value.isdigit() or int(value) < 1:
+        msg = "%s needs a positive number of jobs, not %r" % (option,value,)
+        raise ValueError(msg)
+    return int(value)
          
 
 class _cmd(object):
@@ -204,8 +323,27 @@ class _install(_cmd):
     def run(target,args):
         for arg in args:
             target.load_recipe(arg)
+        target.install_recipes(args)
+
+class _fetch(_cmd):
+    """download sources for recipes and their dependencies"""
+    @staticmethod
+    def run(target,args):
         for arg in args:
-            target.install(arg)
+            target.load_recipe(arg)
+        target.fetch_recipes(args)
+
+class _mirror(_cmd):
+    """copy sources for recipes and their dependencies into a mirror dir"""
+    @staticmethod
+    def run(target,args):
+        if not args:
+            print "usage:      myppy <rootdir> mirror <dir> [<recipe>...]"
+            return 1
+        mirrordir = args[0]
+        for arg in args[1:]:
+            target.load_recipe(arg)
+        target.mirror_recipes(mirrordir,args[1:])
 
 class _uninstall(_cmd):
     """uninstall recipes from the env"""
@@ -220,10 +358,29 @@ class _reinstall(_cmd):
     def run(target,args):
         for arg in args:
             target.load_recipe(arg)
+        #  Uninstalling also removes anything that depends on the recipes,
+        #  so put back any of those that were explicitly installed.
+        dependents = set()
+        for arg in args:
+            for dep in target.reverse_dependencies(arg):
+                if dep not in args and target.is_explicitly_installed(dep):
+                    dependents.add(dep)
         for arg in args:
             target.uninstall(arg)
+        target.install_recipes(args + sorted(dependents))
+
+class _update(_cmd):
+    """rebuild installed recipes whose build inputs have changed"""
+    @staticmethod
+    def run(target,args):
+        dry_run = False
         for arg in args:
-            target.install(arg)
+            if arg in ("-n","--dry-run"):
+                dry_run = True
+            else:
+                print "Invalid option:", arg
+                return 1
+        target.update_recipes(dry_run=dry_run)
 
 class _shell(_cmd):
     """start an interactive shell inside env"""
@@ -250,8 +407,11 @@ class _record(_cmd):
     @staticmethod
     def run(target,args):
         (recipe,) = args
-        with target:
+        with target.prefix_lock():
             files = list(target.find_new_files())
-            target.record_files(recipe,files)
+            target.process_files(recipe,files)
+            infos = target.file_infos(files)
+            with target:
+                target.record_files(recipe,files,infos)
 
 
@@ -0,0 +1,167 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.artifacts:  cache of prebuilt recipe artifacts
+
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import errno
+import tarfile
+import tempfile
+from StringIO import StringIO
+
+
+MANIFEST_NAME = ".myppy-manifest"
+
+
+def default_maxsize():
+    """Get the default artifact cache size limit in bytes.
+
+    This can be set in megabytes via $MYPPY_ARTIFACT_CACHE_SIZE.
+    """
+    return int(os.environ.get("MYPPY_ARTIFACT_CACHE_SIZE",10240)) * 1024*1024
+
+
+class ArtifactCache(object):
+    """A size-capped store of prebuilt recipe artifacts.
+
+    Each artifact is a gzipped tarball of the files that a recipe installed,
+    keyed by the fingerprint of the recipe's build inputs.  The files are
+    archived after the env has fixed them up (adjusting rpaths and the like)
+    so they can be unpacked straight back into any env with the same
+    fingerprint.  Along with the files themselves, each tarball contains a
+    manifest listing the paths as they were recorded in the env's database.
+
+    The cache is kept under its size limit by discarding the artifacts that
+    have gone the longest without being used.
+    """
+
+    def __init__(self,cachedir,maxsize=None):
+        if maxsize is None:
+            maxsize = default_maxsize()
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def _path(self,key):
+        return os.path.join(self.cachedir,key + ".tar.gz")
+
+    def open(self,key):
+        """Open the artifact with the given key, or return None if missing.
+
+        Keeping the returned file open ensures the artifact can still be
+        read even if it's concurrently evicted from the cache.
+        """
+        path = self._path(key)
+        try:
+            f = open(path,"rb")
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        #  Mark it as recently used.
+        try:
+            os.utime(path,None)
+        except EnvironmentError:
+            pass
+        return f
+
+    def store(self,key,rootdir,files):
+        """Store the given files under the given key.
+
+        The files must be given as paths relative to rootdir, with a trailing
+        separator for directories.
+        """
+        (fd,tmppath) = tempfile.mkstemp(suffix=".tmp",dir=self.cachedir)
+        os.close(fd)
+        try:
+            tf = tarfile.open(tmppath,"w:gz")
+            try:
+                manifest = "\n".join(files).encode("utf8")
+                info = tarfile.TarInfo(MANIFEST_NAME)
+                info.size = len(manifest)
+                tf.addfile(info,StringIO(manifest))
+                for file in files:
+                    tf.add(os.path.join(rootdir,file),file,recursive=False)
+            finally:
+                tf.close()
+            os.rename(tmppath,self._path(key))
+        except:
+            os.unlink(tmppath)
+            raise
+        self.evict()
+
+    def extract(self,f,rootdir):
+        """Extract an artifact opened by open() into the given rootdir.
+
+        Returns the list of extracted files as absolute paths, in the form
+        originally given to store().
+        """
+        if isinstance(rootdir,unicode):
+            rootdir_b = rootdir.encode(sys.getfilesystemencoding())
+        else:
+            rootdir_b = rootdir
+        realroot = os.path.realpath(rootdir_b)
+        try:
+            tf = tarfile.open(fileobj=f,mode="r:gz")
+            try:
+                member = tf.next()
+                if member is None or member.name != MANIFEST_NAME:
+                    raise ValueError("artifact has no manifest: %r" % (f,))
+                manifest = tf.extractfile(member).read().decode("utf8")
+                for member in tf:
+                    if not _is_safe_name(member.name):
+                        raise ValueError("bad artifact member: %r" % (member.name,))
+                    if member.islnk() and not _is_safe_name(member.linkname):
+                        raise ValueError("bad artifact member: %r" % (member.name,))
+                    dest = os.path.join(rootdir_b,member.name)
+                    #  Don't follow symlinks from earlier members out of
+                    #  the rootdir.
+                    parent = os.path.realpath(os.path.dirname(dest))
+                    if parent != realroot and \
+                       not parent.startswith(realroot + os.sep):
+                        raise ValueError("bad artifact member: %r" % (member.name,))
+                    if os.path.lexists(dest) and not member.isdir():
+                        if not os.path.isdir(dest) or os.path.islink(dest):
+                            os.unlink(dest)
+                    tf.extract(member,rootdir_b)
+            finally:
+                tf.close()
+        finally:
+            f.close()
+        return [os.path.join(rootdir,file) for file in manifest.split("\n")]
+
+    def evict(self):
+        """Remove least-recently-used artifacts until under the size limit."""
+        entries = []
+        total = 0
+        for nm in os.listdir(self.cachedir):
+            if not nm.endswith(".tar.gz"):
+                continue
+            path = os.path.join(self.cachedir,nm)
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            entries.append((st.st_mtime,st.st_size,path))
+            total += st.st_size
+        entries.sort()
+        while total > self.maxsize and entries:
+            (_,size,path) = entries.pop(0)
+            try:
+                os.unlink(path)
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            total -= size
+
+
+def _is_safe_name(name):
+    """Check that an archive member name stays within the extraction dir."""
+    return not (name.startswith("/") or ".." in name.split("/"))
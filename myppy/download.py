@@ -0,0 +1,335 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.download:  resumable, optionally segmented, file downloads
+
+"""
+
+from __future__ import with_statement
+
+import os
+import re
+import json
+import errno
+import shutil
+import urllib
+import urllib2
+import urlparse
+import posixpath
+import threading
+
+
+#  Files smaller than this many bytes per segment aren't worth splitting.
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+
+_CONTENT_RANGE_RE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)")
+
+
+def default_segments():
+    """Get the default number of segments, from $MYPPY_DOWNLOAD_SEGMENTS."""
+    return max(1,int(os.environ.get("MYPPY_DOWNLOAD_SEGMENTS",1)))
+
+
+class RangeNotSupported(Exception):
+    """Raised when the server ignores a request for part of a file."""
+    pass
+
+
+def download(url,path,segments=None,min_segment_size=MIN_SEGMENT_SIZE):
+    """Download the given URL into the given path.
+
+    The data is written to path + ".part" and only renamed into place once
+    complete, so the file at path is never partially written.  If a partial
+    download is found from a previous attempt, it's resumed using an HTTP
+    range request.  The URL it came from is recorded alongside it, with the
+    server's ETag or Last-Modified date, and a partial download of some
+    other URL (e.g. a different mirror) is thrown away rather than resumed.
+
+    With segments > 1, and a server that supports range requests, a large
+    file is split into that many pieces that are downloaded in parallel.
+    Each piece goes into its own ".part.N" file, so they can also be
+    resumed individually.
+    """
+    if segments is None:
+        segments = default_segments()
+    partfile = path + ".part"
+    source = _PartSource(partfile,url)
+    if not source.load():
+        _discard_partials(partfile)
+        source.save()
+    done = False
+    if segments > 1 and not os.path.exists(partfile):
+        size = _get_size(url)
+        if size is not None and size >= segments * min_segment_size:
+            try:
+                _download_segments(url,partfile,size,segments,source)
+            except RangeNotSupported:
+                pass
+            else:
+                done = True
+    if not done:
+        _download_range(url,partfile,0,None,source)
+    os.rename(partfile,path)
+    os.unlink(source.path)
+
+
+class _PartSource(object):
+    """Where a partial download came from, kept in a file next to it.
+
+    This records the URL being downloaded and, once the server has sent
+    one, a validator for the file (its ETag or Last-Modified date).  Range
+    requests that resume the download send the validator in an If-Range
+    header, so that the server sends the whole file again if it changed.
+    """
+
+    def __init__(self,partfile,url):
+        self.path = partfile + ".src"
+        self.url = url
+        self.validator = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the recorded source, returning False if it's not our URL."""
+        try:
+            with open(self.path,"rb") as f:
+                info = json.load(f)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        except ValueError:
+            return False
+        if info.get("url") != self.url:
+            return False
+        self.validator = info.get("validator")
+        return True
+
+    def save(self):
+        tmppath = "%s.%d.%d" % (self.path,os.getpid(),id(self),)
+        with open(tmppath,"wb") as f:
+            json.dump({"url":self.url,"validator":self.validator},f)
+        os.rename(tmppath,self.path)
+
+    def update(self,headers,replace=False):
+        """Record the validator from a response, if we don't have one."""
+        validator = headers.get("ETag")
+        if validator is None or validator.startswith("W/"):
+            validator = headers.get("Last-Modified")
+        with self._lock:
+            if validator != self.validator:
+                if replace or self.validator is None:
+                    self.validator = validator
+                    self.save()
+
+
+def _discard_partials(partfile):
+    """Remove the partial download files, including any segments."""
+    (dirnm,basenm) = os.path.split(partfile)
+    try:
+        names = os.listdir(dirnm or ".")
+    except EnvironmentError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return
+    for nm in names:
+        if nm == basenm or nm.startswith(basenm + "."):
+            try:
+                os.unlink(os.path.join(dirnm,nm))
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def _get_size(url):
+    """Get the size of the file at the given URL, if ranges are supported.
+
+    Returns None if the server won't serve byte ranges for the file.
+    """
+    req = urllib2.Request(url,headers={"Range":"bytes=0-0"})
+    try:
+        f = urllib2.urlopen(req)
+    except urllib2.HTTPError:
+        return None
+    try:
+        if f.getcode() != 206:
+            return None
+        m = _CONTENT_RANGE_RE.match(f.info().get("Content-Range",""))
+        if m is None or m.group(3) == "*":
+            return None
+        return int(m.group(3))
+    finally:
+        f.close()
+
+
+def _download_segments(url,partfile,size,segments,source):
+    """Download a file in several segments at once, then join them up."""
+    step = size // segments
+    bounds = []
+    for i in xrange(segments):
+        start = i * step
+        if i == segments - 1:
+            end = size - 1
+        else:
+            end = start + step - 1
+        bounds.append((partfile + ".%d" % (i,),start,end))
+    errors = []
+    def run(segfile,start,end):
+        try:
+            _download_range(url,segfile,start,end,source)
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=run,args=b) for b in bounds]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for e in errors:
+        if isinstance(e,RangeNotSupported):
+            for (segfile,_,_) in bounds:
+                if os.path.exists(segfile):
+                    os.unlink(segfile)
+            raise e
+    if errors:
+        raise errors[0]
+    #  Join the segments into a temp file, so a crash while joining them
+    #  doesn't leave something that looks like a resumable partial file.
+    with open(partfile + ".join","wb") as fOut:
+        for (segfile,_,_) in bounds:
+            with open(segfile,"rb") as fIn:
+                shutil.copyfileobj(fIn,fOut)
+    os.rename(partfile + ".join",partfile)
+    for (segfile,_,_) in bounds:
+        os.unlink(segfile)
+
+
+def _download_range(url,partfile,start,end,source):
+    """Download the given byte range of a URL into the given file.
+
+    If the file already holds some of the range, only the remainder is
+    requested.  An end of None means the end of the file.  If the server
+    ignores the range request, or the file has changed since the source's
+    validator was recorded, the whole file is downloaded again if it was
+    wanted anyway, and RangeNotSupported is raised otherwise.
+    """
+    try:
+        offset = os.path.getsize(partfile)
+    except EnvironmentError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        offset = 0
+    if end is not None and start + offset > end:
+        return
+    headers = {}
+    if start + offset > 0 or end is not None:
+        rng = "bytes=%d-" % (start + offset,)
+        if end is not None:
+            rng += str(end)
+        headers["Range"] = rng
+        if offset and source.validator is not None:
+            headers["If-Range"] = source.validator
+    try:
+        fIn = urllib2.urlopen(urllib2.Request(url,headers=headers))
+    except urllib2.HTTPError, e:
+        #  Requested range not satisfiable; the partial file must be bad.
+        if e.code == 416 and offset:
+            os.unlink(partfile)
+            return _download_range(url,partfile,start,end,source)
+        raise
+    try:
+        if "Range" in headers and fIn.getcode() != 206:
+            if start != 0 or end is not None:
+                raise RangeNotSupported(url)
+            offset = 0
+        source.update(fIn.info(),replace=(start == 0 and end is None and
+                                          offset == 0))
+        if end is not None:
+            expected = end + 1 - start - offset
+        else:
+            expected = fIn.info().get("Content-Length")
+            if expected is not None:
+                expected = int(expected)
+        if offset:
+            print "RESUMING", url, "FROM BYTE", start + offset
+            mode = "ab"
+        else:
+            mode = "wb"
+        written = 0
+        with open(partfile,mode) as fOut:
+            chunk = fIn.read(1024*64)
+            while chunk:
+                fOut.write(chunk)
+                written += len(chunk)
+                chunk = fIn.read(1024*64)
+    finally:
+        fIn.close()
+    if expected is not None and written != expected:
+        msg = "incomplete download of %s: got %d of %d bytes"
+        raise IOError(msg % (url,written,expected,))
+
+
+def parse_mirrors(spec):
+    """Parse a whitespace-separated list of mirrors, e.g. $MYPPY_MIRRORS.
+
+    Each mirror is the base URL of a directory holding source files under
+    their original names.  Plain paths are taken to be local directories.
+    """
+    mirrors = []
+    for mirror in spec.split():
+        if "://" not in mirror:
+            mirror = "file://" + urllib.pathname2url(os.path.abspath(mirror))
+        mirrors.append(mirror.rstrip("/"))
+    return mirrors
+
+
+class MirrorList(object):
+    """An ordered list of mirrors, ranked by how well they've performed.
+
+    Mirrors that have failed are tried after those that haven't, and
+    otherwise faster mirrors are tried first.  Mirrors that haven't been
+    used yet keep their configured order, ahead of known slow ones.
+    """
+
+    def __init__(self,mirrors):
+        self.mirrors = list(mirrors)
+        self._stats = dict((m,[0,0.0,0]) for m in self.mirrors)
+        self._lock = threading.Lock()
+
+    def _rank(self,mirror):
+        (failures,seconds,nbytes) = self._stats[mirror]
+        if nbytes:
+            return (failures,seconds / nbytes)
+        return (failures,0)
+
+    def urls(self,url):
+        """Get the (mirror,url) pairs to try for the given source URL.
+
+        These are the ranked mirrors followed by the original URL, which
+        is given with a mirror of None.
+        """
+        nm = urllib.quote(posixpath.basename(urlparse.urlparse(url).path))
+        with self._lock:
+            mirrors = sorted(self.mirrors,key=self._rank)
+        urls = [(mirror,mirror + "/" + nm) for mirror in mirrors]
+        urls.append((None,url))
+        return urls
+
+    def record_success(self,mirror,seconds,nbytes):
+        if mirror is not None:
+            with self._lock:
+                self._stats[mirror][1] += seconds
+                self._stats[mirror][2] += nbytes
+
+    def record_failure(self,mirror):
+        if mirror is not None:
+            with self._lock:
+                self._stats[mirror][0] += 1
+
+    def set_stats(self,mirror,failures,seconds,nbytes):
+        """Replace the stats for a mirror, e.g. with those saved elsewhere.
+
+        Stats for mirrors that aren't in the list are ignored.
+        """
+        if mirror in self._stats:
+            with self._lock:
+                self._stats[mirror] = [failures,seconds,nbytes]
@@ -0,0 +1,505 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.elf:  minimal in-process reader for ELF binaries
+
+This reads just enough of an ELF file to classify it and to find the shared
+libraries, library search paths and symbol versions it needs at runtime, by
+following the program headers to the dynamic section the same way the
+dynamic loader does.  Both 32-bit and 64-bit files of either byte order
+are supported.
+
+"""
+
+from __future__ import with_statement
+
+import mmap
+import struct
+
+
+ELF_MAGIC = "\x7fELF"
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+ET_REL = 1
+ET_EXEC = 2
+ET_DYN = 3
+ET_CORE = 4
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_HASH = 4
+DT_STRTAB = 5
+DT_SYMTAB = 6
+DT_STRSZ = 10
+DT_SYMENT = 11
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+DT_GNU_HASH = 0x6ffffef5
+DT_VERDEF = 0x6ffffffc
+DT_VERDEFNUM = 0x6ffffffd
+DT_VERNEED = 0x6ffffffe
+DT_VERNEEDNUM = 0x6fffffff
+DT_AUXILIARY = 0x7ffffffd
+DT_FILTER = 0x7fffffff
+
+SHT_DYNSYM = 11
+
+#  Dynamic entries whose value is an offset into the string table.
+_STRING_TAGS = (DT_NEEDED,DT_SONAME,DT_RPATH,DT_RUNPATH,DT_AUXILIARY,
+                DT_FILTER,)
+
+#  Struct layouts, keyed by ELF class.  Only the fields we use are named.
+_EHDR = {ELFCLASS32: "16sHHIIIIIHHHHHH", ELFCLASS64: "16sHHIQQQIHHHHHH"}
+_PHDR = {ELFCLASS32: "IIIIIIII", ELFCLASS64: "IIQQQQQQ"}
+_DYN = {ELFCLASS32: "iI", ELFCLASS64: "qQ"}
+_SHDR = {ELFCLASS32: "IIIIIIIIII", ELFCLASS64: "IIQQQQIIQQ"}
+#  The version-needed structures are the same size in both classes.
+_VERNEED = "HHIII"
+_VERNAUX = "IHHII"
+_VERDEF = "HHHHIII"
+_VERDAUX = "II"
+
+
+class ElfError(Exception):
+    """Raised when a file looks like ELF but can't be parsed."""
+    pass
+
+
+def is_elf(path):
+    """Check whether the given file starts with the ELF magic number."""
+    try:
+        with open(path,"rb") as f:
+            return (f.read(4) == ELF_MAGIC)
+    except EnvironmentError:
+        return False
+
+
+def open_elf(path):
+    """Open the given file as an ElfFile, or return None if it's not ELF."""
+    if not is_elf(path):
+        return None
+    return ElfFile(path)
+
+
+def classify(path):
+    """Get the kind of ELF file at the given path.
+
+    This returns one of "executable", "shared object", "relocatable" or
+    "core", or None if the file isn't ELF.  Position-independent executables
+    are reported as executables, like file(1) does.
+    """
+    elf = open_elf(path)
+    if elf is None:
+        return None
+    with elf:
+        return elf.kind
+
+
+def max_version(versions,prefix):
+    """Get the highest of the given symbol versions having the given prefix.
+
+    For example, max_version(["GLIBC_2.0","GLIBC_2.3.4"],"GLIBC_") gives
+    (2,3,4).  Returns None if no versions have the prefix.
+    """
+    found = None
+    for ver in versions:
+        if ver.startswith(prefix):
+            try:
+                ver = tuple(map(int,ver[len(prefix):].split(".")))
+            except ValueError:
+                continue
+            if found is None or ver > found:
+                found = ver
+    return found
+
+
+class ElfFile(object):
+    """An ELF file, memory-mapped for reading.
+
+    The file header and program headers are parsed on opening; the dynamic
+    section is only read on demand.  Use as a context manager, or call
+    close() when done, to release the mapping.  If opened as writable, the
+    few modifications that can be made in place are also supported.
+    """
+
+    def __init__(self,path,writable=False):
+        self.path = path
+        self.writable = writable
+        if writable:
+            (mode,access) = ("r+b",mmap.ACCESS_WRITE)
+        else:
+            (mode,access) = ("rb",mmap.ACCESS_READ)
+        with open(path,mode) as f:
+            try:
+                self._map = mmap.mmap(f.fileno(),0,access=access)
+            except (ValueError,EnvironmentError), e:
+                raise ElfError("can't map %s: %s" % (path,e,))
+        try:
+            self._parse_header()
+        except (struct.error,ElfError), e:
+            self.close()
+            raise ElfError("bad ELF file %s: %s" % (path,e,))
+        self._dynamic = None
+
+    def close(self):
+        if self._map is not None:
+            if self.writable:
+                self._map.flush()
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,exc_traceback):
+        self.close()
+
+    def _unpack(self,fmt,offset):
+        fmt = self.byteorder + fmt
+        size = struct.calcsize(fmt)
+        if offset < 0 or offset + size > len(self._map):
+            raise ElfError("read past end of file at %d" % (offset,))
+        return struct.unpack(fmt,self._map[offset:offset+size])
+
+    def _parse_header(self):
+        ident = self._map[:16]
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            raise ElfError("not an ELF file")
+        self.elfclass = ord(ident[4])
+        if self.elfclass not in (ELFCLASS32,ELFCLASS64):
+            raise ElfError("unknown ELF class %d" % (self.elfclass,))
+        if ord(ident[5]) == ELFDATA2LSB:
+            self.byteorder = "<"
+        elif ord(ident[5]) == ELFDATA2MSB:
+            self.byteorder = ">"
+        else:
+            raise ElfError("unknown byte order %d" % (ord(ident[5]),))
+        hdr = self._unpack(_EHDR[self.elfclass],0)
+        self.type = hdr[1]
+        self.machine = hdr[2]
+        (phoff,phentsize,phnum) = (hdr[5],hdr[9],hdr[10])
+        (self._shoff,self._shentsize) = (hdr[6],hdr[11])
+        (self._shnum,self._shstrndx) = (hdr[12],hdr[13])
+        self._sections = None
+        self.segments = []
+        for i in xrange(phnum):
+            ph = self._unpack(_PHDR[self.elfclass],phoff + i * phentsize)
+            if self.elfclass == ELFCLASS32:
+                (p_type,p_offset,p_vaddr,_,p_filesz) = ph[:5]
+            else:
+                (p_type,_,p_offset,p_vaddr,_,p_filesz) = ph[:6]
+            self.segments.append((p_type,p_offset,p_vaddr,p_filesz))
+
+    @property
+    def bits(self):
+        """The word size of the file, 32 or 64."""
+        return 32 if self.elfclass == ELFCLASS32 else 64
+
+    @property
+    def kind(self):
+        """The kind of file, as a string; see classify()."""
+        if self.type == ET_EXEC:
+            return "executable"
+        if self.type == ET_DYN:
+            for seg in self.segments:
+                if seg[0] == PT_INTERP:
+                    return "executable"
+            return "shared object"
+        if self.type == ET_REL:
+            return "relocatable"
+        if self.type == ET_CORE:
+            return "core"
+        return None
+
+    @property
+    def section_names(self):
+        """The names of the sections in the file, from the section headers.
+
+        Sections aren't needed to run a binary, so this may well be empty.
+        """
+        if self._sections is None:
+            self._sections = []
+            headers = self._section_headers()
+            if headers:
+                stroff = headers[self._shstrndx][4]
+                for sh in headers:
+                    start = stroff + sh[0]
+                    end = self._map.find("\x00",start)
+                    if end < 0:
+                        raise ElfError("bad section name at %d" % (start,))
+                    self._sections.append(self._map[start:end])
+        return self._sections
+
+    def _section_headers(self):
+        """Get the raw section headers, or an empty list if there are none.
+
+        Each header is a tuple of (name,type,flags,addr,offset,size,link,
+        info,addralign,entsize) for both ELF classes.
+        """
+        headers = []
+        if self._shoff and self._shstrndx < self._shnum:
+            fmt = _SHDR[self.elfclass]
+            for i in xrange(self._shnum):
+                offset = self._shoff + i * self._shentsize
+                headers.append(self._unpack(fmt,offset))
+        return headers
+
+    @property
+    def has_symbols(self):
+        """Whether the file has a symbol table or debug info to strip."""
+        for nm in self.section_names:
+            if nm == ".symtab" or nm.startswith((".debug",".zdebug")):
+                return True
+        return False
+
+    def vaddr_to_offset(self,vaddr):
+        """Convert a virtual address to an offset in the file."""
+        for (p_type,p_offset,p_vaddr,p_filesz) in self.segments:
+            if p_type == PT_LOAD and p_vaddr <= vaddr < p_vaddr + p_filesz:
+                return vaddr - p_vaddr + p_offset
+        raise ElfError("address %#x is not in the file" % (vaddr,))
+
+    @property
+    def dynamic(self):
+        """List of (tag,value,offset) for entries in the dynamic section.
+
+        The offset is that of the entry itself within the file.  This is
+        empty for files that aren't dynamically linked.
+        """
+        if self._dynamic is None:
+            self._dynamic = []
+            fmt = _DYN[self.elfclass]
+            size = struct.calcsize(fmt)
+            for (p_type,p_offset,_,p_filesz) in self.segments:
+                if p_type != PT_DYNAMIC:
+                    continue
+                for offset in xrange(p_offset,p_offset + p_filesz,size):
+                    (tag,value) = self._unpack(fmt,offset)
+                    if tag == DT_NULL:
+                        break
+                    self._dynamic.append((tag,value,offset))
+        return self._dynamic
+
+    def _dynamic_value(self,tag):
+        for (dtag,value,_) in self.dynamic:
+            if dtag == tag:
+                return value
+        return None
+
+    def _dynamic_values(self,tag):
+        return [value for (dtag,value,_) in self.dynamic if dtag == tag]
+
+    def strtab_offset(self):
+        """Get the file offset of the dynamic string table."""
+        strtab = self._dynamic_value(DT_STRTAB)
+        if strtab is None:
+            raise ElfError("no dynamic string table")
+        return self.vaddr_to_offset(strtab)
+
+    def dynamic_string(self,index):
+        """Get the string at the given index in the dynamic string table."""
+        start = self.strtab_offset() + index
+        end = self._map.find("\x00",start)
+        if start >= len(self._map) or end < 0:
+            raise ElfError("string %d is not in the file" % (index,))
+        return self._map[start:end]
+
+    @property
+    def needed(self):
+        """The names of the shared libraries this file needs."""
+        return [self.dynamic_string(i) for i in self._dynamic_values(DT_NEEDED)]
+
+    @property
+    def rpath(self):
+        """The DT_RPATH of this file, or None if it doesn't have one."""
+        index = self._dynamic_value(DT_RPATH)
+        if index is None:
+            return None
+        return self.dynamic_string(index)
+
+    @property
+    def runpath(self):
+        """The DT_RUNPATH of this file, or None if it doesn't have one."""
+        index = self._dynamic_value(DT_RUNPATH)
+        if index is None:
+            return None
+        return self.dynamic_string(index)
+
+    def set_rpath(self,rpath):
+        """Replace the rpath of this file in place, if there's room for it.
+
+        Whichever of DT_RPATH and DT_RUNPATH the file has are changed to
+        point to the new value, which overwrites the old one in the string
+        table.  This only works if the file already has an rpath at least
+        as long as the new one, whose bytes aren't shared with any other
+        string; otherwise nothing is changed and False is returned.  Adding or growing an rpath means rearranging the file,
+        which is left to tools like patchelf.
+        """
+        indexes = self._dynamic_values(DT_RPATH)
+        indexes.extend(self._dynamic_values(DT_RUNPATH))
+        if not indexes:
+            return False
+        for index in indexes:
+            if len(self.dynamic_string(index)) < len(rpath):
+                return False
+        #  The linker merges strings that are suffixes of others, so e.g.
+        #  a symbol name might live at the end of the old rpath.  It can
+        #  only be overwritten if nothing else uses any of its bytes.
+        refs = self.string_references()
+        if refs is None:
+            return False
+        for index in indexes:
+            end = index + len(self.dynamic_string(index))
+            for ref in refs:
+                if ref in indexes:
+                    continue
+                if ref <= end and ref + len(self.dynamic_string(ref)) >= index:
+                    return False
+        for index in indexes:
+            start = self.strtab_offset() + index
+            oldlen = len(self.dynamic_string(index))
+            self._map[start:start+oldlen] = rpath.ljust(oldlen,"\x00")
+        return True
+
+    def string_references(self):
+        """Get the offsets of all strings used from the dynamic string table.
+
+        This covers the string-valued dynamic entries, the names of the
+        dynamic symbols, and the names in the symbol version sections.
+        Returns None if the number of dynamic symbols can't be found, in
+        which case it's not known which strings are in use.
+        """
+        refs = set()
+        for (tag,value,_) in self.dynamic:
+            if tag in _STRING_TAGS:
+                refs.add(value)
+        symtab = self._dynamic_value(DT_SYMTAB)
+        if symtab is not None:
+            nsyms = self._count_symbols()
+            if nsyms is None:
+                return None
+            entsize = self._dynamic_value(DT_SYMENT)
+            if not entsize:
+                entsize = 16 if self.elfclass == ELFCLASS32 else 24
+            offset = self.vaddr_to_offset(symtab)
+            for i in xrange(nsyms):
+                refs.add(self._unpack("I",offset + i * entsize)[0])
+        for (offset,_) in self._verneed_entries():
+            refs.add(self._unpack(_VERNEED,offset)[2])
+        for offset in self._vernaux_offsets():
+            refs.add(self._unpack(_VERNAUX,offset)[3])
+        verdef = self._dynamic_value(DT_VERDEF)
+        if verdef is not None:
+            remaining = self._dynamic_value(DT_VERDEFNUM)
+            offset = self.vaddr_to_offset(verdef)
+            while remaining is None or remaining > 0:
+                (_,_,_,vd_cnt,_,vd_aux,vd_next) = self._unpack(_VERDEF,offset)
+                auxoffset = offset + vd_aux
+                for _ in xrange(vd_cnt):
+                    (vda_name,vda_next) = self._unpack(_VERDAUX,auxoffset)
+                    refs.add(vda_name)
+                    if not vda_next:
+                        break
+                    auxoffset += vda_next
+                if remaining is not None:
+                    remaining -= 1
+                if not vd_next:
+                    break
+                offset += vd_next
+        return refs
+
+    def _count_symbols(self):
+        """Get the number of entries in the dynamic symbol table, or None.
+
+        The dynamic section doesn't record this directly.  It's taken from
+        the section headers if there are any, or else from the hash table.
+        """
+        for sh in self._section_headers():
+            if sh[1] == SHT_DYNSYM and sh[9]:
+                return sh[5] // sh[9]
+        hash = self._dynamic_value(DT_HASH)
+        if hash is not None:
+            #  The number of chain entries is the number of symbols.
+            return self._unpack("II",self.vaddr_to_offset(hash))[1]
+        gnu_hash = self._dynamic_value(DT_GNU_HASH)
+        if gnu_hash is not None:
+            #  Find the highest symbol in any bucket, then follow its chain
+            #  to the end, which is marked by the low bit being set.
+            offset = self.vaddr_to_offset(gnu_hash)
+            (nbuckets,symoffset,bloomsize,_) = self._unpack("IIII",offset)
+            offset += 16 + bloomsize * (self.bits // 8)
+            buckets = self._unpack("I" * nbuckets,offset)
+            last = max(buckets) if buckets else 0
+            if last < symoffset:
+                return symoffset
+            offset += 4 * nbuckets
+            while not self._unpack("I",offset + 4 * (last - symoffset))[0] & 1:
+                last += 1
+            return last + 1
+        return None
+
+    def _verneed_entries(self):
+        """Get (offset,vn_cnt) for each version-needed entry."""
+        entries = []
+        verneed = self._dynamic_value(DT_VERNEED)
+        if verneed is None:
+            return entries
+        remaining = self._dynamic_value(DT_VERNEEDNUM)
+        offset = self.vaddr_to_offset(verneed)
+        while remaining is None or remaining > 0:
+            (_,vn_cnt,_,_,vn_next) = self._unpack(_VERNEED,offset)
+            entries.append((offset,vn_cnt))
+            if remaining is not None:
+                remaining -= 1
+            if not vn_next:
+                break
+            offset += vn_next
+        return entries
+
+    def _vernaux_offsets(self,entry=None):
+        """Get the offsets of the auxiliary version-needed entries.
+
+        If an entry from _verneed_entries() is given, only its auxiliary
+        entries are included.
+        """
+        if entry is None:
+            entries = self._verneed_entries()
+        else:
+            entries = [entry]
+        offsets = []
+        for (offset,vn_cnt) in entries:
+            auxoffset = offset + self._unpack(_VERNEED,offset)[3]
+            for _ in xrange(vn_cnt):
+                offsets.append(auxoffset)
+                vna_next = self._unpack(_VERNAUX,auxoffset)[4]
+                if not vna_next:
+                    break
+                auxoffset += vna_next
+        return offsets
+
+    def version_needs(self):
+        """Get the symbol versions this file needs from other libraries.
+
+        This reads the version-needed entries (the .gnu.version_r section)
+        and returns a list of (library,version) pairs, e.g. the pair
+        ("libc.so.6","GLIBC_2.3").
+        """
+        needs = []
+        for entry in self._verneed_entries():
+            vn_file = self._unpack(_VERNEED,entry[0])[2]
+            libname = self.dynamic_string(vn_file)
+            for auxoffset in self._vernaux_offsets(entry):
+                vna_name = self._unpack(_VERNAUX,auxoffset)[3]
+                needs.append((libname,self.dynamic_string(vna_name)))
+        return needs
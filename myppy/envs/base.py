@@ -14,11 +14,26 @@ import subprocess
 import shutil
 import sqlite3
 import errno
+import stat
+import time
 import urlparse
-import urllib2
+import hashlib
+import json
+import heapq
+import contextlib
+import threading
+import traceback
 from functools import wraps
+from multiprocessing.pool import ThreadPool
 
 from myppy import util
+from myppy.scheduler import Scheduler
+from myppy.graph import RecipeGraph
+from myppy.jobserver import JobServer
+from myppy.artifacts import ArtifactCache
+from myppy.unpack import FollowFile, PristineStore, can_stream, \
+                         extract_file, extract_stream
+from myppy.download import download, parse_mirrors, MirrorList
 
 
 from myppy.recipes import base as _base_recipes
@@ -44,7 +59,8 @@ class MyppyEnv(object):
         * clean():      clean up temporary and build-related files
         * do():         execute a subprocess within the environment
         * install():    install a given recipe into the environment
-        * uninstall():  uninstall a recipe from the environment
+        * install_recipes():  install several recipes, building in parallel
+        * uninstall():  uninstall a recipe, and anything depending on it
 
     """
  
@@ -52,6 +68,16 @@ class MyppyEnv(object):
 
     DB_NAME = os.path.join("local","myppy.db")
 
+    #  How long to wait for another process to finish writing to the db.
+    DB_TIMEOUT = 600
+
+    #  Number of threads used to unlink files when uninstalling.
+    REMOVE_THREADS = 8
+
+    #  Directories modified less than this many seconds before being listed
+    #  are left out of the snapshot used by find_new_files().
+    SNAPSHOT_SLACK = 2
+
     def __init__(self,rootdir, architecture):
         if not isinstance(rootdir,unicode):
             rootdir = rootdir.decode(sys.getfilesystemencoding())
@@ -60,14 +86,51 @@ class MyppyEnv(object):
         self.cachedir = os.path.join(self.rootdir,"cache")
         self.env = os.environ.copy()
         self._old_files_cache = None
+        self._new_dir_snapshot = None
         self._add_env_path("PATH",os.path.join(self.PREFIX,"bin"))
         self._has_db_lock = 0
+        #  Number of independent recipes to build at the same time.
+        self.jobs = int(os.environ.get("MYPPY_JOBS",1))
+        #  All make processes share a single jobserver, so the total number
+        #  of compile jobs stays bounded however many recipes are building.
+        self.jobserver = JobServer()
+        #  Number of source downloads to run at the same time.
+        self.fetch_jobs = int(os.environ.get("MYPPY_FETCH_JOBS",4))
+        #  Sources are looked for on any configured mirrors first.
+        mirrors = parse_mirrors(os.environ.get("MYPPY_MIRRORS",""))
+        self.mirrors = MirrorList(mirrors)
+        self._fetched = {}
+        #  Each source archive is extracted once into a pristine store, and
+        #  build dirs are checked out from there.
+        mode = os.environ.get("MYPPY_SOURCE_CHECKOUT","reflink")
+        pristinedir = os.path.join(self.builddir,"MYPPY-PRISTINE")
+        self.sources = PristineStore(pristinedir,mode)
+        self.env["MAKEFLAGS"] = self.jobserver.MAKEFLAGS
+        #  Prebuilt artifacts can be shared between envs via a common cache.
+        artifactdir = os.environ.get("MYPPY_ARTIFACT_CACHE")
+        if artifactdir:
+            self.artifacts = ArtifactCache(artifactdir)
+        else:
+            self.artifacts = None
+        self._fingerprints = {}
+        self.graph = RecipeGraph(self.load_recipe)
+        self._explicit_cache = None
         if not os.path.exists(self.rootdir):
             os.makedirs(self.rootdir)
-        dbpath = os.path.join(self.rootdir,self.DB_NAME)
-        if not os.path.exists(os.path.dirname(dbpath)):
-            os.makedirs(os.path.dirname(dbpath))
-        self._db = sqlite3.connect(dbpath,isolation_level=None)
+        #  Advisory locks let several myppy processes share the env.
+        self.lockdir = os.path.join(self.rootdir,"locks")
+        if not os.path.exists(self.lockdir):
+            os.makedirs(self.lockdir)
+        self._prefix_lock = util.FileLock(os.path.join(self.lockdir,"prefix"))
+        self._prefix_lock_depth = 0
+        self._data_version = None
+        self._dbpath = os.path.join(self.rootdir,self.DB_NAME)
+        if not os.path.exists(os.path.dirname(self._dbpath)):
+            os.makedirs(os.path.dirname(self._dbpath))
+        self._db = sqlite3.connect(self._dbpath,isolation_level=None,
+                                   timeout=self.DB_TIMEOUT)
+        #  Write-ahead logging lets readers carry on during a long install.
+        self._db.execute("PRAGMA journal_mode=WAL")
         self._initdb()
         # Whether to build 32bit or 64bit architecture. Defaults to architecture
         # of Python interpreter.
@@ -88,6 +151,34 @@ class MyppyEnv(object):
             if not self._has_db_lock:
                 self._db.execute("COMMIT TRANSACTION")
 
+    @contextlib.contextmanager
+    def prefix_lock(self):
+        """Context manager holding the lock on changes to the env's files.
+
+        This must be held while installing files into the env and finding
+        and recording them, so that concurrent myppy processes don't see
+        each other's half-installed files.  It must be acquired before
+        starting a db transaction, never after.
+        """
+        if not self._prefix_lock_depth:
+            self._prefix_lock.acquire()
+        self._prefix_lock_depth += 1
+        try:
+            yield
+        finally:
+            self._prefix_lock_depth -= 1
+            if not self._prefix_lock_depth:
+                self._prefix_lock.release()
+
+    def _check_db_changes(self):
+        """Discard cached db state if another process has changed the db."""
+        row = self._db.execute("PRAGMA data_version").fetchone()
+        data_version = row and row[0]
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self._old_files_cache = None
+            self._explicit_cache = None
+
     def _add_env_path(self,key,path,pos=0):
         """Add an entry to list of paths in an envionment variable."""
         PATH = self.env.get(key,"")
@@ -124,22 +215,24 @@ class MyppyEnv(object):
 
     def init(self, args=[]):
         """Build the base myppy python environment."""
-        for dep in self.DEPENDENCIES:
-            self.install(dep,initialising=True,explicit=False)
+        self.install_recipes(self.DEPENDENCIES,initialising=True,explicit=False)
         
     def clean(self):
         """Clean out temporary built files and the like."""
-        if os.path.exists(self.builddir):
-            shutil.rmtree(self.builddir)
-        if os.path.exists(self.cachedir):
-            shutil.rmtree(self.cachedir)
-        q = "SELECT DISTINCT recipe FROM installed_files"
-        for row in self._db.execute(q):
-            if not self.is_explicitly_installed(row[0]):
-                self.uninstall(row[0])
-        for fpath in self.find_new_files():
-            if os.path.isfile(fpath) or os.path.islink(fpath):
-                os.unlink(fpath)
+        with self.prefix_lock():
+            if os.path.exists(self.builddir):
+                shutil.rmtree(self.builddir)
+            if os.path.exists(self.cachedir):
+                shutil.rmtree(self.cachedir)
+            for recipe in sorted(self.installed_recipes()):
+                if not self.is_installed(recipe):
+                    continue
+                if not self.is_explicitly_installed(recipe):
+                    self.uninstall(recipe)
+            for fpath in self.find_new_files():
+                if os.path.isfile(fpath) or os.path.islink(fpath):
+                    os.unlink(fpath)
+            self._new_dir_snapshot = None
 
     def do(self,*cmdline,**kwds):
         """Execute the given command within this myppy environment."""
@@ -182,27 +275,63 @@ class MyppyEnv(object):
         q = "SELECT filepath FROM installed_files WHERE recipe=? LIMIT 1"
         return (self._db.execute(q,(recipe,)).fetchone() is not None)
 
+    def _is_installed_now(self,recipe):
+        """Check whether a recipe is installed, using a new db connection.
+
+        This is safe to call from a forked child process, unlike methods
+        using the env's own db connection.
+        """
+        db = sqlite3.connect(self._dbpath,timeout=self.DB_TIMEOUT)
+        try:
+            q = "SELECT filepath FROM installed_files WHERE recipe=? LIMIT 1"
+            return (db.execute(q,(recipe,)).fetchone() is not None)
+        finally:
+            db.close()
+
     def is_explicitly_installed(self,recipe):
         if not self.is_installed(recipe):
             return False
-        deps = set(self.DEPENDENCIES)
-        for row in self._db.execute("SELECT recipe FROM installed_recipes"):
-            deps.add(row[0])
-        todo = list(deps)
-        while todo:
-            r = self.load_recipe(todo.pop(0))
-            for dep in r.DEPENDENCIES:
-                if dep not in deps:
-                    deps.add(dep)
-                    todo.append(dep)
-        return recipe in deps
+        return recipe in self._explicit_closure()
+
+    def _explicit_closure(self):
+        """Get all recipes needed by those that were explicitly installed.
+
+        This is cached until installed_recipes is changed, either by us or
+        (as detected by sqlite's data_version) by another process.
+        """
+        self._check_db_changes()
+        if self._explicit_cache is None:
+            explicit = set(self.DEPENDENCIES)
+            q = "SELECT recipe FROM installed_recipes"
+            for row in self._db.execute(q):
+                explicit.add(row[0])
+            self._explicit_cache = self.graph.closure(explicit)
+        return self._explicit_cache
   
     def install(self,recipe,initialising=False,explicit=True):
         """Install the named recipe into this myppy env."""
-        if not self.is_installed(recipe):
-            r = self.load_recipe(recipe)
-            if not initialising and not self.is_initialised():
-                self.init()
+        self.install_recipes([recipe],initialising,explicit)
+
+    def install_recipes(self,recipes,initialising=False,explicit=True):
+        """Install the named recipes into this myppy env.
+
+        The full graph of recipes needed is resolved up front, and up to
+        self.jobs recipes whose dependencies are already installed will be
+        fetched and built at the same time.  Installing the built files and
+        recording them is always done one recipe at a time, since it works
+        by looking for new files in the env.
+
+        Other myppy processes may be installing into the same env.  Each
+        recipe is locked from the start of its build until it's installed,
+        as is the build directory it uses, and a recipe that turns out to
+        have been installed by someone else in the meantime is skipped.
+        """
+        (deps,order) = self._plan_install(recipes,sequential=initialising)
+        if order and not initialising and not self.is_initialised():
+            self.init()
+            (deps,order) = self._plan_install(recipes)
+        plan = dict((name,self.load_recipe(name)) for name in order)
+        for (recipe,r) in plan.iteritems():
             for conflict in r.CONFLICTS_WITH:
                 if self.is_explicitly_installed(conflict):
                     msg = "Recipe %r conflicts with %r, "
@@ -210,59 +339,522 @@ class MyppyEnv(object):
                     msg %= (recipe,conflict,)
                     raise RuntimeError(msg)
                 self.uninstall(conflict)
-            for dep in r.DEPENDENCIES:
-                if dep != recipe:
-                    self.install(dep,initialising=initialising,explicit=False)
-            for dep in r.BUILD_DEPENDENCIES:
-                if dep != recipe:
-                    self.install(dep,initialising=initialising,explicit=False)
-            print "FETCHING", recipe
-            r.fetch()
+        #  Open any prebuilt artifacts now, so they can't be evicted from
+        #  the cache before we get around to installing them.
+        artifacts = {}
+        if self.artifacts is not None:
+            for (recipe,r) in plan.iteritems():
+                if r.ARTIFACT_CACHEABLE:
+                    key = self.recipe_fingerprint(recipe)
+                    artifact = self.artifacts.open(key)
+                    if artifact is not None:
+                        artifacts[recipe] = artifact
+        def builddir_key(recipe):
+            return self._source_key(recipe,plan[recipe])
+        #  The lock files are opened here rather than in the build step,
+        #  so that locks taken by a forked build are still held afterwards.
+        locks = {}
+        def lock(name):
+            if name not in locks:
+                locks[name] = util.FileLock(os.path.join(self.lockdir,name))
+            return locks[name]
+        for recipe in order:
+            lock("recipe-" + recipe)
+            lock("source-" + builddir_key(recipe))
+        def build(recipe):
+            lock("recipe-" + recipe).acquire()
+            if recipe in artifacts or self._is_installed_now(recipe):
+                return
+            lock("source-" + builddir_key(recipe)).acquire()
+            self._build_recipe(recipe,plan[recipe])
+        def install(recipe):
+            try:
+                if recipe in artifacts:
+                    self._restore_recipe(recipe,artifacts.pop(recipe))
+                else:
+                    self._install_recipe(recipe,plan[recipe])
+            finally:
+                lock("source-" + builddir_key(recipe)).release()
+                lock("recipe-" + recipe).release()
+        #  Start downloading all the sources up front, so that each build
+        #  can start as soon as its own source has arrived.
+        fetcher = self._prefetch_in_child([plan[recipe] for recipe in order
+                                           if recipe not in artifacts])
+        try:
+            Scheduler(deps,order,self.jobs,builddir_key).run(build,install)
+        finally:
+            try:
+                os.waitpid(fetcher,0)
+            except OSError, e:
+                #  The scheduler may already have reaped it.
+                if e.errno != errno.ECHILD:
+                    raise
+            for artifact in artifacts.itervalues():
+                artifact.close()
+            for l in locks.itervalues():
+                l.close()
+        if explicit:
+            for recipe in recipes:
+                if not self.is_explicitly_installed(recipe):
+                    q = "INSERT INTO installed_recipes VALUES (?)"
+                    self._db.execute(q,(recipe,))
+                    self._explicit_cache = None
+
+    def _plan_install(self,recipes,sequential=False):
+        """Work out which recipes must be built to install the given ones.
+
+        This returns a dict mapping each recipe that is not yet installed to
+        the set of recipes it must wait for, and a list of those recipes in
+        the order that a serial depth-first install would build them.
+
+        If sequential is true, everything needed for each of the named
+        recipes must also wait for everything needed by the ones before it.
+        This is used when initialising the env, where earlier dependencies
+        provide the toolchain for later ones.
+        """
+        deps = {}
+        order = []
+        def visit(recipe):
+            if recipe in deps or self.is_installed(recipe):
+                return
+            deps[recipe] = set()
+            for dep in self.graph.build_dependencies(recipe):
+                visit(dep)
+                if dep in deps:
+                    deps[recipe].add(dep)
+            order.append(recipe)
+        for recipe in recipes:
+            earlier = list(order)
+            visit(recipe)
+            if sequential:
+                for later in order[len(earlier):]:
+                    deps[later].update(earlier)
+        return (deps,order)
+
+    def fetch_recipes(self,recipes):
+        """Download the sources for the named recipes and everything needed
+        to build them, whether already installed or not.
+        """
+        rs = [self.load_recipe(recipe)
+              for recipe in sorted(self.graph.build_closure(recipes))]
+        (pool,results) = self._prefetch(rs)
+        pool.close()
+        pool.join()
+        failed = []
+        for (r,result) in results:
+            try:
+                result.get()
+            except Exception:
+                failed.append(r.__class__.__name__)
+        if failed:
+            raise RuntimeError("failed to fetch: %s" % (", ".join(failed),))
+
+    def _prefetch(self,rs):
+        """Start fetching the given recipes in a pool of background threads.
+
+        Each distinct source is fetched once.  A build that needs a source
+        that's still downloading will wait for it in fetch().  Returns the
+        pool and a list of (recipe,result) pairs; the caller must close
+        and join the pool.
+        """
+        pool = ThreadPool(max(1,self.fetch_jobs))
+        results = []
+        seen = set()
+        def fetch(r):
+            try:
+                r.fetch()
+            except Exception, e:
+                print "FETCH FAILED", getattr(r,"SOURCE_URL",r), e
+                raise
+        for r in rs:
+            key = self._source_key(r.__class__.__name__,r)
+            if key not in seen:
+                seen.add(key)
+                results.append((r,pool.apply_async(fetch,(r,))))
+        return (pool,results)
+
+    def _prefetch_in_child(self,rs):
+        """Fetch the given recipes in a forked helper process.
+
+        The helper fetches them in a pool of threads just like _prefetch(),
+        while this process stays single-threaded.  Forking a process with
+        other threads running can leave the child deadlocked on a lock that
+        one of them was holding, and builds are run in forked children.
+        Returns the pid of the helper.
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                (pool,_) = self._prefetch(rs)
+                pool.close()
+                pool.join()
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status)
+        return pid
+
+    def _source_key(self,recipe,r):
+        """Get a key identifying the source that a recipe is built from.
+
+        Recipes sharing a source tarball also share a build directory, so
+        this is the tarball's filename.  Recipes with no source of their
+        own are keyed on their name, so they don't get in each other's way.
+        """
+        url = getattr(r,"SOURCE_URL",None)
+        if not url or url == _base_recipes.Recipe.SOURCE_URL:
+            return recipe
+        return os.path.basename(url)
+
+    def _build_recipe(self,recipe,r):
+        """Build the given recipe, ready for installation.
+
+        The build fetches its own sources as needed, so that they can be
+        unpacked as they're downloaded rather than afterwards.
+        """
+        print "BUILDING", recipe
+        with self.jobserver.slot():
+            r.build()
+
+    def _install_recipe(self,recipe,r):
+        """Install an already-built recipe, and record its files.
+
+        The prefix lock is only held while files are going into the env
+        and being recorded.  Staged installs are run before taking it, and
+        the files are post-processed and cached after releasing it.
+        """
+        if self.is_installed(recipe):
+            print "ALREADY INSTALLED", recipe
+            return
+        print "INSTALLING", recipe
+        stagedir = None
+        if r.STAGED_INSTALL:
+            stagedir = self._stage_install(recipe,r)
+        try:
+            with self.prefix_lock():
+                if self.is_installed(recipe):
+                    print "ALREADY INSTALLED", recipe
+                    return
+                if stagedir is not None:
+                    files = self._merge_staged_install(recipe,stagedir)
+                else:
+                    r.install()
+                    print "RECORDING INSTALLED FILES FOR", recipe
+                    files = list(self.find_new_files())
+                #  The metadata is filled in once the files are processed.
+                with self:
+                    self.record_files(recipe,files,[(None,)*3]*len(files))
+        finally:
+            if stagedir is not None and os.path.exists(stagedir):
+                shutil.rmtree(stagedir)
+        try:
+            self.process_files(recipe,files)
+            infos = self.file_infos(files)
             with self:
-                print "BUILDING", recipe
-                r.build()
-                print "INSTALLING", recipe
-                r.install()
-                print "RECORDING INSTALLED FILES FOR", recipe
-                files = list(self.find_new_files())
-                self.record_files(recipe,files)
-                print "INSTALLED", recipe
-        if explicit and not self.is_explicitly_installed(recipe):
+                self._update_file_infos(recipe,files,infos)
+                self._record_fingerprint(recipe)
+        except Exception:
+            print "PROCESSING FAILED, UNINSTALLING", recipe
+            self.uninstall(recipe)
+            raise
+        print "INSTALLED", recipe
+        if self.artifacts is not None and r.ARTIFACT_CACHEABLE:
+            print "CACHING ARTIFACT FOR", recipe
+            files = [file[len(self.rootdir)+1:] for file in files]
+            self.artifacts.store(self.recipe_fingerprint(recipe),
+                                 self.rootdir,files)
+
+    def _stage_install(self,recipe,r):
+        """Run a recipe's install commands into a staging dir.
+
+        The commands put their files under a private staging dir, from
+        which _merge_staged_install() moves them into place.  This tells us
+        exactly which files were installed, so there's no need to scan the
+        whole env looking for new ones.  Returns the staging dir.
+        """
+        stagedir = os.path.join(self.builddir,"MYPPY-STAGE",recipe)
+        if os.path.exists(stagedir):
+            shutil.rmtree(stagedir)
+        r.stagedir = stagedir
+        try:
+            r.install()
+        except Exception:
+            if os.path.exists(stagedir):
+                shutil.rmtree(stagedir)
+            raise
+        finally:
+            r.stagedir = None
+        return stagedir
+
+    def _merge_staged_install(self,recipe,stagedir):
+        """Move a staged install into the env, returning the installed files.
+
+        Some install commands write straight into the env regardless.  To
+        catch these we still look for new files afterwards, but thanks to
+        the directory snapshot only the directories that changed are read.
+        """
+        files = self.merge_staged_files(stagedir)
+        staged = set(files)
+        unstaged = [f for f in self.find_new_files() if f not in staged]
+        if unstaged:
+            print "FILES INSTALLED OUTSIDE STAGING DIR FOR", recipe
+            files.extend(unstaged)
+        return files
+
+    def merge_staged_files(self,stagedir):
+        """Move files from the given staging dir into the env.
+
+        Files staged at stagedir + <final path> are moved to their final
+        path, and the list of newly-installed files is returned in the same
+        form as produced by find_new_files().  The staging dir is left empty.
+        """
+        self._check_db_changes()
+        files = []
+        stageroot = stagedir + self.rootdir
+        todo = [""]
+        while todo:
+            relpath = todo.pop(0)
+            srcdir = stageroot + relpath
+            dstdir = self.rootdir + relpath
+            if not os.path.isdir(srcdir):
+                continue
+            if not os.path.isdir(dstdir):
+                os.makedirs(dstdir)
+            names = os.listdir(srcdir)
+            if not names and relpath:
+                if not self._is_oldfile(dstdir + os.sep):
+                    files.append(dstdir + os.sep)
+            for nm in names:
+                srcpath = os.path.join(srcdir,nm)
+                dstpath = os.path.join(dstdir,nm)
+                if util.isrealdir(srcpath):
+                    todo.append(relpath + os.sep + nm)
+                else:
+                    util.movefile(srcpath,dstpath)
+                    if not self._is_oldfile(dstpath):
+                        files.append(dstpath)
+        #  Anything left over was installed outside the env, which means
+        #  the recipe doesn't properly support staged installs.
+        if os.path.isdir(stageroot):
+            shutil.rmtree(stageroot)
+        for (dirnm,_,filenms) in os.walk(stagedir):
+            if filenms:
+                msg = "files staged outside the env: %s" % (dirnm,)
+                raise RuntimeError(msg)
+        if os.path.isdir(stagedir):
+            shutil.rmtree(stagedir)
+        return files
+
+    def _restore_recipe(self,recipe,artifact):
+        """Install a recipe by unpacking a prebuilt artifact."""
+        with self.prefix_lock():
+            if self.is_installed(recipe):
+                artifact.close()
+                print "ALREADY INSTALLED", recipe
+                return
+            print "RESTORING CACHED ARTIFACT FOR", recipe
+            files = self.artifacts.extract(artifact,self.rootdir)
+            #  The cached files were already fixed up for the env when
+            #  first installed, so they don't need processing again.
+            infos = self.file_infos(files)
+            with self:
+                self.record_files(recipe,files,infos)
+                self._record_fingerprint(recipe)
+            print "INSTALLED", recipe
+
+    def recipe_fingerprint(self,recipe):
+        """Get a hash identifying all the inputs to building a recipe.
+
+        This covers the source code of the recipe class and its bases, the
+        source it's built from, the env's compiler settings and location,
+        and the fingerprints of everything the recipe depends on.  Recipes
+        with the same fingerprint should produce identical files.
+        """
+        try:
+            return self._fingerprints[recipe]
+        except KeyError:
+            pass
+        r = self.load_recipe(recipe)
+        inputs = [("recipe",recipe),("PREFIX",self.PREFIX),("ARCH",self.ARCH)]
+        for nm in ("CC","CXX","CFLAGS","CXXFLAGS","LDFLAGS",
+                   "MACOSX_DEPLOYMENT_TARGET",):
+            inputs.append((nm,getattr(self,nm,None)))
+        inputs.extend(r._fingerprint_inputs())
+        for dep in self.graph.build_dependencies(recipe):
+            inputs.append(("dep:" + dep,self.recipe_fingerprint(dep)))
+        fingerprint = hashlib.sha1(repr(inputs)).hexdigest()
+        self._fingerprints[recipe] = fingerprint
+        return fingerprint
+
+    def _record_fingerprint(self,recipe):
+        q = "DELETE FROM recipe_fingerprints WHERE recipe=?"
+        self._db.execute(q,(recipe,))
+        q = "INSERT INTO recipe_fingerprints VALUES (?,?)"
+        self._db.execute(q,(recipe,self.recipe_fingerprint(recipe),))
+
+    def stale_recipes(self):
+        """Get the installed recipes whose build inputs have changed.
+
+        These are the recipes whose current fingerprint differs from the
+        one recorded when they were installed.  Recipes with no recorded
+        fingerprint (e.g. files recorded by hand) and recipes that no longer
+        exist are never considered stale.
+        """
+        self._check_db_changes()
+        stale = set()
+        q = "SELECT recipe, fingerprint FROM recipe_fingerprints"
+        for (recipe,fingerprint) in self._db.execute(q).fetchall():
+            try:
+                if self.recipe_fingerprint(recipe) != fingerprint:
+                    stale.add(recipe)
+            except AttributeError:
+                continue
+        return stale
+
+    def update_recipes(self,dry_run=False):
+        """Rebuild any installed recipes whose build inputs have changed.
+
+        Everything installed that depends on a stale recipe is rebuilt as
+        well.  The rebuilds all go through a single install_recipes call, so
+        they happen in dependency order and up to self.jobs at a time.  The
+        names of the recipes to be rebuilt are returned; with dry_run=True
+        they're only reported, not rebuilt.
+        """
+        stale = self.stale_recipes()
+        rebuild = set(stale)
+        for recipe in stale:
+            rebuild.update(self.reverse_dependencies(recipe))
+        rebuild = sorted(rebuild)
+        for recipe in rebuild:
+            if recipe in stale:
+                print "OUT OF DATE", recipe
+            else:
+                print "DEPENDS ON OUT OF DATE RECIPES", recipe
+        if dry_run or not rebuild:
+            return rebuild
+        q = "SELECT recipe FROM installed_recipes"
+        explicit = [row[0] for row in self._db.execute(q)
+                    if row[0] in rebuild]
+        for recipe in rebuild:
+            if self.is_installed(recipe):
+                self.uninstall(recipe)
+        self.install_recipes(rebuild,explicit=False)
+        with self:
             q = "INSERT INTO installed_recipes VALUES (?)"
-            self._db.execute(q,(recipe,))
+            self._db.executemany(q,[(recipe,) for recipe in explicit])
+            self._explicit_cache = None
+        return rebuild
+
+    def installed_recipes(self):
+        """Get the set of names of all recipes installed in the env."""
+        q = "SELECT DISTINCT recipe FROM installed_files"
+        return set(row[0] for row in self._db.execute(q))
+
+    def reverse_dependencies(self,recipe):
+        """Get the installed recipes that depend on the given one."""
+        among = []
+        for other in self.installed_recipes():
+            #  Ignore leftovers from recipes that no longer exist.
+            try:
+                self.graph.dependencies(other)
+            except AttributeError:
+                continue
+            among.append(other)
+        return self.graph.dependents(recipe,among)
 
     def uninstall(self,recipe):
-        """Uninstall the named recipe from this myppy env."""
-        # TODO: remove things depending on it
-        with self:
-            q = "DELETE FROM installed_recipes WHERE recipe=?"
-            self._db.execute(q,(recipe,))
-            q = "SELECT filepath FROM installed_files WHERE recipe=?"\
-                " ORDER BY filepath DESC"
-            files = [r[0] for r in self._db.execute(q,(recipe,))]
-            q = "DELETE FROM installed_files WHERE recipe=?"
-            self._db.execute(q,(recipe,))
-            for file in files:
-                assert util.relpath(file) == file
-                if self._old_files_cache is not None:
-                    self._old_files_cache.remove(file)
-            for file in files:
-                filepath = os.path.join(self.rootdir,file)
-                if not os.path.exists(filepath):
+        """Uninstall the named recipe from this myppy env.
+
+        Any installed recipes that depend on it are uninstalled as well,
+        all in a single transaction.  The names of all uninstalled recipes
+        are returned.
+        """
+        with self.prefix_lock():
+            with self:
+                self._check_db_changes()
+                recipes = set([recipe])
+                recipes.update(self.reverse_dependencies(recipe))
+                recipes = sorted(recipes)
+                for r in recipes:
+                    if r != recipe and self.is_installed(r):
+                        print "UNINSTALLING DEPENDENT", r
+                args = [(r,) for r in recipes]
+                q = "DELETE FROM installed_recipes WHERE recipe=?"
+                if self._db.executemany(q,args).rowcount:
+                    self._explicit_cache = None
+                q = "DELETE FROM recipe_fingerprints WHERE recipe=?"
+                self._db.executemany(q,args)
+                files = []
+                q = "SELECT filepath FROM installed_files WHERE recipe=?"
+                for r in recipes:
+                    files.extend(row[0] for row in self._db.execute(q,(r,)))
+                q = "DELETE FROM installed_files WHERE recipe=?"
+                self._db.executemany(q,args)
+                self._forget_dir_snapshot(files)
+                for file in files:
+                    assert util.relpath(file) == file
+                    if self._old_files_cache is not None:
+                        self._old_files_cache.discard(file)
+                self._remove_files(files)
+        return recipes
+
+    def _remove_files(self,files):
+        """Remove the given files from the env, pruning emptied directories.
+
+        Files are grouped by directory and handled deepest directory first.
+        The files in each directory are unlinked in parallel, then the
+        directory is pruned if it's recorded as installed or now empty,
+        in which case its parent gets checked in turn.
+        """
+        bydir = {}
+        for file in files:
+            if file.endswith(os.sep):
+                bydir.setdefault(file.rstrip(os.sep),[])
+            else:
+                bydir.setdefault(os.path.dirname(file),[]).append(file)
+        recorded_dirs = set(f.rstrip(os.sep) for f in files
+                            if f.endswith(os.sep))
+        def unlink(file):
+            try:
+                os.unlink(os.path.join(self.rootdir,file))
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        todo = [(-dirpath.count(os.sep),dirpath) for dirpath in bydir]
+        heapq.heapify(todo)
+        pool = ThreadPool(self.REMOVE_THREADS)
+        try:
+            while todo:
+                (_,dirpath) = heapq.heappop(todo)
+                pool.map(unlink,bydir.pop(dirpath,()))
+                if not dirpath:
                     continue
-                if filepath.endswith(os.sep):
-                    print "PRUNING", filepath
-                    util.prune_dir(filepath)
-                else:
-                    print "REMOVING", filepath
-                    os.unlink(filepath)
-                    dirpath = os.path.dirname(filepath) + os.sep
-                    if not os.listdir(dirpath):
-                        q = "SELECT * FROM installed_files WHERE filepath=?"
-                        if not self._is_oldfile(dirpath):
-                            print "PRUNING", filepath
-                            util.prune_dir(dirpath)
-                
+                fulldirpath = os.path.join(self.rootdir,dirpath)
+                if dirpath in recorded_dirs:
+                    if not os.path.lexists(fulldirpath):
+                        continue
+                elif not util.isrealdir(fulldirpath):
+                    continue
+                elif os.listdir(fulldirpath):
+                    continue
+                elif self._is_oldfile(fulldirpath + os.sep):
+                    continue
+                util.prune_dir(fulldirpath + os.sep)
+                parent = os.path.dirname(dirpath)
+                if parent not in bydir and not os.path.lexists(fulldirpath):
+                    bydir[parent] = []
+                    heapq.heappush(todo,(-parent.count(os.sep),parent))
+        finally:
+            pool.close()
+            pool.join()
+
     def load_recipe(self,recipe):
         return getattr(_base_recipes,recipe)(self)
 
@@ -285,12 +877,13 @@ class MyppyEnv(object):
         return r(self)
 
     def _is_tempfile(self,path):
-        for excl in (self.builddir,self.cachedir,):
+        for excl in (self.builddir,self.cachedir,self.lockdir,):
             if path == excl or path.startswith(excl + os.sep):
                 return True
         if os.path.basename(path) == "myppy.db":
             return True
-        if os.path.basename(path) == "myppy.db-journal":
+        if os.path.basename(path) in ("myppy.db-journal","myppy.db-wal",
+                                      "myppy.db-shm",):
             return True
         return False
 
@@ -309,18 +902,46 @@ class MyppyEnv(object):
         return False
  
     def find_new_files(self):
+        """Find all files in the env that haven't been recorded as installed.
+
+        To avoid listing every directory in the env, this consults the
+        snapshot of directory stat info saved by the last record_files().
+        Once all new files found in a directory have been recorded, they
+        can't change without also changing the mtime of the directory.
+        So a directory whose mtime and inode match the snapshot can't
+        contain any new files, and only its subdirectories need checking.
+        """
+        self._check_db_changes()
+        snapshot = self._load_dir_snapshot()
+        self._new_dir_snapshot = None
+        new_snapshot = {}
+        now = time.time()
         #  os.walk has a bad habit of choking on unicode errors, so
         #  we do it by hand and get it right.  Anything that can't
         #  be decoded properly gets deleted.
         todo = [self.rootdir]
         while todo:
             dirpath = todo.pop(0)
+            try:
+                st = os.stat(dirpath)
+            except OSError, e:
+                if e.errno not in (errno.ENOENT,):
+                    raise
+                continue
+            reldir = dirpath[len(self.rootdir)+1:]
+            old = snapshot.get(reldir)
+            if old is not None and old[:2] == (st.st_mtime,st.st_ino):
+                new_snapshot[reldir] = old
+                for nm in old[2]:
+                    todo.append(os.path.join(dirpath,nm))
+                continue
             try:
                 names = os.listdir(dirpath)
             except OSError, e:
                 if e.errno not in (errno.ENOENT,):
                     raise
                 continue
+            subdirs = []
             if not names:
                 if not self._is_oldfile(dirpath + os.sep):
                     yield dirpath + os.sep
@@ -337,56 +958,432 @@ class MyppyEnv(object):
                     else:
                         if not self._is_tempfile(fpath):
                             if util.isrealdir(fpath):
+                                subdirs.append(nm)
                                 todo.append(fpath)
                             else:
                                 if not self._is_oldfile(fpath):
                                     yield fpath
+            #  A directory modified very recently might be modified again
+            #  without its mtime changing, so don't trust it next time.
+            if st.st_mtime < now - self.SNAPSHOT_SLACK:
+                new_snapshot[reldir] = (st.st_mtime,st.st_ino,subdirs)
+        self._new_dir_snapshot = new_snapshot
+
+    def _load_dir_snapshot(self):
+        snapshot = {}
+        q = "SELECT dirpath, mtime, ino, subdirs FROM dir_snapshots"
+        for (dirpath,mtime,ino,subdirs) in self._db.execute(q):
+            if subdirs:
+                subdirs = subdirs.split("/")
+            else:
+                subdirs = []
+            snapshot[dirpath] = (mtime,ino,subdirs)
+        return snapshot
+
+    def _save_dir_snapshot(self):
+        """Save the snapshot taken by the last complete find_new_files().
+
+        This must only be called once all the files it found have been
+        recorded, or they'd never be found again.
+        """
+        snapshot = self._new_dir_snapshot
+        self._new_dir_snapshot = None
+        if snapshot is None:
+            return
+        self._db.execute("DELETE FROM dir_snapshots")
+        q = "INSERT INTO dir_snapshots VALUES (?,?,?,?)"
+        self._db.executemany(q,((dirpath,mtime,ino,"/".join(subdirs),)
+                                for (dirpath,(mtime,ino,subdirs))
+                                in snapshot.iteritems()))
 
-    def record_files(self,recipe,files):
-        """Record the given list of files as installed for the given recipe."""
+    def _forget_dir_snapshot(self,files):
+        """Discard snapshot entries for the directories holding given files.
+
+        This is needed when files stop being recorded without necessarily
+        being removed from disk.
+        """
+        dirpaths = set()
+        for file in files:
+            dirpaths.add(os.path.dirname(file.rstrip(os.sep)))
+        q = "DELETE FROM dir_snapshots WHERE dirpath=?"
+        self._db.executemany(q,((dirpath,) for dirpath in dirpaths))
+
+    def process_files(self,recipe,files):
+        """Post-process newly-installed files before they're recorded.
+
+        This is called with the prefix lock held but outside of any db
+        transaction, so that slow processing doesn't block other users of
+        the db.  Subclasses override it to fix up binaries for the platform.
+        """
+        pass
+
+    def record_files(self,recipe,files,infos=None):
+        """Record the given list of files as installed for the given recipe.
+
+        Along with each file we record its size, mode and content hash as
+        they are right now, after any post-processing by the env.  Hashing
+        is slow, so callers holding a db transaction should get these from
+        file_infos() beforehand and pass them in.
+        """
         files = list(files)
         assert files, "recipe '%s' didn't install any files" % (recipe,)
-        for file in files:
-            file = file[len(self.rootdir)+1:]
-            assert util.relpath(file) == file
-            self._db.execute("INSERT INTO installed_files VALUES (?,?)",
-                             (recipe,file,))
+        if infos is None:
+            infos = self.file_infos(files)
+        rows = []
+        for (file,info) in zip(files,infos):
+            relfile = file[len(self.rootdir)+1:]
+            assert util.relpath(relfile) == relfile
+            rows.append((recipe,relfile) + info)
             if self._old_files_cache is not None:
-                self._old_files_cache.add(file)
+                self._old_files_cache.add(relfile)
+        q = "INSERT INTO installed_files (recipe,filepath,size,mode,hash)"\
+            " VALUES (?,?,?,?,?)"
+        self._db.executemany(q,rows)
+        self._save_dir_snapshot()
+
+    def _update_file_infos(self,recipe,files,infos):
+        """Update the recorded size, mode and hash of installed files."""
+        rows = []
+        for (file,info) in zip(files,infos):
+            rows.append(info + (recipe,file[len(self.rootdir)+1:],))
+        q = "UPDATE installed_files SET size=?, mode=?, hash=?"\
+            " WHERE recipe=? AND filepath=?"
+        self._db.executemany(q,rows)
+
+    def file_infos(self,files):
+        """Get the (size,mode,hash) to record for each of the given files."""
+        return [self._file_info(file) for file in files]
+
+    def _file_info(self,file):
+        """Get the (size,mode,hash) to be recorded for an installed file.
+
+        Directories and symlinks don't get a content hash.
+        """
+        try:
+            st = os.lstat(file.rstrip(os.sep))
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return (None,None,None)
+        if not stat.S_ISREG(st.st_mode):
+            return (None,st.st_mode,None)
+        return (st.st_size,st.st_mode,util.hashfile(file))
 
     def _initdb(self):
-        self._db.execute("CREATE TABLE IF NOT EXISTS installed_recipes ("
-                         "  recipe STRING NOT NULL"
-                         ")")
-        self._db.execute("CREATE TABLE IF NOT EXISTS installed_files ("
-                         "  recipe STRING NOT NULL,"
-                         "  filepath STRING NOT NULL"
-                         ")")
-
-    def fetch(self,url,md5=None):
-        """Fetch the file at the given URL, using cached version if possible."""
+        """Create or upgrade the database schema.
+
+        The schema version is stored in the "user_version" pragma, and
+        each entry in SCHEMA_MIGRATIONS upgrades it by one version.  Old
+        databases from before the schema was versioned have version zero.
+        """
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version > len(self.SCHEMA_MIGRATIONS):
+            raise RuntimeError("myppy.db has unknown schema version %d"
+                               % (version,))
+        if version == len(self.SCHEMA_MIGRATIONS):
+            return
+        with self:
+            #  Re-check, in case another process has just upgraded it.
+            version = self._db.execute("PRAGMA user_version").fetchone()[0]
+            for statements in self.SCHEMA_MIGRATIONS[version:]:
+                for statement in statements:
+                    self._db.execute(statement)
+                version += 1
+            self._db.execute("PRAGMA user_version=%d" % (version,))
+
+    SCHEMA_MIGRATIONS = [
+        #  Version 1:  the original unversioned tables.
+        ["CREATE TABLE IF NOT EXISTS installed_recipes ("
+         "  recipe STRING NOT NULL"
+         ")",
+         "CREATE TABLE IF NOT EXISTS installed_files ("
+         "  recipe STRING NOT NULL,"
+         "  filepath STRING NOT NULL"
+         ")",
+         "CREATE TABLE IF NOT EXISTS recipe_fingerprints ("
+         "  recipe STRING NOT NULL,"
+         "  fingerprint STRING NOT NULL"
+         ")",
+         "CREATE TABLE IF NOT EXISTS dir_snapshots ("
+         "  dirpath STRING NOT NULL,"
+         "  mtime REAL NOT NULL,"
+         "  ino INTEGER NOT NULL,"
+         "  subdirs STRING NOT NULL"
+         ")",],
+        #  Version 2:  indexes, and per-file metadata.
+        ["CREATE INDEX IF NOT EXISTS installed_files_recipe"
+         "  ON installed_files (recipe)",
+         "CREATE INDEX IF NOT EXISTS installed_files_filepath"
+         "  ON installed_files (filepath)",
+         "CREATE INDEX IF NOT EXISTS installed_recipes_recipe"
+         "  ON installed_recipes (recipe)",
+         "CREATE INDEX IF NOT EXISTS recipe_fingerprints_recipe"
+         "  ON recipe_fingerprints (recipe)",
+         "CREATE INDEX IF NOT EXISTS dir_snapshots_dirpath"
+         "  ON dir_snapshots (dirpath)",
+         "ALTER TABLE installed_files ADD COLUMN size INTEGER",
+         "ALTER TABLE installed_files ADD COLUMN mode INTEGER",
+         "ALTER TABLE installed_files ADD COLUMN hash STRING",],
+        #  Version 3:  download stats for each source mirror.
+        ["CREATE TABLE IF NOT EXISTS mirror_stats ("
+         "  mirror STRING NOT NULL PRIMARY KEY,"
+         "  failures INTEGER NOT NULL DEFAULT 0,"
+         "  seconds REAL NOT NULL DEFAULT 0,"
+         "  nbytes INTEGER NOT NULL DEFAULT 0"
+         ")",],
+    ]
+
+    def fetch(self,url,md5=None,sha256=None):
+        """Fetch the file at the given URL, using cached version if possible.
+
+        If an md5 or sha256 hex digest is given, the file is checked against
+        it.  Digests of cached files are kept in a sidecar ".meta" file, so
+        they're only recalculated if the file changes.
+        """
+        cachefile = self.cache_path(url)
+        #  Concurrent fetches of the same file, from other threads or other
+        #  processes, wait for the first one to finish downloading it.
+        lock = util.FileLock(cachefile + ".lock")
+        try:
+            with lock:
+                if os.path.exists(cachefile):
+                    bad = self._check_digests(cachefile,md5,sha256)
+                    if bad is not None:
+                        print "BAD %s FOR" % (bad.upper(),), cachefile
+                        os.unlink(cachefile)
+                if not os.path.exists(cachefile):
+                    self._download(url,cachefile,md5,sha256)
+        finally:
+            lock.close()
+        self._fetched[url] = cachefile
+        return cachefile
+
+    def cache_path(self,url):
+        """Get the path at which the file for the given URL is cached."""
         cachedir = os.environ.get("MYPPY_DOWNLOAD_CACHE",self.cachedir)
         if cachedir:
             if not os.path.isabs(cachedir[0]):
                 cachedir = os.path.join(self.rootdir,cachedir)
-            if not os.path.isdir(cachedir):
+            try:
                 os.makedirs(cachedir)
+            except EnvironmentError, e:
+                if e.errno != errno.EEXIST:
+                    raise
         nm = os.path.basename(urlparse.urlparse(url).path)
-        cachefile = os.path.join(cachedir,nm)
-        if md5 is not None and os.path.exists(cachefile):
-            if md5 != util.md5file(cachefile):
-                print "BAD MD5 FOR", cachefile
-                print md5, util.md5file(cachefile)
-                os.unlink(cachefile)
-        if not os.path.exists(cachefile):
-            print "DOWNLOADING", url
-            fIn = urllib2.urlopen(url)
+        return os.path.join(cachedir,nm)
+
+    def unpack(self,url,workdir,md5=None,sha256=None,select=None):
+        """Fetch the archive at the given URL and extract it into workdir.
+
+        Archives are extracted into the pristine source store, keyed by
+        their sha256, and workdir is checked out from there.  So an archive
+        that has been unpacked before isn't extracted again.  If a
+        MemberFilter is given as select, only the members it selects are
+        extracted, and the filter becomes part of the key.
+
+        If the archive isn't already cached, it's extracted while it's
+        being downloaded, by following the partial download file as it
+        grows.  This works just as well when the download is being done
+        by another thread or process, e.g. the prefetcher.  If anything
+        goes wrong with the streamed extraction, or the bytes it saw don't
+        match the completed file, it's done again from the cached file.
+
+        Returns the path of the top-level directory in the archive.
+        """
+        cachefile = self.cache_path(url)
+        tmpdir = None
+        streamed = False
+        if not os.path.exists(cachefile) and can_stream(cachefile):
+            tmpdir = self.sources.tempdir()
             try:
-                 with open(cachefile,"wb") as fOut:
-                    shutil.copyfileobj(fIn,fOut)
-            finally:
-                fIn.close()
-        if md5 is not None and md5 != util.md5file(cachefile):
-            raise RuntimeError("corrupted download: %s" % (url,))
-        return cachefile
+                streamed = self._unpack_streaming(url,tmpdir,md5,sha256,
+                                                  select)
+            except:
+                shutil.rmtree(tmpdir)
+                raise
+        cachefile = self.fetch(url,md5,sha256)
+        key = self._cached_digests(cachefile)["sha256"]
+        if select:
+            key += "-" + select.key
+        if not self.sources.has(key):
+            if tmpdir is None:
+                tmpdir = self.sources.tempdir()
+            if not streamed:
+                extract_file(cachefile,tmpdir,select)
+            self.sources.commit(tmpdir,key)
+        elif tmpdir is not None:
+            shutil.rmtree(tmpdir)
+        self.sources.checkout(key,workdir)
+        return os.path.join(workdir,os.listdir(workdir)[0])
+
+    def _unpack_streaming(self,url,workdir,md5=None,sha256=None,select=None):
+        """Extract an archive into workdir while it's being downloaded.
+
+        Returns True if the extracted files are known to be good, or False
+        if the workdir has been cleared out for them to be extracted again.
+        """
+        cachefile = self.cache_path(url)
+        errors = []
+        def fetch():
+            try:
+                self.fetch(url,md5,sha256)
+            except Exception, e:
+                errors.append(e)
+        fetcher = threading.Thread(target=fetch)
+        fetcher.start()
+        f = FollowFile(cachefile + ".part",cachefile,fetcher.isAlive)
+        try:
+            try:
+                extract_stream(f,cachefile,workdir,select)
+                streamed = True
+            except Exception, e:
+                print "STREAMING UNPACK FAILED", url, e
+                streamed = False
+        finally:
+            fetcher.join()
+            f.close()
+        if errors:
+            raise errors[0]
+        if streamed:
+            sha256 = self._cached_digests(cachefile)["sha256"]
+            if f.matches(os.path.getsize(cachefile),sha256):
+                return True
+        shutil.rmtree(workdir)
+        os.makedirs(workdir)
+        return False
+
+    def _download(self,url,cachefile,md5=None,sha256=None):
+        """Download a file, trying each mirror in turn before the original.
+
+        A mirror that fails or gives a bad file is skipped and ranked lower
+        for future downloads.
+        """
+        errors = []
+        self._load_mirror_stats()
+        for (mirror,srcurl) in self.mirrors.urls(url):
+            print "DOWNLOADING", srcurl
+            t0 = time.time()
+            try:
+                download(srcurl,cachefile)
+            except Exception, e:
+                print "DOWNLOAD FAILED", srcurl, e
+                errors.append("%s: %s" % (srcurl,e,))
+                self._record_mirror_stats(mirror,1,0,0)
+                continue
+            bad = self._check_digests(cachefile,md5,sha256)
+            if bad is not None:
+                print "BAD %s FOR" % (bad.upper(),), srcurl
+                errors.append("%s: corrupted download" % (srcurl,))
+                self._record_mirror_stats(mirror,1,0,0)
+                os.unlink(cachefile)
+                continue
+            nbytes = os.path.getsize(cachefile)
+            self._record_mirror_stats(mirror,0,time.time() - t0,nbytes)
+            return
+        raise RuntimeError("could not download %s:\n  %s"
+                           % (url,"\n  ".join(errors),))
+
+    def _load_mirror_stats(self):
+        """Update the mirror rankings with stats from the db.
+
+        Downloads happen in forked build processes and in the prefetch
+        helper, so the stats are kept in the db where they all can see
+        them.  This uses a new db connection, like _is_installed_now().
+        """
+        if not self.mirrors.mirrors:
+            return
+        db = sqlite3.connect(self._dbpath,timeout=self.DB_TIMEOUT)
+        try:
+            q = "SELECT mirror, failures, seconds, nbytes FROM mirror_stats"
+            for (mirror,failures,seconds,nbytes) in db.execute(q):
+                self.mirrors.set_stats(mirror,failures,seconds,nbytes)
+        finally:
+            db.close()
+
+    def _record_mirror_stats(self,mirror,failures,seconds,nbytes):
+        """Add the results of a download from the given mirror to its stats.
+
+        The mirror is None for downloads from the original URL, which have
+        no stats.
+        """
+        if mirror is None:
+            return
+        if failures:
+            self.mirrors.record_failure(mirror)
+        else:
+            self.mirrors.record_success(mirror,seconds,nbytes)
+        db = sqlite3.connect(self._dbpath,timeout=self.DB_TIMEOUT)
+        try:
+            with db:
+                q = "INSERT OR IGNORE INTO mirror_stats (mirror) VALUES (?)"
+                db.execute(q,(mirror,))
+                q = "UPDATE mirror_stats SET failures=failures+?,"
+                q += " seconds=seconds+?, nbytes=nbytes+? WHERE mirror=?"
+                db.execute(q,(failures,seconds,nbytes,mirror,))
+        finally:
+            db.close()
+
+    def mirror_recipes(self,mirrordir,recipes):
+        """Copy the sources for the named recipes into a mirror directory.
+
+        Everything needed to build the recipes is fetched as necessary,
+        and copied into the given directory under its original name.  The
+        directory can then be listed in $MYPPY_MIRRORS.  Files already in
+        the mirror are only replaced if their contents differ.
+        """
+        if not os.path.isdir(mirrordir):
+            os.makedirs(mirrordir)
+        self.fetch_recipes(recipes)
+        for (url,cachefile) in sorted(self._fetched.iteritems()):
+            nm = os.path.basename(urlparse.urlparse(url).path)
+            dest = os.path.join(mirrordir,nm)
+            if os.path.exists(dest):
+                if os.path.getsize(dest) == os.path.getsize(cachefile):
+                    digests = util.hashfile_multi(dest,("sha256",))
+                    sha256 = self._cached_digests(cachefile)["sha256"]
+                    if digests["sha256"] == sha256:
+                        continue
+            print "MIRRORING", nm
+            shutil.copyfile(cachefile,dest + ".tmp")
+            os.rename(dest + ".tmp",dest)
+
+    def _check_digests(self,cachefile,md5=None,sha256=None):
+        """Check a cached file against the expected digests, if any.
+
+        Returns the name of the first mismatched digest, or None if the
+        file is OK.
+        """
+        if md5 is None and sha256 is None:
+            return None
+        digests = self._cached_digests(cachefile)
+        if md5 is not None and md5 != digests["md5"]:
+            return "md5"
+        if sha256 is not None and sha256 != digests["sha256"]:
+            return "sha256"
+        return None
+
+    def _cached_digests(self,cachefile):
+        """Get the md5 and sha256 digests of a file in the download cache.
+
+        These are stored along with the file's size, mtime and inode in a
+        sidecar file named cachefile + ".meta", and only recalculated when
+        the file no longer matches those.
+        """
+        st = os.stat(cachefile)
+        stinfo = {"size":st.st_size,"mtime":st.st_mtime,"ino":st.st_ino}
+        metafile = cachefile + ".meta"
+        try:
+            with open(metafile,"rb") as f:
+                meta = json.load(f)
+        except (EnvironmentError,ValueError):
+            meta = {}
+        if all(meta.get(k) == v for (k,v) in stinfo.iteritems()):
+            if "md5" in meta and "sha256" in meta:
+                return meta
+        meta = util.hashfile_multi(cachefile,("md5","sha256",))
+        meta.update(stinfo)
+        with open(metafile + ".tmp","wb") as f:
+            json.dump(meta,f)
+        os.rename(metafile + ".tmp",metafile)
+        return meta
 
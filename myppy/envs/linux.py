@@ -6,7 +6,11 @@ from __future__ import with_statement
 import os
 import stat
 
+from multiprocessing.pool import ThreadPool
+
+from myppy import elf
 from myppy.envs import base
+from myppy.jobserver import default_size
 
 from myppy.recipes import linux as _linux_recipes
 
@@ -16,6 +20,20 @@ class MyppyEnv(base.MyppyEnv):
     DEPENDENCIES = ["bin_lsbsdk","patchelf"]
     DEPENDENCIES.extend(base.MyppyEnv.DEPENDENCIES)
 
+    #  Extra linker flags for each MYPPY_LINK_PROFILE.  The "startup"
+    #  profiles cut the time spent in the dynamic loader: unneeded libs
+    #  are dropped, and symbol lookup uses GNU-style hash tables.  The old
+    #  SysV tables are kept as well, since loaders before glibc 2.5 can't
+    #  read the GNU ones.  Function symbols are bound lazily, or all at
+    #  once at startup with "startup-now".
+    LINK_PROFILES = {
+        "default": "",
+        "startup": "-Wl,-O1 -Wl,--as-needed -Wl,--hash-style=both"
+                   " -Wl,-z,lazy",
+        "startup-now": "-Wl,-O1 -Wl,--as-needed -Wl,--hash-style=both"
+                       " -Wl,-z,now",
+    }
+
     @property
     def _arch_switch(self):
         """Return cli option for the compiler to compile 32bit or 64bit app."""
@@ -42,6 +60,7 @@ class MyppyEnv(base.MyppyEnv):
         #  to choose the dynamic linker at runtime. This trades
         #  lsb-compatability for ability to run out-of-the-box on more linuxen.
         flags = self._arch_switch + ' --lsb-besteffort ' + ' '
+        flags += self.LINK_PROFILES[self.link_profile] + ' '
         # Some recipes require this -L/libdir ldflag.
         for libdir in ('lib', ):
             flags += ' -L' + os.path.join(self.PREFIX, libdir)
@@ -72,6 +91,11 @@ class MyppyEnv(base.MyppyEnv):
                          os.path.join(self.PREFIX, self._lsb_libdir, 'pkgconfig'),))
 
     def __init__(self,rootdir, architecture):
+        self.link_profile = os.environ.get("MYPPY_LINK_PROFILE","default")
+        if self.link_profile not in self.LINK_PROFILES:
+            msg = "unknown MYPPY_LINK_PROFILE %r, expected one of: %s"
+            profiles = ", ".join(sorted(self.LINK_PROFILES))
+            raise ValueError(msg % (self.link_profile,profiles,))
         super(MyppyEnv,self).__init__(rootdir, architecture)
         if not os.path.exists(os.path.join(self.PREFIX,"lib")):
             os.makedirs(os.path.join(self.PREFIX,"lib"))
@@ -100,62 +124,158 @@ class MyppyEnv(base.MyppyEnv):
         self.env["LSBCC_SHAREDLIBS"] = "bz2:crypto:ncurses:ncursesw:python:python2.7:readline:ssl"
         # For debugging lsbcc options.
         #self.env["LSBCC_VERBOSE"] = '0x0040'
+        #  Debug info stripped from binaries can be kept for debugging.
+        self.debug_store = os.environ.get("MYPPY_DEBUG_STORE")
+        if self.debug_store:
+            self.debug_store = os.path.abspath(self.debug_store)
 
-    def record_files(self,recipe,files):
-        if recipe not in ("bin_lsbsdk",):
-            for fpath in files:
-                fpath = os.path.join(self.rootdir,fpath)
-                fnm = os.path.basename(fpath)
-                if fpath == os.path.realpath(fpath):
-                    if fnm.endswith(".so") or ".so." in fnm:
-                        self._check_glibc_symbols(fpath)
-                        if recipe not in ("python27",):
-                            self._strip(fpath)
-                        self._adjust_rpath(fpath)
-                    elif "." not in fnm or os.access(fpath, os.X_OK):
-                        fileinfo = self.bt("file",fpath)
-                        if "executable" in fileinfo and "ELF" in fileinfo:
-                            if recipe not in ("python27",):
-                                self._strip(fpath)
-                            self._adjust_rpath(fpath)
-        super(MyppyEnv,self).record_files(recipe,files)
-
-    def _strip(self,fpath):
-        mod = os.stat(fpath).st_mode
-        os.chmod(fpath,stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
-        self.do("strip",fpath)
-        os.chmod(fpath,mod)
+    def process_files(self,recipe,files):
+        """Strip, check and adjust the rpath of installed ELF binaries.
+
+        The work is spread over a thread pool, since most of it is done in
+        subprocesses.  Files are only stripped if they have something to
+        strip, and then in a few batches rather than one at a time.  Files
+        needing too-new symbol versions are all reported together once
+        every file is done.
+        """
+        if recipe in ("bin_lsbsdk",):
+            return
+        tasks = []
+        for fpath in files:
+            fpath = os.path.join(self.rootdir,fpath)
+            fnm = os.path.basename(fpath)
+            if fpath == os.path.realpath(fpath):
+                if fnm.endswith(".so") or ".so." in fnm:
+                    tasks.append((fpath,True))
+                elif "." not in fnm or os.access(fpath, os.X_OK):
+                    if elf.classify(fpath) == "executable":
+                        tasks.append((fpath,False))
+        def check(task):
+            (fpath,is_lib) = task
+            (errors,versions) = ([],[])
+            if is_lib:
+                (errors,versions) = self._check_glibc_symbols(fpath)
+            with elf.ElfFile(fpath) as f:
+                return (errors,versions,f.has_symbols)
+        nthreads = default_size()
+        pool = ThreadPool(nthreads)
+        try:
+            results = pool.map(check,tasks)
+            if recipe not in ("python27",):
+                tostrip = [fpath for ((fpath,_),(_,_,has_symbols))
+                           in zip(tasks,results) if has_symbols]
+                pool.map(self._strip_files,_batches(tostrip,nthreads))
+            #  patchelf and whatever it needs are installed before patchelf
+            #  itself is available, so they can get by without it.
+            bootstrap = (recipe in self.graph.build_closure(["patchelf"]))
+            def adjust_rpath(fpath):
+                self._adjust_rpath(fpath,need_patchelf=not bootstrap)
+            pool.map(adjust_rpath,[fpath for (fpath,_) in tasks])
+        finally:
+            pool.close()
+            pool.join()
+        #  The checks run side-by-side, so summarise them once at the end.
+        versions = [ver for (_,vers,_) in results for ver in vers]
+        for prefix in ("GLIBC_","GLIBCXX_",):
+            maxver = elf.max_version(versions,prefix)
+            if maxver is not None:
+                maxver = prefix + ".".join(map(str,maxver))
+                print "HIGHEST VERSION NEEDED BY", recipe, maxver
+        errors = [err for (errs,_,_) in results for err in errs]
+        if errors:
+            msg = "%d symbol version errors in %s:\n" % (len(errors),recipe,)
+            raise RuntimeError(msg + "\n".join(errors))
+
+    def _strip_files(self,fpaths):
+        """Strip the given files, using a single strip command.
+
+        If MYPPY_DEBUG_STORE is set, the debug info from each file is first
+        saved under that directory, at the file's full path plus ".debug".
+        That's where gdb will find it when the store is set as its
+        debug-file-directory.
+        """
+        modes = {}
+        for fpath in fpaths:
+            print "STRIPPING", fpath
+            modes[fpath] = os.stat(fpath).st_mode
+            os.chmod(fpath,stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+        try:
+            debugfiles = []
+            if self.debug_store:
+                for fpath in fpaths:
+                    debugfile = self.debug_store + fpath + ".debug"
+                    if not os.path.isdir(os.path.dirname(debugfile)):
+                        os.makedirs(os.path.dirname(debugfile))
+                    self.do("objcopy","--only-keep-debug",fpath,debugfile)
+                    debugfiles.append((fpath,debugfile))
+            self.do("strip",*fpaths)
+            for (fpath,debugfile) in debugfiles:
+                self.do("objcopy","--add-gnu-debuglink=" + debugfile,fpath)
+        finally:
+            for (fpath,mod) in modes.iteritems():
+                os.chmod(fpath,mod)
 
     def _check_glibc_symbols(self,fpath):
+        """Check for symbol versions too new to be portable.
+
+        Returns a list of errors, and the list of symbol versions needed.
+        """
         print "VERIFYING GLIBC SYMBOLS", fpath
+        with elf.ElfFile(fpath) as f:
+            needs = f.version_needs()
         errors = []
-        for ln in self.bt("objdump","-T",fpath).split("\n"):
-            for field in ln.split():
-                if field.startswith("GLIBC_"):
-                    ver = field.split("_",1)[1].split(".")
-                    ver = map(int,ver)
-                    if ver >= [2,4,]:
-                        errors.append(ln.strip())
-                elif field.startswith("GLIBCXX_"):
-                    ver = field.split("_",1)[1].split(".")
-                    ver = map(int,ver)
-                    if ver > [3,4,7]:
-                        errors.append(ln.strip())
-        assert not errors, "\n".join(errors)
-
-    def _adjust_rpath(self,fpath):
-        #  patchelf might not be installed if we're just initialising the env.
-        if os.path.exists(os.path.join(self.PREFIX,"bin","patchelf")):
-            print "ADJUSTING RPATH", fpath
-            backrefs = []
-            froot = os.path.dirname(fpath)
-            while froot != self.PREFIX:
-                backrefs.append("..")
-                froot = os.path.dirname(froot)
-            rpath = "/".join(backrefs) + "/lib"
-            rpath = "${ORIGIN}:${ORIGIN}/" + rpath
-            self.do("patchelf","--set-rpath",rpath,fpath)
+        for (lib,ver) in needs:
+            glibc = elf.max_version([ver],"GLIBC_")
+            glibcxx = elf.max_version([ver],"GLIBCXX_")
+            if glibc is not None and glibc >= (2,4,):
+                errors.append("%s needs %s from %s" % (fpath,ver,lib,))
+            elif glibcxx is not None and glibcxx > (3,4,7):
+                errors.append("%s needs %s from %s" % (fpath,ver,lib,))
+        return (errors,[ver for (_,ver) in needs])
+
+    def _adjust_rpath(self,fpath,need_patchelf=True):
+        """Point the rpath of the given file at the env's lib directory.
+
+        This is done in place if the existing rpath has room for it, and
+        with patchelf otherwise.  If patchelf isn't installed, that's an
+        error unless need_patchelf is false.
+        """
+        backrefs = []
+        froot = os.path.dirname(fpath)
+        while froot != self.PREFIX:
+            backrefs.append("..")
+            froot = os.path.dirname(froot)
+        rpath = "/".join(backrefs) + "/lib"
+        rpath = "${ORIGIN}:${ORIGIN}/" + rpath
+        with elf.ElfFile(fpath) as f:
+            current = [p for p in (f.rpath,f.runpath) if p is not None]
+        if current and all(p == rpath for p in current):
+            return
+        mod = os.stat(fpath).st_mode
+        os.chmod(fpath,mod | stat.S_IWUSR)
+        try:
+            with elf.ElfFile(fpath,writable=True) as f:
+                if f.set_rpath(rpath):
+                    print "ADJUSTED RPATH IN PLACE", fpath
+                    return
+            if os.path.exists(os.path.join(self.PREFIX,"bin","patchelf")):
+                print "ADJUSTING RPATH", fpath
+                self.do("patchelf","--set-rpath",rpath,fpath)
+            elif need_patchelf:
+                msg = "can't adjust rpath of %s without patchelf" % (fpath,)
+                raise RuntimeError(msg)
+            else:
+                print "NO ROOM TO ADJUST RPATH WITHOUT PATCHELF", fpath
+        finally:
+            os.chmod(fpath,mod)
 
     def load_recipe(self,recipe):
         return self._load_recipe_subclass(recipe,MyppyEnv,_linux_recipes)
 
+
+def _batches(items,nbatches,maxsize=200):
+    """Split a list into about nbatches lists of at most maxsize items."""
+    if not items:
+        return []
+    size = min(maxsize,-(-len(items) // nbatches))
+    return [items[i:i+size] for i in xrange(0,len(items),size)]
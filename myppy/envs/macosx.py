@@ -117,7 +117,7 @@ class MyppyEnv(base.MyppyEnv):
     def load_recipe(self,recipe):
         return self._load_recipe_subclass(recipe,MyppyEnv,_macosx_recipes)
 
-    def record_files(self,recipe,files):
+    def process_files(self,recipe,files):
         #  Fix up linker paths for portability.
         #  Also guard against bad complication, e.g. linking with
         #  the wrong SDK or for the wrong archs.
@@ -143,7 +143,6 @@ class MyppyEnv(base.MyppyEnv):
                             self._adjust_dynamic_lib(recipe,fpath)
                         elif "executable" in fdesc:
                             self._adjust_executable(recipe,fpath)
-        super(MyppyEnv,self).record_files(recipe,files)
 
     def _adjust_static_lib(self,recipe,fpath):
         self._check_lib_has_all_archs(fpath)
@@ -0,0 +1,103 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.graph:  memoized dependency graph of myppy recipes
+
+"""
+
+
+class RecipeGraph(object):
+    """The dependency graph between recipes, loaded on demand.
+
+    Recipe classes don't change while myppy is running, so each recipe is
+    loaded at most once to find its edges.  Runtime dependencies (those in
+    DEPENDENCIES) are kept separately from build-time ones, since only the
+    former are needed once a recipe has been installed.  Reverse edges are
+    maintained for every recipe that has been loaded, and closures over
+    runtime dependencies are memoized.
+    """
+
+    def __init__(self,load_recipe):
+        self.load_recipe = load_recipe
+        self._deps = {}
+        self._build_deps = {}
+        self._rdeps = {}
+        self._closures = {}
+
+    def _load(self,recipe):
+        if recipe in self._deps:
+            return
+        r = self.load_recipe(recipe)
+        deps = [dep for dep in r.DEPENDENCIES if dep != recipe]
+        build_deps = [dep for dep in r.DEPENDENCIES + r.BUILD_DEPENDENCIES
+                      if dep != recipe]
+        self._deps[recipe] = deps
+        self._build_deps[recipe] = build_deps
+        self._rdeps.setdefault(recipe,set())
+        for dep in deps:
+            self._rdeps.setdefault(dep,set()).add(recipe)
+
+    def dependencies(self,recipe):
+        """Get the direct runtime dependencies of the given recipe."""
+        self._load(recipe)
+        return self._deps[recipe]
+
+    def build_dependencies(self,recipe):
+        """Get everything that must be installed to build the given recipe."""
+        self._load(recipe)
+        return self._build_deps[recipe]
+
+    def closure(self,recipes):
+        """Get the given recipes plus everything they depend on at runtime."""
+        result = set()
+        for recipe in recipes:
+            if recipe not in result:
+                result.update(self._closure(recipe))
+        return result
+
+    def build_closure(self,recipes):
+        """Get the given recipes plus everything needed to build them."""
+        result = set(recipes)
+        todo = list(result)
+        while todo:
+            for dep in self.build_dependencies(todo.pop()):
+                if dep not in result:
+                    result.add(dep)
+                    todo.append(dep)
+        return result
+
+    def _closure(self,recipe):
+        try:
+            return self._closures[recipe]
+        except KeyError:
+            pass
+        closure = set([recipe])
+        todo = [recipe]
+        while todo:
+            for dep in self.dependencies(todo.pop()):
+                if dep not in closure:
+                    closure.add(dep)
+                    todo.append(dep)
+        closure = frozenset(closure)
+        self._closures[recipe] = closure
+        return closure
+
+    def dependents(self,recipe,among):
+        """Get the recipes that depend on the given one, directly or not.
+
+        Only recipes in the given collection are considered, and they are
+        loaded as needed to find their edges.  The result doesn't include
+        the given recipe itself.
+        """
+        for other in among:
+            self._load(other)
+        among = set(among)
+        result = set()
+        todo = [recipe]
+        while todo:
+            for rdep in self._rdeps.get(todo.pop(),()):
+                if rdep in among and rdep not in result and rdep != recipe:
+                    result.add(rdep)
+                    todo.append(rdep)
+        return result
@@ -0,0 +1,83 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.jobserver:  a GNU make jobserver shared by all builds in an env
+
+"""
+
+from __future__ import with_statement
+
+import os
+import errno
+import contextlib
+import multiprocessing
+
+
+def default_size():
+    """Get the default number of job slots, from env or the CPU count."""
+    size = os.environ.get("MYPPY_MAKE_JOBS")
+    if size:
+        return int(size)
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class JobServer(object):
+    """A GNU make jobserver, for bounding the total number of build jobs.
+
+    This is simply a pipe pre-loaded with one token per job slot.  Each
+    recipe build takes a token for as long as it's running, and any make
+    process that finds the pipe in MAKEFLAGS takes an extra token for each
+    additional job that it starts.  So the total number of jobs stays within
+    the limit no matter how many recipes are being built at once.
+
+    The pipe is inherited by all subprocesses, so it's enough to put the
+    MAKEFLAGS string into the environment of the build commands.
+    """
+
+    def __init__(self,size=None):
+        if size is None:
+            size = default_size()
+        self.size = max(1,size)
+        (self.rfd,self.wfd) = os.pipe()
+        os.write(self.wfd,"+" * self.size)
+
+    @property
+    def MAKEFLAGS(self):
+        #  Older versions of make only understand --jobserver-fds, newer
+        #  ones prefer --jobserver-auth.  Unknown options in MAKEFLAGS are
+        #  silently ignored, so we can give both.
+        fds = "%d,%d" % (self.rfd,self.wfd)
+        return "-j --jobserver-fds=%s --jobserver-auth=%s" % (fds,fds)
+
+    def acquire(self):
+        """Take a token from the jobserver, blocking until one is free."""
+        while True:
+            try:
+                token = os.read(self.rfd,1)
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+            else:
+                if token:
+                    return token
+
+    def release(self,token="+"):
+        """Return a token to the jobserver."""
+        os.write(self.wfd,token)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Context manager holding a single job slot."""
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
@@ -5,17 +5,21 @@ from __future__ import with_statement
 
 import os
 import sys
-import tempfile
+import json
+import inspect
+import hashlib
 import urlparse
 import urllib2
 import subprocess
 import shutil
 
 from textwrap import dedent
+from contextlib import contextmanager
 
 import myppy
+from myppy.unpack import extract_file, MemberFilter
 from myppy.util import md5file, do, bt, cd, relpath, tempdir, chstdin, \
-                       prune_dir
+                       prune_dir, PatchSession
 
 
 class _RecipeMetaclass(type):
@@ -54,6 +58,12 @@ class Recipe(object):
 
     SOURCE_URL = "http://source.url.is/missing.txt"
     SOURCE_MD5 = None
+    SOURCE_SHA256 = None
+    #  Patterns selecting which parts of the source tarball to extract,
+    #  relative to its top-level directory; see unpack.MemberFilter.
+    #  Use these to skip docs, examples and the like that aren't built.
+    SOURCE_INCLUDE = None
+    SOURCE_EXCLUDE = ()
 
     CONFIGURE_DIR = "."
     CONFIGURE_SCRIPT = "./configure"
@@ -62,6 +72,23 @@ class Recipe(object):
 
     MAKE_VARS = ()
     MAKE_RELPATH = "."
+    #  Set this to False for recipes whose makefiles break under "make -j".
+    PARALLEL_MAKE = True
+    #  Set this to False for recipes whose output isn't determined by the
+    #  recipe itself, e.g. those that install the latest version from PyPI.
+    ARTIFACT_CACHEABLE = True
+    #  Set this to True for recipes whose install step honours DESTDIR, or
+    #  the variable named by DESTDIR_VAR.  They are installed into a staging
+    #  dir and then moved into place, so the env knows exactly which files
+    #  they installed without having to scan for them.  Nothing is moved
+    #  until the whole install step is done, so it mustn't try to use any
+    #  of the files it has just installed.
+    STAGED_INSTALL = False
+    DESTDIR_VAR = "DESTDIR"
+    #  Build phases that change the source tree in ways that can't safely
+    #  be repeated, such as patching.  If one of these must be redone, the
+    #  build starts again from a freshly unpacked tree.
+    FRESH_TREE_PHASES = ("patch",)
 
     @property
     def PREFIX(self):
@@ -73,27 +100,168 @@ class Recipe(object):
 
     def __init__(self,target):
         self.target = target
+        #  Set by the env while doing a staged install.
+        self.stagedir = None
+        #  Set while patches are being batched up by _patching().
+        self._patch_session = None
 
     def fetch(self):
         """Download any files necessary to build this recipe."""
-        self.target.fetch(self.SOURCE_URL,self.SOURCE_MD5)
+        self.target.fetch(self.SOURCE_URL,self.SOURCE_MD5,self.SOURCE_SHA256)
 
     def build(self):
         """Build all of the files for this recipe."""
-        self._unpack()
-        self._patch()
-        self._configure()
-        self._make()
+        self._run_phases(("unpack","patch","configure","make",))
 
     def install(self):
         """Install all of the files for this recipe."""
         self._generic_make(target="install")
 
+    def _fingerprint_inputs(self):
+        """Get a list of (name,value) pairs describing how this is built.
+
+        This includes the source code of the recipe class and each of its
+        bases, since that's where any patches live.
+        """
+        inputs = self._source_inputs()
+        inputs.extend(self._attr_inputs("SOURCE_URL","SOURCE_MD5",
+                                        "SOURCE_SHA256","SOURCE_INCLUDE",
+                                        "SOURCE_EXCLUDE","CONFIGURE_SCRIPT",
+                                        "CONFIGURE_DIR","CONFIGURE_ARGS",
+                                        "CONFIGURE_VARS","MAKE_VARS",
+                                        "MAKE_RELPATH",))
+        return inputs
+
+    def _source_inputs(self):
+        """Get the source code of the recipe class and each of its bases."""
+        inputs = []
+        for cls in type(self).__mro__:
+            if isinstance(cls,_RecipeMetaclass):
+                try:
+                    src = inspect.getsource(cls)
+                except (IOError,TypeError):
+                    src = None
+                inputs.append(("%s.%s" % (cls.__module__,cls.__name__),src))
+        return inputs
+
+    def _attr_inputs(self,*names):
+        """Get (name,value) pairs for the named attributes of the recipe."""
+        inputs = []
+        for nm in names:
+            try:
+                value = getattr(self,nm)
+            except Exception, e:
+                #  Some values can't be calculated until the build starts.
+                value = "<%s>" % (e.__class__.__name__,)
+            inputs.append((nm,value))
+        return inputs
+
+    def _phase_inputs(self,phase):
+        """Get a list of (name,value) pairs describing a phase of build()."""
+        if phase == "unpack":
+            return self._attr_inputs("SOURCE_URL","SOURCE_MD5",
+                                     "SOURCE_SHA256","SOURCE_INCLUDE",
+                                     "SOURCE_EXCLUDE",)
+        if phase == "patch":
+            return self._source_inputs()
+        if phase == "configure":
+            inputs = self._attr_inputs("CONFIGURE_SCRIPT","CONFIGURE_DIR",
+                                       "CONFIGURE_ARGS","CONFIGURE_VARS",)
+            for nm in ("PREFIX","ARCH","CC","CXX","CFLAGS","CXXFLAGS",
+                       "LDFLAGS","MACOSX_DEPLOYMENT_TARGET",):
+                inputs.append((nm,getattr(self.target,nm,None)))
+            recipe = self.__class__.__name__
+            for dep in self.target.graph.build_dependencies(recipe):
+                inputs.append(("dep:" + dep,self.target.recipe_fingerprint(dep)))
+            return inputs
+        if phase == "make":
+            return self._attr_inputs("MAKE_VARS","MAKE_RELPATH",
+                                     "PARALLEL_MAKE",)
+        return []
+
+    def _run_phases(self,phases):
+        """Run the named phases of the build, skipping any that are done.
+
+        Each phase is stamped with a hash of its inputs, chained with those
+        of the phases before it, once it completes.  When a build is tried
+        again, phases whose stamps still match are skipped, so e.g. a failed
+        make can continue where it left off.  The stamps are kept beside the
+        build dir, and belong to whichever recipe used that dir last.  They
+        are ignored if the build dir itself has since been removed.
+        """
+        updir = self._get_updir()
+        stampfile = updir + ".myppy-stamps"
+        recipe = self.__class__.__name__
+        try:
+            with open(stampfile,"rb") as f:
+                info = json.load(f)
+        except (EnvironmentError,ValueError):
+            info = {}
+        if not os.path.isdir(updir):
+            info = {}
+        if info.get("recipe") != recipe:
+            info = {"recipe":recipe,"stamps":{}}
+        stamps = info["stamps"]
+        #  Find the first phase that needs to be run again.
+        done = []
+        stamp = ""
+        for phase in phases:
+            stamp = self._phase_stamp(stamp,phase)
+            if stamps.get(phase) != stamp:
+                if phase in self.FRESH_TREE_PHASES:
+                    done = []
+                break
+            done.append(stamp)
+        for phase in phases[len(done):]:
+            stamps.pop(phase,None)
+        self._save_stamps(stampfile,info)
+        for phase in phases[:len(done)]:
+            print "ALREADY DONE", phase, recipe
+        stamp = done[-1] if done else ""
+        for phase in phases[len(done):]:
+            stamp = self._phase_stamp(stamp,phase)
+            getattr(self,"_phase_" + phase)()
+            stamps[phase] = stamp
+            self._save_stamps(stampfile,info)
+
+    def _phase_stamp(self,prev,phase):
+        inputs = repr(self._phase_inputs(phase))
+        return hashlib.sha1(prev + phase + inputs).hexdigest()
+
+    def _save_stamps(self,stampfile,info):
+        if not os.path.isdir(os.path.dirname(stampfile)):
+            os.makedirs(os.path.dirname(stampfile))
+        with open(stampfile + ".tmp","wb") as f:
+            json.dump(info,f)
+        os.rename(stampfile + ".tmp",stampfile)
+
+    def _phase_unpack(self):
+        self._unpack()
+
+    def _phase_patch(self):
+        with self._patching():
+            self._patch()
+
+    def _phase_configure(self):
+        self._configure()
+
+    def _phase_make(self):
+        self._make()
+
+    def _get_updir(self):
+        """Get the directory into which the source tarball is unpacked.
+
+        This is always <builddir>/<sourcefilename>/
+        """
+        src = self.target.cache_path(self.SOURCE_URL)
+        return os.path.join(self.target.builddir,os.path.basename(src))
+
     def _unpack(self):
-        """Do a generic "tar -x" on the downloaded source tarball."""
-        src = self.target.fetch(self.SOURCE_URL)
-        updir = os.path.join(self.target.builddir,os.path.basename(src))
-        return self._unpack_tarball(src,updir)
+        """Fetch and extract the source tarball, streaming if possible."""
+        updir = self._get_updir()
+        select = MemberFilter(self.SOURCE_INCLUDE,self.SOURCE_EXCLUDE)
+        return self.target.unpack(self.SOURCE_URL,updir,self.SOURCE_MD5,
+                                  self.SOURCE_SHA256,select)
 
     def _patch(self):
         pass
@@ -108,15 +276,7 @@ class Recipe(object):
         """Unpack the given tarball into the specified workdir."""
         if not os.path.isdir(workdir):
             os.makedirs(workdir)
-        if src.endswith(".bz2"):
-            cmd = ["tar","-xjf", src, "-C", workdir]
-        elif src.endswith(".gz") or src.endswith(".tgz"):
-            cmd = ["tar","-xzf", src, "-C", workdir]
-        elif src.endswith(".zip"):
-            cmd = ["unzip", src, "-d", workdir]
-        else:
-            cmd = ["tar","-xf", "-C", workdir]
-        self.target.do(*cmd)
+        extract_file(src,workdir)
         return os.path.join(workdir,os.listdir(workdir)[0])
 
     def _generic_configure(self,script=None,vars=None,args=None,env={}):
@@ -150,22 +310,38 @@ class Recipe(object):
         if relpath is None:
             relpath = self.MAKE_RELPATH
         cmd = ["make"]
-        # Parallel execution of compilation.
-        cmd.append('-j3')
+        # Parallel execution is controlled by the env's jobserver.
+        if not self.PARALLEL_MAKE:
+            env = self._serial_make(cmd,env)
         if vars is not None:
             cmd.extend(vars)
         if makefile is not None:
             cmd.extend(("-f",makefile))
         cmd.extend(("-C",os.path.join(workdir,relpath)))
+        if self.stagedir is not None:
+            cmd.append("%s=%s" % (self.DESTDIR_VAR,self.stagedir,))
         if target is not None:
             cmd.append(target)
         self.target.do(*cmd,env=env)
 
+    def _serial_make(self,cmd,env):
+        """Force the given make command to run only a single job.
+
+        This adds "-j1" to the command and returns a copy of the given env
+        with the jobserver removed from MAKEFLAGS.
+        """
+        cmd.append("-j1")
+        env = env.copy()
+        env["MAKEFLAGS"] = ""
+        return env
+
     def _generic_pyinstall(self,relpath="",args=[],env={}):
         """Do a generic "python setup.py install" for this recipe."""
         workdir = self._get_builddir()
         cmd = [self.target.PYTHON_EXECUTABLE,"setup.py","install"]
         cmd.extend(args)
+        if self.stagedir is not None:
+            cmd.append("--root=" + self.stagedir)
         with cd(os.path.join(workdir,relpath)):
             self.target.do(*cmd,env=env)
 
@@ -179,19 +355,35 @@ class Recipe(object):
         return os.path.join(workdir,os.listdir(workdir)[0])
 
     def _patch_file(self,fpath,filter):
-        """Apply a linewise patch function to the specified file."""
+        """Apply a linewise patch function to the specified file.
+
+        Inside a _patching() block the patch is queued, to be applied
+        along with any others for the same file at the end of the block.
+        """
         if not os.path.isabs(fpath):
             fpath = os.path.join(self.PREFIX,fpath)
-        mod = os.stat(fpath).st_mode
-        (fd,tf) = tempfile.mkstemp()
-        os.close(fd)
-        with open(tf,"wt") as fOut:
-            with open(fpath,"rt") as fIn:
-                for ln in filter(fIn):
-                    fOut.write(ln)
-            fOut.flush()
-        do("mv","-f",tf,fpath)
-        os.chmod(fpath,mod)
+        if self._patch_session is not None:
+            self._patch_session.add(fpath,filter)
+        else:
+            with PatchSession() as session:
+                session.add(fpath,filter)
+
+    @contextmanager
+    def _patching(self):
+        """Context manager batching up all patches made within it.
+
+        Each patched file is read and rewritten just once, when the
+        outermost block exits successfully.
+        """
+        if self._patch_session is not None:
+            yield
+        else:
+            self._patch_session = PatchSession()
+            try:
+                yield
+                self._patch_session.apply()
+            finally:
+                self._patch_session = None
 
     def _patch_build_file(self,relpath,filter):
         """Apply a linewise patch function to specified file in build dir."""
@@ -203,8 +395,7 @@ class PyRecipe(Recipe):
     DEPENDENCIES = ["python27"]
     def build(self):
         """Build all of the files for this recipe."""
-        self._unpack()
-        self._patch()
+        self._run_phases(("unpack","patch",))
     def install(self):
         """Install all of the files for this recipe."""
         self._generic_pyinstall()
@@ -216,17 +407,23 @@ class PipPyRecipe(PyRecipe):
     """
     DEPENDENCIES = ["py_pip","py_setuptools"]
     PYPI_PKG = ""
+    ARTIFACT_CACHEABLE = False
+    STAGED_INSTALL = True
     def fetch(self):
         pass
     def build(self):
         pass
     def install(self):
         self.target.do("env")
-        self.target.do("pip","install",self.PYPI_PKG)
+        cmd = ["pip","install",self.PYPI_PKG]
+        if self.stagedir is not None:
+            cmd.extend(("--root",self.stagedir))
+        self.target.do(*cmd)
 
 
 class CMakeRecipe(Recipe):
     BUILD_DEPENDENCIES = ["cmake"]
+    STAGED_INSTALL = True
     def _configure(self):
         self._generic_cmake()
     def _generic_cmake(self,relpath=".",args=[],env={}):
@@ -240,7 +437,8 @@ class CMakeRecipe(Recipe):
             cmd.append(arg)
         # Do an out-of-source build, required by some recipes.
         builddir = os.path.join(self._get_builddir(), "MYPPY-BUILD")
-        os.makedirs(builddir)
+        if not os.path.isdir(builddir):
+            os.makedirs(builddir)
         cmd.append("..")
         with cd(builddir):
             self.target.do(*cmd,env=env)
@@ -261,6 +459,7 @@ class PyCMakeRecipe(CMakeRecipe):
 
 class cmake(Recipe):
     SOURCE_URL = "http://www.cmake.org/files/v2.8/cmake-2.8.10.tar.gz"
+    STAGED_INSTALL = True
     CONFIGURE_VARS = None
     MAKE_VARS = ["VERBOSE=1"]
 
@@ -269,6 +468,9 @@ class python27(Recipe):
     DEPENDENCIES = ["lib_zlib","lib_readline","lib_sqlite3","lib_bz2"]
     SOURCE_URL = "http://www.python.org/ftp/python/2.7.3/Python-2.7.3.tgz"
     CONFIGURE_ARGS = ("--enable-shared", "--disable-static")
+    STAGED_INSTALL = True
+    #  The configure phase also patches some source files.
+    FRESH_TREE_PHASES = ("patch","configure",)
     def _patch(self):
         #  Add some builtin modules:
         #    * fcntl  (handy for use with esky)
@@ -299,7 +501,8 @@ class python27(Recipe):
 
     def _configure(self):
         super(python27,self)._configure()
-        self._post_config_patch()
+        with self._patching():
+            self._post_config_patch()
 
     def _post_config_patch(self):
         #  Patch the zipimport module to accept zipfiles with comments.
@@ -410,12 +613,14 @@ class lib_bz2(Recipe):
 class lib_readline(Recipe):
     SOURCE_URL = "ftp://ftp.gnu.org/gnu/readline/readline-6.2.tar.gz"
     SOURCE_MD5 = "67948acb2ca081f23359d0256e9a271c"
+    STAGED_INSTALL = True
     CONFIGURE_ARGS = ("--disable-shared","--enable-static",)
 
 
 class lib_zlib(Recipe):
     SOURCE_URL = "http://zlib.net/zlib-1.2.7.tar.gz"
     SOURCE_MD5 = "60df6a37c56e7c1366cca812414f7b85"
+    STAGED_INSTALL = True
     CONFIGURE_ARGS = ("--static",)
     CONFIGURE_VARS = None
     def _configure(self):
@@ -429,14 +634,17 @@ class lib_zlib(Recipe):
 
 class lib_png(Recipe):
     SOURCE_URL = "http://downloads.sourceforge.net/project/libpng/libpng15/1.5.13/libpng-1.5.13.tar.gz"
+    STAGED_INSTALL = True
 
 
 class lib_jpeg(Recipe):
     SOURCE_URL = "http://www.ijg.org/files/jpegsrc.v8c.tar.gz"
+    STAGED_INSTALL = True
 
 
 class lib_tiff(Recipe):
     SOURCE_URL = "ftp://ftp.remotesensing.org/pub/libtiff/tiff-3.9.4.tar.gz"
+    STAGED_INSTALL = True
 
 
 class lib_openssl(Recipe):
@@ -454,6 +662,9 @@ class lib_openssl(Recipe):
             '-DOPENSSL_NO_DSO', '-I%s' % os.path.join(self.PREFIX, 'include'),
             '-L%s' % os.path.join(self.PREFIX, 'lib')]
     CONFIGURE_VARS = None
+    PARALLEL_MAKE = False
+    STAGED_INSTALL = True
+    DESTDIR_VAR = "INSTALL_PREFIX"
     def _patch(self):
         super(lib_openssl,self)._patch()
         def make_Configure_executable(lines):
@@ -496,6 +707,7 @@ class lib_openssl(Recipe):
 class lib_sqlite3(Recipe):
     SOURCE_URL = "http://www.sqlite.org/sqlite-autoconf-3071201.tar.gz"
     SOURCE_MD5 = 'eb7bbd258913518ad30971ea7ecb0ca9'
+    STAGED_INSTALL = True
     CONFIGURE_ARGS = ('--enable-static', '--enable-shared',
         '--disable-readline', '--disable-dynamic-extensions',
     )
@@ -508,6 +720,7 @@ class py_setuptools(PyRecipe):
 
 class py_pip(PyRecipe):
     DEPENDENCIES = ["py_setuptools"]
+    ARTIFACT_CACHEABLE = False
     def fetch(self):
         pass
     def build(self):
@@ -517,6 +730,8 @@ class py_pip(PyRecipe):
 
 
 class py_myppy(Recipe):
+    #  This installs whatever version of myppy is currently running.
+    ARTIFACT_CACHEABLE = False
     def fetch(self):
         pass
     def build(self):
@@ -541,8 +756,15 @@ class py_myppy(Recipe):
 
 
 
+#  Parts of the wxPython source tarball that none of its recipes build.
+_WX_SOURCE_EXCLUDE = ("docs","samples","demos","wxPython/demo",
+                      "wxPython/samples","wxPython/docs",)
+
+
 class lib_wxwidgets_base(Recipe):
     SOURCE_URL = "http://downloads.sourceforge.net/project/wxpython/wxPython/2.8.11.0/wxPython-src-2.8.11.0.tar.bz2"
+    SOURCE_EXCLUDE = _WX_SOURCE_EXCLUDE
+    STAGED_INSTALL = True
     CONFIGURE_ARGS = ("--with-opengl","--enable-unicode","--enable-optimize","--enable-debug_flag",)
     def _unpack(self):
         try:
@@ -586,8 +808,15 @@ class _lib_qt4_base(Recipe):
     SOURCE_URL = "http://get.qt.nokia.com/qt/source/qt-everywhere-opensource-src-4.7.4.tar.gz"
     #SOURCE_MD5 = "6f88d96507c84e9fea5bf3a71ebeb6d7"
     #SOURCE_URL = "http://get.qt.nokia.com/qt/source/qt-trunk.tar.gz"
+    #  Skip the parts that configure is told not to build, and the
+    #  mkspecs for embedded platforms.  Webkit isn't built either, but
+    #  the linux recipe still patches one of its headers.
+    SOURCE_EXCLUDE = ("examples","demos","doc/html","doc/qch",
+                      "mkspecs/qws","mkspecs/wince*","mkspecs/symbian*",)
     CONFIGURE_VARS = None
     DISABLE_FEATURES = []
+    STAGED_INSTALL = True
+    DESTDIR_VAR = "INSTALL_ROOT"
     @property
     def CFLAGS(self):
         flags = super(_lib_qt4_base,self).CFLAGS
@@ -655,6 +884,8 @@ class lib_qt4(_lib_qt4_base):
 class py_wxpython(PyRecipe):
     DEPENDENCIES = ["lib_wxwidgets"]
     SOURCE_URL = "http://downloads.sourceforge.net/project/wxpython/wxPython/2.8.11.0/wxPython-src-2.8.11.0.tar.bz2"
+    SOURCE_EXCLUDE = _WX_SOURCE_EXCLUDE
+    STAGED_INSTALL = True
     def install(self):
         self._generic_pyinstall(relpath="wxPython")
 
@@ -694,8 +925,7 @@ class py_pypy(Recipe):
     SOURCE_URL = "http://pypy.org/download/pypy-1.5-src.tar.bz2"
     SOURCE_MD5 = "cb9ada2c50666318c3a2863da1fbe487"
     def build(self):
-        self._unpack()
-        self._patch()
+        self._run_phases(("unpack","patch",))
     def install(self):
         workdir = self._get_builddir()
         for dirnm in ("py","lib-python","pypy",):
@@ -721,6 +951,7 @@ class lib_postgresql(Recipe):
     DEPENDENCIES = ["lib_openssl", "lib_zlib"]
     SOURCE_URL = "ftp://ftp.postgresql.org/pub/source/v9.1.4/postgresql-9.1.4.tar.gz"
     SOURCE_MD5 = "07c5e02e0b5e9b4c82a6d40443a3102f"
+    STAGED_INSTALL = True
     @property
     def CONFIGURE_ARGS(self):
         return ("--enable-shared","--enable-depend","--without-tcl","--without-perl",
@@ -758,12 +989,14 @@ class lib_mysql(Recipe):
 class lib_expat(Recipe):
     SOURCE_URL = "http://downloads.sourceforge.net/project/expat/expat/2.0.1/expat-2.0.1.tar.gz"
     SOURCE_MD5 = "ee8b492592568805593f81f8cdf2a04c"
+    STAGED_INSTALL = True
     CONFIGURE_ARGS = ["--enable-static", "--enable-shared"]
 
 
 class lib_openldap(Recipe):
     SOURCE_URL = "ftp://ftp.openldap.org/pub/OpenLDAP/openldap-release/openldap-2.4.31.tgz"
     SOURCE_MD5 = "804c6cb5698db30b75ad0ff1c25baefd"
+    STAGED_INSTALL = True
     CONFIGURE_ARGS = [
         '--disable-slapd', # Disable server libraries.
         '--disable-static',
@@ -862,11 +1095,16 @@ class py_p4python121(PyRecipe):
     def fetch(self):
         pass
 
+    @property
+    def workdir(self):
+        #  Computed rather than stored by build(), since install() may be
+        #  called on a different instance when building in parallel.
+        return os.path.join(self.target.builddir, 'p4python-2012.1.442152')
+
     def build(self):
         # fetch and upnpack source
         src = self.target.fetch(self.SOURCE_URL)
         self._unpack_tarball(src,self.target.builddir)
-        self.workdir = os.path.join(self.target.builddir, 'p4python-2012.1.442152')
         # fetch P4API
         src = self.target.fetch(self.P4API_URL)
         self._unpack_tarball(src,self.workdir)
@@ -78,12 +78,16 @@ class Recipe(base.Recipe):
         if relpath is None:
             relpath = self.MAKE_RELPATH
         cmd = ["make",]
+        if not self.PARALLEL_MAKE:
+            env = self._serial_make(cmd,env)
         if vars is not None:
             cmd.extend(["CC="+self.CC,"CXX="+self.CXX])
             cmd.extend(vars)
         if makefile is not None:
             cmd.extend(("-f",makefile))
         cmd.extend(("-C",os.path.join(workdir,relpath)))
+        if self.stagedir is not None:
+            cmd.append("%s=%s" % (self.DESTDIR_VAR,self.stagedir,))
         if target is not None:
             cmd.append(target)
         self.target.do(*cmd,env=env)
@@ -182,6 +186,15 @@ class python27(base.python27,Recipe,):
                     yield "        return '-L' + dir\n"
         self._patch_build_file("Lib/distutils/unixccompiler.py",
                                remove_runtime_library_support)
+        #  Calls between functions in libpython needn't go through the PLT,
+        #  which saves the loader a lot of work at startup.
+        if self.target.link_profile != "default":
+            def bind_functions_locally(lines):
+                for ln in lines:
+                    yield ln.replace("-Wl,-h$(INSTSONAME)",
+                                     "-Wl,-Bsymbolic-functions "
+                                     "-Wl,-h$(INSTSONAME)")
+            self._patch_build_file("Makefile",bind_functions_locally)
 
     def install(self):
         #  Hard-code distutils.util.get_platform() to return linux-i686
@@ -199,6 +212,7 @@ class python27(base.python27,Recipe,):
 class patchelf(Recipe):
     SOURCE_URL = "http://hydra.nixos.org/build/1524660/download/2/patchelf-0.6.tar.bz2"
     SOURCE_MD5 = "5087261514b4b5814a39c3d3a36eb6ef"
+    STAGED_INSTALL = True
 
 
 class lib_openssl(base.lib_openssl,Recipe):
@@ -219,6 +233,7 @@ class lib_openssl(base.lib_openssl,Recipe):
 class lib_ncurses(Recipe):
     SOURCE_URL = 'http://ftp.gnu.org/pub/gnu/ncurses/ncurses-5.9.tar.gz'
     SOURCE_MD5 = '8cb9c412e5f2d96bc6f459aa8c6282a1'
+    STAGED_INSTALL = True
     CONFIGURE_ARGS = [
         '--with-shared',
         '--enable-widec'
@@ -309,7 +324,8 @@ class lib_gtk(Recipe):
 class _lib_qt4_base(base._lib_qt4_base,Recipe):
     @property
     def DISABLE_FEATURES(self):
-        features = super(_lib_qt4_base,self).DISABLE_FEATURES
+        #  Copy the list, so we don't keep appending to the class attribute.
+        features = list(super(_lib_qt4_base,self).DISABLE_FEATURES)
         features.append("inotify")
         return features
     @property
@@ -95,12 +95,16 @@ class Recipe(base.Recipe):
         if relpath is None:
             relpath = self.MAKE_RELPATH
         cmd = ["make"]
+        if not self.PARALLEL_MAKE:
+            env = self._serial_make(cmd,env)
         if vars is not None:
             cmd.extend(["CC="+self.CC,"CXX="+self.CXX])
             cmd.extend(vars)
         if makefile is not None:
             cmd.extend(("-f",makefile))
         cmd.extend(("-C",os.path.join(workdir,relpath)))
+        if self.stagedir is not None:
+            cmd.append("%s=%s" % (self.DESTDIR_VAR,self.stagedir,))
         if target is not None:
             cmd.append(target)
         env = env.copy()
@@ -157,6 +161,12 @@ class NWayRecipe(Recipe):
         self._nway_make()
         self._nway_merge()
 
+    def install(self):
+        #  The build may have happened in a different process, so we can't
+        #  rely on _nway_make() having left TARGET_ARCH set for us.
+        self.TARGET_ARCH = self.LOCAL_ARCH
+        super(NWayRecipe,self).install()
+
     def _nway_configure(self,script=None,vars=None,args=None,env={}):
         """Do a "./configure" for each architecure in a separate dir."""
         workdir = self._get_builddir()
@@ -280,6 +290,8 @@ class PyRecipe(base.PyRecipe,Recipe):
 
 class python27(base.python27,Recipe):
     """Install the basic Python interpreter, with myppy support."""
+    #  The framework install hasn't been checked for DESTDIR support.
+    STAGED_INSTALL = False
 
     @property
     def CC(self):
@@ -385,6 +397,8 @@ class lib_bz2(base.lib_bz2,NWayRecipe):
 
 class _lib_qt4_base(base._lib_qt4_base,Recipe):
     DEPENDENCIES = ["lib_icu"]
+    #  install() copies extra files directly into the env.
+    STAGED_INSTALL = False
     @property
     def CONFIGURE_ARGS(self):
         args = list(super(_lib_qt4_base,self).CONFIGURE_ARGS)
@@ -0,0 +1,142 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.scheduler:  run a graph of dependent jobs on a bounded worker pool
+
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import errno
+import traceback
+
+
+class Scheduler(object):
+    """Run a graph of dependent jobs, several at a time.
+
+    The graph is given as a dict mapping each node to the set of nodes that
+    it must wait for.  Each job is split into two callbacks:  "work", which
+    does the expensive part of the job, and "finish", which runs in the
+    calling process once the work has succeeded.  A node only becomes ready
+    once the finish callback of each of its dependencies has completed.
+
+    With jobs > 1 the work callback runs in a forked child process, so that
+    it's free to chdir() and fiddle with sys.stdin without upsetting any of
+    its siblings.  Nodes that map to the same key under the optional keyfunc
+    (e.g. because they share a build directory) never have their work
+    running at the same time.  With jobs=1 everything runs inline.
+
+    Ready nodes are started in the order given by the "order" argument, so
+    a serial run visits nodes in exactly that order.
+    """
+
+    def __init__(self,deps,order=None,jobs=1,keyfunc=None):
+        self.deps = dict((node,set(ds)) for (node,ds) in deps.iteritems())
+        if order is None:
+            order = sorted(self.deps)
+        self.order = list(order)
+        self.jobs = max(1,jobs)
+        if keyfunc is None:
+            keyfunc = lambda node: node
+        self.keyfunc = keyfunc
+
+    def run(self,work,finish):
+        """Run all jobs in the graph, raising an error if any of them fail."""
+        if self.jobs == 1:
+            self._run_inline(work,finish)
+        else:
+            self._run_forked(work,finish)
+
+    def _next_ready(self,pending,done,busy=()):
+        for node in self.order:
+            if node not in pending:
+                continue
+            if self.keyfunc(node) in busy:
+                continue
+            for dep in self.deps[node]:
+                if dep in self.deps and dep not in done:
+                    break
+            else:
+                return node
+        return None
+
+    def _stuck(self,pending):
+        msg = "dependency cycle among: %s" % (", ".join(sorted(pending)),)
+        return RuntimeError(msg)
+
+    def _run_inline(self,work,finish):
+        pending = set(self.order)
+        done = set()
+        while pending:
+            node = self._next_ready(pending,done)
+            if node is None:
+                raise self._stuck(pending)
+            pending.remove(node)
+            work(node)
+            finish(node)
+            done.add(node)
+
+    def _run_forked(self,work,finish):
+        pending = set(self.order)
+        done = set()
+        running = {}
+        failed = []
+        exc_info = None
+        while running or (pending and not failed and exc_info is None):
+            while len(running) < self.jobs and not failed and not exc_info:
+                busy = set(self.keyfunc(n) for n in running.itervalues())
+                node = self._next_ready(pending,done,busy)
+                if node is None:
+                    break
+                pending.remove(node)
+                running[self._spawn(work,node)] = node
+            if not running:
+                raise self._stuck(pending)
+            (pid,status) = self._wait()
+            node = running.pop(pid,None)
+            if node is None:
+                continue
+            if status != 0:
+                failed.append(node)
+                continue
+            if exc_info is not None:
+                continue
+            try:
+                finish(node)
+            except Exception:
+                exc_info = sys.exc_info()
+            else:
+                done.add(node)
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if failed:
+            raise RuntimeError("failed to build: %s" % (", ".join(failed),))
+
+    def _spawn(self,work,node):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                work(node)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status)
+        return pid
+
+    def _wait(self):
+        while True:
+            try:
+                return os.waitpid(-1,0)
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
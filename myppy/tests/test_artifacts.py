@@ -0,0 +1,161 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+
+from __future__ import with_statement
+
+import os
+import stat
+import tarfile
+import unittest
+from StringIO import StringIO
+
+from myppy import util
+from myppy.artifacts import ArtifactCache, MANIFEST_NAME
+from myppy.envs.base import MyppyEnv
+from myppy.recipes.base import Recipe
+
+
+def make_files(rootdir):
+    """Create some installed files, returning them in store() form."""
+    os.makedirs(os.path.join(rootdir,"local","lib"))
+    os.makedirs(os.path.join(rootdir,"local","share","empty"))
+    with open(os.path.join(rootdir,"local","lib","libfoo.so.1"),"wb") as f:
+        f.write("libfoo")
+    os.chmod(os.path.join(rootdir,"local","lib","libfoo.so.1"),0755)
+    with open(os.path.join(rootdir,"local","lib","foo.txt"),"wb") as f:
+        f.write("readme")
+    os.chmod(os.path.join(rootdir,"local","lib","foo.txt"),0600)
+    os.symlink("libfoo.so.1",os.path.join(rootdir,"local","lib","libfoo.so"))
+    return ["local/lib/libfoo.so.1","local/lib/foo.txt","local/lib/libfoo.so",
+            "local/share/empty/"]
+
+
+def make_artifact(members):
+    """Make artifact bytes from a list of (name,type,data-or-linkname)."""
+    buf = StringIO()
+    tf = tarfile.open(fileobj=buf,mode="w:gz")
+    info = tarfile.TarInfo(MANIFEST_NAME)
+    tf.addfile(info,StringIO(""))
+    for (name,type,data) in members:
+        info = tarfile.TarInfo(name)
+        info.type = type
+        if type == tarfile.SYMTYPE:
+            info.linkname = data
+            tf.addfile(info)
+        else:
+            info.size = len(data)
+            tf.addfile(info,StringIO(data))
+    tf.close()
+    return buf.getvalue()
+
+
+class TestArtifactCache(unittest.TestCase):
+
+    def test_store_and_extract_round_trip(self):
+        with util.tempdir() as cachedir:
+            cache = ArtifactCache(cachedir)
+            with util.tempdir() as srcdir:
+                files = make_files(srcdir)
+                cache.store("key1",srcdir,files)
+            self.assertEquals(cache.open("missing"),None)
+            with util.tempdir() as dstdir:
+                extracted = cache.extract(cache.open("key1"),dstdir)
+                self.assertEquals(extracted,
+                                  [os.path.join(dstdir,f) for f in files])
+                libdir = os.path.join(dstdir,"local","lib")
+                with open(os.path.join(libdir,"libfoo.so.1")) as f:
+                    self.assertEquals(f.read(),"libfoo")
+                mode = os.stat(os.path.join(libdir,"libfoo.so.1")).st_mode
+                self.assertEquals(stat.S_IMODE(mode),0755)
+                mode = os.stat(os.path.join(libdir,"foo.txt")).st_mode
+                self.assertEquals(stat.S_IMODE(mode),0600)
+                self.assertEquals(os.readlink(os.path.join(libdir,
+                                                           "libfoo.so")),
+                                  "libfoo.so.1")
+                self.assertTrue(os.path.isdir(os.path.join(dstdir,"local",
+                                                           "share","empty")))
+                #  Extracting over existing files replaces them.
+                cache.extract(cache.open("key1"),dstdir)
+                self.assertEquals(os.readlink(os.path.join(libdir,
+                                                           "libfoo.so")),
+                                  "libfoo.so.1")
+
+    def test_least_recently_used_are_evicted(self):
+        with util.tempdir() as cachedir:
+            cache = ArtifactCache(cachedir,maxsize=1024*1024)
+            with util.tempdir() as srcdir:
+                files = make_files(srcdir)
+                for key in ("a","b","c"):
+                    cache.store(key,srcdir,files)
+            for (key,mtime) in (("a",3000),("b",1000),("c",2000)):
+                os.utime(os.path.join(cachedir,key + ".tar.gz"),(mtime,mtime))
+            #  Opening an artifact marks it as used.
+            cache.open("b").close()
+            sizes = dict((nm,os.path.getsize(os.path.join(cachedir,nm)))
+                         for nm in os.listdir(cachedir))
+            cache.maxsize = sizes["a.tar.gz"] + sizes["b.tar.gz"]
+            cache.evict()
+            self.assertEquals(sorted(os.listdir(cachedir)),
+                              ["a.tar.gz","b.tar.gz"])
+
+    def _extract_bytes(self,data,rootdir):
+        with util.tempdir() as cachedir:
+            with open(os.path.join(cachedir,"bad.tar.gz"),"wb") as f:
+                f.write(data)
+            cache = ArtifactCache(cachedir)
+            cache.extract(cache.open("bad"),rootdir)
+
+    def test_bad_members_are_rejected(self):
+        with util.tempdir() as outside:
+            with util.tempdir() as rootdir:
+                for members in ([("/abs",tarfile.REGTYPE,"x")],
+                                [("a/../../x",tarfile.REGTYPE,"x")],
+                                [("x",tarfile.SYMTYPE,outside),
+                                 ("x/passwd",tarfile.REGTYPE,"x")]):
+                    self.assertRaises(ValueError,self._extract_bytes,
+                                      make_artifact(members),rootdir)
+                self.assertEquals(os.listdir(outside),[])
+                #  Symlinks that stay inside the rootdir are fine.
+                os.mkdir(os.path.join(rootdir,"real"))
+                self._extract_bytes(make_artifact([
+                    ("link",tarfile.SYMTYPE,"real"),
+                    ("link/file",tarfile.REGTYPE,"x"),
+                ]),rootdir)
+                self.assertEquals(os.listdir(os.path.join(rootdir,"real")),
+                                  ["file"])
+
+
+class lib_cached(Recipe):
+    SOURCE_URL = "http://example.com/cached-1.0.tar.gz"
+    def fetch(self):
+        raise AssertionError("cached recipe was fetched")
+    def build(self):
+        raise AssertionError("cached recipe was built")
+
+
+class CachingEnv(MyppyEnv):
+    DEPENDENCIES = []
+    def load_recipe(self,recipe):
+        return {"lib_cached": lib_cached}[recipe](self)
+
+
+class TestRestore(unittest.TestCase):
+
+    def test_install_restores_cached_artifact(self):
+        with util.tempdir() as cachedir:
+            with util.tempdir() as rootdir:
+                env = CachingEnv(rootdir,"32bit")
+                env.artifacts = ArtifactCache(cachedir)
+                with util.tempdir() as srcdir:
+                    files = make_files(srcdir)
+                    env.artifacts.store(env.recipe_fingerprint("lib_cached"),
+                                        srcdir,files)
+                env.install_recipes(["lib_cached"])
+                self.assertTrue(env.is_installed("lib_cached"))
+                self.assertTrue(env.is_explicitly_installed("lib_cached"))
+                fpath = os.path.join(rootdir,"local","lib","libfoo.so.1")
+                with open(fpath) as f:
+                    self.assertEquals(f.read(),"libfoo")
+                self.assertEquals(env.stale_recipes(),set())
+                self.assertEquals(env.uninstall("lib_cached"),["lib_cached"])
+                self.assertFalse(os.path.exists(fpath))
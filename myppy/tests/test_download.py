@@ -0,0 +1,128 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+
+from __future__ import with_statement
+
+import os
+import re
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+
+from myppy import util
+from myppy.download import download
+
+
+DATA = "".join(chr(i % 251) for i in xrange(100000))
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve DATA at any path, honouring single byte-range requests.
+
+    If the server's "fail_after" attribute is set, the connection is cut
+    after sending that many bytes of a response.
+    """
+    def get_data(self):
+        return DATA
+    def do_GET(self):
+        self.server.requests.append(self.headers.get("Range"))
+        data = self.get_data()
+        (start,end) = (0,len(data) - 1)
+        m = re.match(r"bytes=(\d+)-(\d*)$",self.headers.get("Range") or "")
+        if m is not None and self.server.ranges:
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)),end)
+            if start > end:
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range","bytes %d-%d/%d"
+                                             % (start,end,len(data),))
+        else:
+            self.send_response(200)
+        body = data[start:end+1]
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        if self.server.fail_after is not None:
+            body = body[:self.server.fail_after]
+            self.server.fail_after = None
+        self.wfile.write(body)
+    def log_message(self,*args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1",0),RangeHandler)
+        self.server.requests = []
+        self.server.ranges = True
+        self.server.fail_after = None
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/data.tgz" % (self.server.server_port,)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def _read(self,path):
+        with open(path,"rb") as f:
+            return f.read()
+
+    def test_interrupted_download_is_resumed(self):
+        with util.tempdir() as workdir:
+            path = os.path.join(workdir,"data.tgz")
+            self.server.fail_after = 30000
+            self.assertRaises(IOError,download,self.url,path,1)
+            self.assertFalse(os.path.exists(path))
+            self.assertEquals(os.path.getsize(path + ".part"),30000)
+            download(self.url,path,1)
+            self.assertEquals(self._read(path),DATA)
+            self.assertFalse(os.path.exists(path + ".part"))
+            self.assertEquals(self.server.requests,[None,"bytes=30000-"])
+
+    def test_partial_file_from_another_url_is_discarded(self):
+        with util.tempdir() as workdir:
+            path = os.path.join(workdir,"data.tgz")
+            self.server.fail_after = 30000
+            self.assertRaises(IOError,download,self.url,path,1)
+            download(self.url + "?mirror=2",path,1)
+            self.assertEquals(self._read(path),DATA)
+            self.assertEquals(self.server.requests,[None,None])
+            self.assertEquals(os.listdir(workdir),["data.tgz"])
+
+    def test_partial_file_is_discarded_without_range_support(self):
+        with util.tempdir() as workdir:
+            path = os.path.join(workdir,"data.tgz")
+            with open(path + ".part","wb") as f:
+                f.write("garbage")
+            self.server.ranges = False
+            download(self.url,path,1)
+            self.assertEquals(self._read(path),DATA)
+
+    def test_segmented_download(self):
+        with util.tempdir() as workdir:
+            path = os.path.join(workdir,"data.tgz")
+            download(self.url,path,4,min_segment_size=1000)
+            self.assertEquals(self._read(path),DATA)
+            self.assertEquals(os.listdir(workdir),["data.tgz"])
+            self.assertEquals(sorted(self.server.requests[1:]),
+                              ["bytes=0-24999","bytes=25000-49999",
+                               "bytes=50000-74999","bytes=75000-99999"])
+
+    def test_segmented_download_falls_back_without_range_support(self):
+        with util.tempdir() as workdir:
+            path = os.path.join(workdir,"data.tgz")
+            self.server.ranges = False
+            download(self.url,path,4,min_segment_size=1000)
+            self.assertEquals(self._read(path),DATA)
@@ -0,0 +1,364 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+
+from __future__ import with_statement
+
+import os
+import struct
+import unittest
+
+from myppy import util
+from myppy import elf
+
+
+#  Everything is loaded at this address, to check address translation.
+BASE_VADDR = 0x8048000
+
+
+def make_elf(elfclass=elf.ELFCLASS64,byteorder="<",type=elf.ET_DYN,
+             interp=False,needed=(),rpath=None,runpath=None,verneed=(),
+             sections=None,symbols=(),merge_strings=False):
+    """Build the bytes of a minimal dynamically-linked ELF file.
+
+    The verneed argument is a list of (library,[versions]) pairs.  Each file
+    has a single PT_LOAD segment mapping the whole file.  If a list of
+    section names is given, there are also section headers with those
+    names, though they don't describe anything.  Symbols are given by name,
+    and found via a DT_HASH table.  If merge_strings is true, strings that
+    are suffixes of earlier ones share their bytes, as the linker does.
+    """
+    if elfclass == elf.ELFCLASS32:
+        (ehsize,phentsize) = (52,32)
+    else:
+        (ehsize,phentsize) = (64,56)
+    phnum = 3 if interp else 2
+    #  The dynamic string table, in which index 0 is the empty string.
+    strtab = ["\x00"]
+    def addstr(s):
+        if merge_strings:
+            index = "".join(strtab).find(s + "\x00")
+            if index >= 0:
+                return index
+        index = len("".join(strtab))
+        strtab.append(s + "\x00")
+        return index
+    dynamic = []
+    for lib in needed:
+        dynamic.append((elf.DT_NEEDED,addstr(lib)))
+    if rpath is not None:
+        dynamic.append((elf.DT_RPATH,addstr(rpath)))
+    if runpath is not None:
+        dynamic.append((elf.DT_RUNPATH,addstr(runpath)))
+    verdata = []
+    for (i,(lib,versions)) in enumerate(verneed):
+        entry = []
+        for (j,ver) in enumerate(versions):
+            next = 16 if j < len(versions) - 1 else 0
+            entry.append(struct.pack(byteorder + "IHHII",
+                                     0,0,j + 2,addstr(ver),next))
+        next = 16 + 16 * len(versions) if i < len(verneed) - 1 else 0
+        entry.insert(0,struct.pack(byteorder + "HHIII",1,len(versions),
+                                   addstr(lib),16,next))
+        verdata.append("".join(entry))
+    if elfclass == elf.ELFCLASS32:
+        (symfmt,symsize) = (byteorder + "IIIBBH",16)
+    else:
+        (symfmt,symsize) = (byteorder + "IBBHQQ",24)
+    symdata = [struct.pack(symfmt,0,0,0,0,0,0)]
+    for nm in symbols:
+        if elfclass == elf.ELFCLASS32:
+            symdata.append(struct.pack(symfmt,addstr(nm),0,0,0x12,0,1))
+        else:
+            symdata.append(struct.pack(symfmt,addstr(nm),0x12,0,1,0,0))
+    symdata = "".join(symdata)
+    #  A hash table with a single empty bucket, just giving the count.
+    hashdata = struct.pack(byteorder + "II",1,len(symbols) + 1)
+    hashdata += "\x00" * 4 * (len(symbols) + 2)
+    strtab = "".join(strtab)
+    verdata = "".join(verdata)
+    interpdata = "/lib/ld-linux.so.2\x00" if interp else ""
+    stroff = ehsize + phnum * phentsize
+    veroff = stroff + len(strtab)
+    symoff = veroff + len(verdata)
+    hashoff = symoff + len(symdata)
+    interpoff = hashoff + len(hashdata)
+    dynoff = interpoff + len(interpdata)
+    dynamic.append((elf.DT_STRTAB,BASE_VADDR + stroff))
+    dynamic.append((elf.DT_STRSZ,len(strtab)))
+    if verneed:
+        dynamic.append((elf.DT_VERNEED,BASE_VADDR + veroff))
+        dynamic.append((elf.DT_VERNEEDNUM,len(verneed)))
+    if symbols:
+        dynamic.append((elf.DT_SYMTAB,BASE_VADDR + symoff))
+        dynamic.append((elf.DT_SYMENT,symsize))
+        dynamic.append((elf.DT_HASH,BASE_VADDR + hashoff))
+    dynamic.append((elf.DT_NULL,0))
+    if elfclass == elf.ELFCLASS32:
+        dynfmt = byteorder + "iI"
+    else:
+        dynfmt = byteorder + "qQ"
+    dyndata = "".join(struct.pack(dynfmt,*d) for d in dynamic)
+    size = dynoff + len(dyndata)
+    shdata = ""
+    (shoff,shnum,shstrndx) = (0,0,0)
+    if sections is not None:
+        names = [""] + list(sections) + [".shstrtab"]
+        shstrtab = "".join(nm + "\x00" for nm in names)
+        if elfclass == elf.ELFCLASS32:
+            (shfmt,shentsize) = (byteorder + "IIIIIIIIII",40)
+        else:
+            (shfmt,shentsize) = (byteorder + "IIQQQQIIQQ",64)
+        shoff = size + len(shstrtab)
+        (shnum,shstrndx) = (len(names),len(names) - 1)
+        shdata = shstrtab
+        nameoff = 0
+        for nm in names:
+            shdata += struct.pack(shfmt,nameoff,1,0,0,size,len(shstrtab),
+                                  0,0,1,0)
+            nameoff += len(nm) + 1
+    phdrs = [(elf.PT_LOAD,0,BASE_VADDR,size),
+             (elf.PT_DYNAMIC,dynoff,BASE_VADDR + dynoff,len(dyndata))]
+    if interp:
+        phdrs.append((elf.PT_INTERP,interpoff,BASE_VADDR + interpoff,
+                      len(interpdata)))
+    phdata = []
+    for (p_type,p_offset,p_vaddr,p_filesz) in phdrs:
+        if elfclass == elf.ELFCLASS32:
+            phdata.append(struct.pack(byteorder + "IIIIIIII",p_type,p_offset,
+                                      p_vaddr,p_vaddr,p_filesz,p_filesz,5,4))
+        else:
+            phdata.append(struct.pack(byteorder + "IIQQQQQQ",p_type,5,
+                                      p_offset,p_vaddr,p_vaddr,p_filesz,
+                                      p_filesz,8))
+    ident = elf.ELF_MAGIC + chr(elfclass)
+    ident += chr(elf.ELFDATA2LSB if byteorder == "<" else elf.ELFDATA2MSB)
+    ident += "\x01" + "\x00" * 9
+    if elfclass == elf.ELFCLASS32:
+        ehdr = struct.pack(byteorder + "16sHHIIIIIHHHHHH",ident,type,3,1,0,
+                           ehsize,shoff,0,ehsize,phentsize,phnum,40,
+                           shnum,shstrndx)
+    else:
+        ehdr = struct.pack(byteorder + "16sHHIQQQIHHHHHH",ident,type,62,1,0,
+                           ehsize,shoff,0,ehsize,phentsize,phnum,64,
+                           shnum,shstrndx)
+    data = ehdr + "".join(phdata) + strtab + verdata + symdata + hashdata
+    data += interpdata + dyndata
+    return data + shdata
+
+
+class TestElf(unittest.TestCase):
+
+    def _write(self,dirnm,nm,data):
+        path = os.path.join(dirnm,nm)
+        with open(path,"wb") as f:
+            f.write(data)
+        return path
+
+    def test_classify(self):
+        with util.tempdir() as d:
+            so = self._write(d,"libfoo.so",make_elf())
+            exe = self._write(d,"foo",make_elf(type=elf.ET_EXEC))
+            pie = self._write(d,"pie",make_elf(interp=True))
+            obj = self._write(d,"foo.o",make_elf(type=elf.ET_REL))
+            script = self._write(d,"script","#!/bin/sh\n")
+            empty = self._write(d,"empty","")
+            self.assertEquals(elf.classify(so),"shared object")
+            self.assertEquals(elf.classify(exe),"executable")
+            self.assertEquals(elf.classify(pie),"executable")
+            self.assertEquals(elf.classify(obj),"relocatable")
+            self.assertEquals(elf.classify(script),None)
+            self.assertEquals(elf.classify(empty),None)
+            self.assertEquals(elf.classify(os.path.join(d,"missing")),None)
+            bad = self._write(d,"bad",make_elf()[:20])
+            self.assertRaises(elf.ElfError,elf.classify,bad)
+
+    def test_dynamic_info_in_all_formats(self):
+        verneed = [("libc.so.6",["GLIBC_2.0","GLIBC_2.3.4"]),
+                   ("libstdc++.so.6",["GLIBCXX_3.4"])]
+        with util.tempdir() as d:
+            for elfclass in (elf.ELFCLASS32,elf.ELFCLASS64):
+                for byteorder in ("<",">"):
+                    data = make_elf(elfclass,byteorder,
+                                    needed=["libc.so.6","libstdc++.so.6"],
+                                    runpath="$ORIGIN/../lib",
+                                    verneed=verneed)
+                    with elf.ElfFile(self._write(d,"lib.so",data)) as f:
+                        self.assertEquals(f.bits,
+                                          32 if elfclass == 1 else 64)
+                        self.assertEquals(f.needed,
+                                          ["libc.so.6","libstdc++.so.6"])
+                        self.assertEquals(f.runpath,"$ORIGIN/../lib")
+                        self.assertEquals(f.rpath,None)
+                        self.assertEquals(f.version_needs(),[
+                            ("libc.so.6","GLIBC_2.0"),
+                            ("libc.so.6","GLIBC_2.3.4"),
+                            ("libstdc++.so.6","GLIBCXX_3.4"),
+                        ])
+
+    def test_section_names(self):
+        with util.tempdir() as d:
+            for elfclass in (elf.ELFCLASS32,elf.ELFCLASS64):
+                data = make_elf(elfclass,">",sections=[".text",".dynsym"])
+                with elf.ElfFile(self._write(d,"lib.so",data)) as f:
+                    self.assertEquals(f.section_names,
+                                      ["",".text",".dynsym",".shstrtab"])
+                    self.assertFalse(f.has_symbols)
+                for extra in (".symtab",".debug_info",".zdebug_line"):
+                    data = make_elf(elfclass,sections=[".text",extra])
+                    with elf.ElfFile(self._write(d,"lib.so",data)) as f:
+                        self.assertTrue(f.has_symbols)
+            with elf.ElfFile(self._write(d,"lib.so",make_elf())) as f:
+                self.assertEquals(f.section_names,[])
+                self.assertFalse(f.has_symbols)
+
+    def test_rpath_sharing_bytes_is_not_overwritten(self):
+        longpath = "/opt/some/very/long/path/to/the/lib"
+        with util.tempdir() as d:
+            for elfclass in (elf.ELFCLASS32,elf.ELFCLASS64):
+                #  The symbol "lib" is merged into the end of the rpath.
+                data = make_elf(elfclass,rpath=longpath,symbols=["foo","lib"],
+                                verneed=[("libc.so.6",["GLIBC_2.0"])],
+                                merge_strings=True)
+                path = self._write(d,"lib.so",data)
+                with elf.ElfFile(path,writable=True) as f:
+                    index = f._dynamic_value(elf.DT_RPATH) + len(longpath) - 3
+                    self.assertTrue(index in f.string_references())
+                    self.assertEquals(f.dynamic_string(index),"lib")
+                    self.assertFalse(f.set_rpath("/short"))
+                with open(path,"rb") as f:
+                    self.assertEquals(f.read(),data)
+                #  Without the merged symbol it can be rewritten.
+                data = make_elf(elfclass,rpath=longpath,symbols=["foo"],
+                                verneed=[("libc.so.6",["GLIBC_2.0"])],
+                                merge_strings=True)
+                path = self._write(d,"lib.so",data)
+                with elf.ElfFile(path,writable=True) as f:
+                    self.assertTrue(f.set_rpath("/short"))
+                with elf.ElfFile(path) as f:
+                    self.assertEquals(f.rpath,"/short")
+                    self.assertEquals(f.version_needs(),
+                                      [("libc.so.6","GLIBC_2.0")])
+
+    def test_max_version(self):
+        versions = ["GLIBC_2.0","GLIBC_2.3.4","GLIBC_2.3","GLIBC_PRIVATE",
+                    "GLIBCXX_3.4.7","CXXABI_1.3"]
+        self.assertEquals(elf.max_version(versions,"GLIBC_"),(2,3,4))
+        self.assertEquals(elf.max_version(versions,"GLIBCXX_"),(3,4,7))
+        self.assertEquals(elf.max_version(versions,"GCC_"),None)
+
+
+class TestGlibcCheck(unittest.TestCase):
+
+    def test_new_symbol_versions_are_rejected(self):
+        from myppy.envs.linux import MyppyEnv
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"64bit")
+            path = os.path.join(env.PREFIX,"lib","libok.so")
+            with open(path,"wb") as f:
+                f.write(make_elf(verneed=[("libc.so.6",["GLIBC_2.3.4"]),
+                                 ("libstdc++.so.6",["GLIBCXX_3.4.7"])]))
+            self.assertEquals(env._check_glibc_symbols(path),
+                              ([],["GLIBC_2.3.4","GLIBCXX_3.4.7"]))
+            for (lib,ver) in (("libc.so.6","GLIBC_2.4"),
+                              ("libstdc++.so.6","GLIBCXX_3.4.9")):
+                with open(path,"wb") as f:
+                    f.write(make_elf(verneed=[(lib,["GLIBC_2.0",ver])]))
+                (errors,_) = env._check_glibc_symbols(path)
+                self.assertEquals(len(errors),1)
+
+    def test_all_errors_are_reported_after_processing(self):
+        from myppy.envs.linux import MyppyEnv
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"64bit")
+            stripped = []
+            env._strip_files = lambda fpaths: stripped.extend(fpaths)
+            adjusted = []
+            def adjust_rpath(fpath,need_patchelf):
+                adjusted.append((fpath,need_patchelf))
+            env._adjust_rpath = adjust_rpath
+            files = []
+            for nm in ("liba.so","libb.so.1","libok.so","prog","data.txt"):
+                files.append(os.path.join(env.PREFIX,"lib",nm))
+            bad = make_elf(verneed=[("libc.so.6",["GLIBC_2.17"])],
+                           sections=[".symtab"])
+            prog = make_elf(type=elf.ET_EXEC,sections=[".debug_info"])
+            for (fpath,data) in zip(files,(bad,bad,make_elf(),prog,"text")):
+                with open(fpath,"wb") as f:
+                    f.write(data)
+            try:
+                env.process_files("lib_foo",files)
+            except RuntimeError, e:
+                self.assertTrue("liba.so needs GLIBC_2.17" in str(e))
+                self.assertTrue("libb.so.1 needs GLIBC_2.17" in str(e))
+            else:
+                self.fail("symbol version errors not reported")
+            #  Only files with something to strip get stripped.
+            self.assertEquals(sorted(stripped),sorted(files[:2] + files[3:4]))
+            self.assertEquals(sorted(adjusted),
+                              sorted((fpath,True) for fpath in files[:4]))
+            #  patchelf can't need itself to be installed already.
+            del adjusted[:]
+            env.process_files("patchelf",files[2:])
+            self.assertEquals(sorted(adjusted),
+                              sorted((fpath,False) for fpath in files[2:4]))
+
+    def test_strip_keeps_debug_info_in_store(self):
+        from myppy.envs.linux import MyppyEnv
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"64bit")
+            env.debug_store = os.path.join(rootdir,"debug")
+            commands = []
+            env.do = lambda *cmdline: commands.append(cmdline)
+            files = [os.path.join(env.PREFIX,"lib",nm)
+                     for nm in ("liba.so","libb.so")]
+            for fpath in files:
+                open(fpath,"wb").close()
+                os.chmod(fpath,0444)
+            env._strip_files(files)
+            debugfiles = [env.debug_store + fpath + ".debug"
+                          for fpath in files]
+            self.assertEquals(commands,[
+                ("objcopy","--only-keep-debug",files[0],debugfiles[0]),
+                ("objcopy","--only-keep-debug",files[1],debugfiles[1]),
+                ("strip",files[0],files[1]),
+            ] + [("objcopy","--add-gnu-debuglink=" + debugfile,fpath)
+                 for (fpath,debugfile) in zip(files,debugfiles)])
+            for fpath in files:
+                self.assertEquals(os.stat(fpath).st_mode & 0777,0444)
+
+    def test_rpath_is_rewritten_in_place(self):
+        from myppy.envs.linux import MyppyEnv
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"64bit")
+            def do(*cmdline,**kwds):
+                raise AssertionError("ran %r" % (cmdline,))
+            env.do = do
+            libdir = os.path.join(env.PREFIX,"lib","python2.7")
+            os.makedirs(libdir)
+            fpath = os.path.join(libdir,"_foo.so")
+            with open(fpath,"wb") as f:
+                f.write(make_elf(needed=["libfoo.so"],
+                                 runpath="/build/tmp/local/lib/long/path",
+                                 rpath="/build/tmp/local/lib/long/path"))
+            os.chmod(fpath,0555)
+            env._adjust_rpath(fpath)
+            with elf.ElfFile(fpath) as f:
+                self.assertEquals(f.runpath,"${ORIGIN}:${ORIGIN}/../../lib")
+                self.assertEquals(f.rpath,"${ORIGIN}:${ORIGIN}/../../lib")
+                self.assertEquals(f.needed,["libfoo.so"])
+            self.assertEquals(os.stat(fpath).st_mode & 0777,0555)
+            #  Files that are already correct aren't touched at all.
+            os.utime(fpath,(1000000000,1000000000))
+            env._adjust_rpath(fpath)
+            self.assertEquals(os.stat(fpath).st_mtime,1000000000)
+            #  Growing the rpath needs patchelf, which is only optional
+            #  while it's still being installed.
+            with open(fpath,"wb") as f:
+                f.write(make_elf(runpath="/short"))
+            self.assertRaises(RuntimeError,env._adjust_rpath,fpath)
+            env._adjust_rpath(fpath,need_patchelf=False)
+            with elf.ElfFile(fpath) as f:
+                self.assertEquals(f.runpath,"/short")
+            os.makedirs(os.path.join(env.PREFIX,"bin"))
+            open(os.path.join(env.PREFIX,"bin","patchelf"),"w").close()
+            self.assertRaises(AssertionError,env._adjust_rpath,fpath)
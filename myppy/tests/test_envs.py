@@ -0,0 +1,412 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+
+from __future__ import with_statement
+
+import os
+import time
+import sqlite3
+import hashlib
+import unittest
+
+from myppy import util
+from myppy.envs.base import MyppyEnv
+from myppy.recipes.base import Recipe
+
+
+class TestFindNewFiles(unittest.TestCase):
+
+    def _make_files(self,env,*names):
+        for nm in names:
+            path = os.path.join(env.rootdir,nm)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path,"w").close()
+
+    def _age_dirs(self,env):
+        #  Make every dir look old enough to be trusted by the snapshot.
+        then = time.time() - 60
+        for (dirnm,_,_) in os.walk(env.rootdir):
+            os.utime(dirnm,(then,then))
+
+    def _full_walk(self,env):
+        with env:
+            env._db.execute("DELETE FROM dir_snapshots")
+            return sorted(env.find_new_files())
+
+    def test_snapshot_matches_full_walk(self):
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            self._make_files(env,"local/lib/liba.so","local/bin/a")
+            self._age_dirs(env)
+            with env:
+                env.record_files("a",env.find_new_files())
+            self._make_files(env,"local/lib/sub/libb.so")
+            os.mkdir(os.path.join(rootdir,"local","share"))
+            with env:
+                found = sorted(env.find_new_files())
+            self.assertEquals(found,self._full_walk(env))
+            self.assertEquals(found,[
+                os.path.join(env.rootdir,"local","lib","sub","libb.so"),
+                os.path.join(env.rootdir,"local","share") + os.sep,
+            ])
+
+    def test_snapshot_is_consistent_after_uninstall(self):
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            self._make_files(env,"local/lib/liba.so","local/lib/libb.so")
+            os.makedirs(os.path.join(rootdir,"local","etc"))
+            os.symlink("missing",os.path.join(rootdir,"local","etc","dead"))
+            self._age_dirs(env)
+            with env:
+                env.record_files("lib_png",env.find_new_files())
+            self._make_files(env,"local/lib/libc.so")
+            self._age_dirs(env)
+            with env:
+                env.record_files("lib_jpeg",env.find_new_files())
+            env.uninstall("lib_png")
+            self.assertFalse(os.path.lexists(os.path.join(rootdir,"local",
+                                                          "etc")))
+            self.assertTrue(env.is_installed("lib_jpeg"))
+            with env:
+                found = sorted(env.find_new_files())
+            self.assertEquals(found,[])
+            self.assertEquals(found,self._full_walk(env))
+
+
+class TestUninstall(unittest.TestCase):
+
+    def _record(self,env,recipe,*names):
+        files = []
+        for nm in names:
+            path = os.path.join(env.rootdir,nm)
+            if nm.endswith("/"):
+                os.makedirs(path)
+            else:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path,"w").close()
+            files.append(path)
+        with env:
+            env.record_files(recipe,files)
+
+    def test_dependents_are_uninstalled(self):
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            self._record(env,"lib_zlib","local/lib/libz.a")
+            self._record(env,"lib_png","local/lib/libpng.so")
+            self._record(env,"py_PIL","local/lib/python/PIL/Image.py",
+                                      "local/lib/python/PIL/empty/",
+                                      "local/include/PIL/Imaging.h")
+            self._record(env,"lib_jpeg","local/lib/libjpeg.so")
+            removed = env.uninstall("lib_zlib")
+            self.assertEquals(removed,["lib_zlib","py_PIL"])
+            self.assertEquals(env.installed_recipes(),
+                              set(["lib_png","lib_jpeg"]))
+            self.assertEquals(sorted(os.listdir(os.path.join(rootdir,"local",
+                                                             "lib"))),
+                              ["libjpeg.so","libpng.so"])
+            for dirpath in ("local/lib/python/PIL","local/include/PIL"):
+                self.assertFalse(os.path.exists(os.path.join(rootdir,dirpath)))
+
+
+class lib_halfstaged(Recipe):
+    STAGED_INSTALL = True
+    ARTIFACT_CACHEABLE = False
+    def install(self):
+        #  Staging doesn't need the prefix lock.
+        lock = util.FileLock(os.path.join(self.target.lockdir,"prefix"))
+        self.unlocked = lock.acquire(blocking=False)
+        lock.close()
+        libdir = self.stagedir + os.path.join(self.PREFIX,"lib")
+        os.makedirs(libdir)
+        open(os.path.join(libdir,"libstaged.so"),"w").close()
+        #  Ignoring DESTDIR, as some makefiles do.
+        bindir = os.path.join(self.PREFIX,"bin")
+        if not os.path.isdir(bindir):
+            os.makedirs(bindir)
+        open(os.path.join(bindir,"unstaged"),"w").close()
+
+
+class TestStagedInstall(unittest.TestCase):
+
+    def _stage(self,env,stagedir,*names):
+        for nm in names:
+            path = stagedir + os.path.join(env.rootdir,nm)
+            if nm.endswith("/"):
+                os.makedirs(path)
+            else:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path,"w").close()
+
+    def test_merge_staged_files(self):
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            libdir = os.path.join(rootdir,"local","lib")
+            os.makedirs(libdir)
+            open(os.path.join(libdir,"libold.so"),"w").close()
+            with env:
+                env.record_files("old",[os.path.join(libdir,"libold.so")])
+            with util.tempdir() as tempdir:
+                stagedir = os.path.join(tempdir,"stage")
+                self._stage(env,stagedir,"local/lib/libnew.so.1",
+                                         "local/lib/sub/deep/data",
+                                         "local/share/empty/")
+                os.symlink("libnew.so.1",stagedir + libdir + "/libnew.so")
+                files = env.merge_staged_files(stagedir)
+                self.assertFalse(os.path.exists(stagedir))
+            self.assertEquals(sorted(files),[
+                os.path.join(libdir,"libnew.so"),
+                os.path.join(libdir,"libnew.so.1"),
+                os.path.join(libdir,"sub","deep","data"),
+                os.path.join(rootdir,"local","share","empty") + os.sep,
+            ])
+            self.assertEquals(os.readlink(os.path.join(libdir,"libnew.so")),
+                              "libnew.so.1")
+            self.assertTrue(os.path.exists(os.path.join(libdir,"libold.so")))
+
+    def test_files_staged_outside_env_are_rejected(self):
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            with util.tempdir() as tempdir:
+                stagedir = os.path.join(tempdir,"stage")
+                os.makedirs(os.path.join(stagedir,"usr","lib"))
+                open(os.path.join(stagedir,"usr","lib","libz.so"),"w").close()
+                self.assertRaises(RuntimeError,env.merge_staged_files,stagedir)
+
+    def test_unstaged_files_are_found(self):
+        with util.tempdir() as rootdir:
+            env = MetaEnv(rootdir,"32bit")
+            r = lib_halfstaged(env)
+            env._install_recipe("lib_halfstaged",r)
+            self.assertTrue(r.unlocked)
+            self.assertFalse(os.path.exists(os.path.join(env.builddir,
+                                                         "MYPPY-STAGE",
+                                                         "lib_halfstaged")))
+            staged = os.path.join(env.PREFIX,"lib","libstaged.so")
+            unstaged = os.path.join(env.PREFIX,"bin","unstaged")
+            q = "SELECT filepath, mode FROM installed_files WHERE recipe=?"
+            rows = env._db.execute(q,("lib_halfstaged",)).fetchall()
+            self.assertEquals(sorted(path for (path,_) in rows),
+                              ["local/bin/unstaged","local/lib/libstaged.so"])
+            self.assertTrue(all(mode is not None for (_,mode) in rows))
+            env.uninstall("lib_halfstaged")
+            self.assertFalse(os.path.exists(staged))
+            self.assertFalse(os.path.exists(unstaged))
+
+
+class meta_recipe(Recipe):
+    SOURCE_URL = None
+    def fetch(self):
+        pass
+    def build(self):
+        pass
+    def install(self):
+        name = self.__class__.__name__
+        open(os.path.join(self.PREFIX,name + "-installed"),"w").close()
+
+class meta_one(meta_recipe):
+    pass
+
+class meta_two(meta_recipe):
+    pass
+
+class lib_nosource(Recipe):
+    pass
+
+
+class MetaEnv(MyppyEnv):
+    DEPENDENCIES = []
+    def load_recipe(self,recipe):
+        return globals()[recipe](self)
+
+
+class TestSourceKey(unittest.TestCase):
+
+    def test_recipes_without_source_are_keyed_by_name(self):
+        with util.tempdir() as rootdir:
+            env = MetaEnv(rootdir,"32bit")
+            self.assertEquals(env._source_key("meta_one",meta_one(env)),
+                              "meta_one")
+            r = lib_nosource(env)
+            self.assertEquals(env._source_key("lib_nosource",r),
+                              "lib_nosource")
+            r.SOURCE_URL = "http://example.com/nosource-1.0.tar.gz"
+            self.assertEquals(env._source_key("lib_nosource",r),
+                              "nosource-1.0.tar.gz")
+            env.jobs = 2
+            env.install_recipes(["meta_one","meta_two"])
+            self.assertEquals(env.installed_recipes(),
+                              set(["meta_one","meta_two"]))
+
+
+class TestUpdate(unittest.TestCase):
+
+    def _record(self,env,recipe,*names):
+        files = []
+        for nm in names:
+            path = os.path.join(env.rootdir,nm)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path,"w").close()
+            files.append(path)
+        with env:
+            env.record_files(recipe,files)
+
+    def _install(self,env,recipe,*names):
+        self._record(env,recipe,*names)
+        with env:
+            env._record_fingerprint(recipe)
+
+    def test_stale_recipes_are_rebuilt_with_dependents(self):
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            self._install(env,"lib_zlib","local/lib/libz.a")
+            self._install(env,"lib_png","local/lib/libpng.so")
+            self._install(env,"py_PIL","local/lib/python/PIL/Image.py")
+            self._record(env,"handmade","local/bin/handmade")
+            with env:
+                env._db.execute("INSERT INTO installed_recipes"
+                                " VALUES ('py_PIL')")
+                q = "UPDATE recipe_fingerprints SET fingerprint='old'"
+                q += " WHERE recipe='lib_zlib'"
+                env._db.execute(q)
+            self.assertEquals(env.stale_recipes(),set(["lib_zlib"]))
+            self.assertEquals(env.update_recipes(dry_run=True),
+                              ["lib_zlib","py_PIL"])
+            self.assertTrue(env.is_installed("py_PIL"))
+            built = []
+            def install_recipes(recipes,initialising=False,explicit=True):
+                built.append((list(recipes),explicit))
+                self._install(env,"lib_zlib","local/lib/libz.a")
+                self._install(env,"py_PIL","local/lib/python/PIL/Image.py")
+            env.install_recipes = install_recipes
+            env.update_recipes()
+            self.assertEquals(built,[(["lib_zlib","py_PIL"],False)])
+            self.assertEquals(env.stale_recipes(),set())
+            self.assertTrue(env.is_explicitly_installed("py_PIL"))
+            self.assertEquals(env.installed_recipes(),
+                              set(["lib_zlib","lib_png","py_PIL","handmade"]))
+
+
+class TestDatabase(unittest.TestCase):
+
+    def test_unversioned_db_is_upgraded(self):
+        with util.tempdir() as rootdir:
+            os.makedirs(os.path.join(rootdir,"local"))
+            db = sqlite3.connect(os.path.join(rootdir,MyppyEnv.DB_NAME))
+            db.execute("CREATE TABLE installed_recipes ("
+                       "  recipe STRING NOT NULL"
+                       ")")
+            db.execute("CREATE TABLE installed_files ("
+                       "  recipe STRING NOT NULL,"
+                       "  filepath STRING NOT NULL"
+                       ")")
+            db.execute("INSERT INTO installed_files VALUES ('a','local/a')")
+            db.commit()
+            db.close()
+            env = MyppyEnv(rootdir,"32bit")
+            version = env._db.execute("PRAGMA user_version").fetchone()[0]
+            self.assertEquals(version,len(MyppyEnv.SCHEMA_MIGRATIONS))
+            self.assertTrue(env.is_installed("a"))
+            q = "SELECT size, mode, hash FROM installed_files"
+            self.assertEquals(env._db.execute(q).fetchall(),[(None,)*3])
+            #  Opening it again shouldn't try to re-apply the migrations.
+            MyppyEnv(rootdir,"32bit")
+
+    def test_file_metadata_is_recorded(self):
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            fpath = os.path.join(env.rootdir,"local","data")
+            with open(fpath,"wb") as f:
+                f.write("hello")
+            with env:
+                env.record_files("a",[fpath])
+            q = "SELECT size, hash FROM installed_files WHERE filepath=?"
+            (size,hash) = env._db.execute(q,("local/data",)).fetchone()
+            self.assertEquals(size,5)
+            self.assertEquals(hash,hashlib.sha256("hello").hexdigest())
+
+    def test_files_are_hashed_outside_transaction(self):
+        with util.tempdir() as rootdir:
+            env = MetaEnv(rootdir,"32bit")
+            locked = []
+            hashfile = util.hashfile
+            def checking_hashfile(path):
+                locked.append(env._has_db_lock)
+                return hashfile(path)
+            util.hashfile = checking_hashfile
+            try:
+                env._install_recipe("meta_one",meta_one(env))
+            finally:
+                util.hashfile = hashfile
+            self.assertEquals(locked,[0])
+            self.assertTrue(env.is_installed("meta_one"))
+
+    def test_explicit_closure_sees_other_connections(self):
+        with util.tempdir() as rootdir:
+            env1 = MyppyEnv(rootdir,"32bit")
+            env2 = MyppyEnv(rootdir,"32bit")
+            self.assertFalse(env1.is_explicitly_installed("lib_png"))
+            with env2:
+                env2._db.execute("INSERT INTO installed_files (recipe,"
+                                 " filepath) VALUES ('lib_png','local/p')")
+            self.assertFalse(env1.is_explicitly_installed("lib_png"))
+            with env2:
+                env2._db.execute("INSERT INTO installed_recipes"
+                                 " VALUES ('lib_png')")
+            self.assertTrue(env1.is_explicitly_installed("lib_png"))
+
+
+class TestLocking(unittest.TestCase):
+
+    def test_lock_taken_by_child_outlives_it(self):
+        with util.tempdir() as lockdir:
+            path = os.path.join(lockdir,"lock")
+            lock = util.FileLock(path)
+            pid = os.fork()
+            if pid == 0:
+                lock.acquire()
+                os._exit(0)
+            os.waitpid(pid,0)
+            other = util.FileLock(path)
+            self.assertFalse(other.acquire(blocking=False))
+            lock.release()
+            self.assertTrue(other.acquire(blocking=False))
+            other.close()
+            lock.close()
+
+    def test_prefix_lock_is_reentrant(self):
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            other = util.FileLock(os.path.join(env.lockdir,"prefix"))
+            with env.prefix_lock():
+                with env.prefix_lock():
+                    pass
+                self.assertFalse(other.acquire(blocking=False))
+            self.assertTrue(other.acquire(blocking=False))
+            other.close()
+
+
+class TestLinkProfile(unittest.TestCase):
+
+    def test_link_profile_flags(self):
+        from myppy.envs.linux import MyppyEnv as LinuxEnv
+        environ = os.environ.copy()
+        try:
+            with util.tempdir() as rootdir:
+                os.environ.pop("MYPPY_LINK_PROFILE",None)
+                default = LinuxEnv(rootdir,"32bit")
+                self.assertFalse("--as-needed" in default.LDFLAGS)
+                os.environ["MYPPY_LINK_PROFILE"] = "startup"
+                env = LinuxEnv(rootdir,"32bit")
+                self.assertTrue("-Wl,--hash-style=both" in env.LDFLAGS)
+                self.assertTrue("-Wl,-z,lazy" in env.env["LDFLAGS"])
+                self.assertNotEquals(env.recipe_fingerprint("lib_zlib"),
+                                     default.recipe_fingerprint("lib_zlib"))
+                os.environ["MYPPY_LINK_PROFILE"] = "fastest"
+                self.assertRaises(ValueError,LinuxEnv,rootdir,"32bit")
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
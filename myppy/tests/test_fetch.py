@@ -0,0 +1,373 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+
+from __future__ import with_statement
+
+import os
+import time
+import shutil
+import tarfile
+import hashlib
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+import SimpleHTTPServer
+from StringIO import StringIO
+
+from myppy import util
+from myppy.envs import base as envs_base
+from myppy.envs.base import MyppyEnv
+from myppy.download import parse_mirrors, MirrorList
+from myppy.unpack import MemberFilter
+from myppy.recipes.base import Recipe
+from myppy.tests.test_download import RangeHandler, DATA
+
+
+class SlowHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serve files from the server's rootdir, slowly, counting requests."""
+    requests = []
+    def do_GET(self):
+        self.requests.append(self.path)
+        time.sleep(0.2)
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+    def translate_path(self,path):
+        return os.path.join(self.server.rootdir,path.lstrip("/"))
+    def log_message(self,*args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class MirrorHandler(RangeHandler):
+    """Serve the contents of the server's "files" dict, by path."""
+    def get_data(self):
+        return self.server.files[self.path]
+
+
+class FakeRecipe(object):
+    BUILD_DEPENDENCIES = []
+    def __init__(self,target,name,deps,url,md5):
+        self.target = target
+        self.DEPENDENCIES = deps
+        self.SOURCE_URL = url
+        self.SOURCE_MD5 = md5
+    def fetch(self):
+        self.target.fetch(self.SOURCE_URL,self.SOURCE_MD5)
+
+
+class FakeEnv(MyppyEnv):
+    RECIPES = {}
+    def load_recipe(self,recipe):
+        (deps,url,md5) = self.RECIPES[recipe]
+        return FakeRecipe(self,recipe,deps,url,md5)
+
+
+class lib_threadcheck(Recipe):
+    thread_counts = []
+    def build(self):
+        self.thread_counts.append(threading.active_count())
+        self.fetch()
+    def install(self):
+        open(os.path.join(self.PREFIX,"threadcheck"),"w").close()
+
+
+class ThreadCheckEnv(MyppyEnv):
+    DEPENDENCIES = []
+    def load_recipe(self,recipe):
+        return {"lib_threadcheck": lib_threadcheck}[recipe](self)
+
+
+class TestFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.serverdir = util.tempdir()
+        self.server = ThreadingHTTPServer(("127.0.0.1",0),SlowHandler)
+        self.server.rootdir = self.serverdir.__enter__()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        SlowHandler.requests = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.serverdir.__exit__(None,None,None)
+
+    def _publish(self,nm,data):
+        with open(os.path.join(self.server.rootdir,nm),"wb") as f:
+            f.write(data)
+        url = "http://127.0.0.1:%d/%s" % (self.server.server_port,nm)
+        return (url,hashlib.md5(data).hexdigest())
+
+    def test_fetch_recipes_downloads_closure_concurrently(self):
+        RECIPES = {}
+        (url,md5) = self._publish("base.tar.gz","base")
+        RECIPES["base"] = ([],url,md5)
+        deps = []
+        for i in xrange(4):
+            (url,md5) = self._publish("lib%d.tar.gz" % (i,),"lib%d" % (i,))
+            RECIPES["lib%d" % (i,)] = (["base"],url,md5)
+            deps.append("lib%d" % (i,))
+        #  Two recipes built from the same source only fetch it once.
+        RECIPES["lib0_extra"] = (["base"],) + RECIPES["lib0"][1:]
+        RECIPES["app"] = (deps + ["lib0_extra"],) + RECIPES["base"][1:]
+        with util.tempdir() as rootdir:
+            env = FakeEnv(rootdir,"32bit")
+            env.RECIPES = RECIPES
+            env.fetch_jobs = 5
+            t0 = time.time()
+            env.fetch_recipes(["app"])
+            #  Five distinct files at 0.2s each, fetched side-by-side.
+            self.assertTrue(time.time() - t0 < 0.2 * 4)
+            self.assertEquals(sorted(SlowHandler.requests),
+                              ["/base.tar.gz","/lib0.tar.gz","/lib1.tar.gz",
+                               "/lib2.tar.gz","/lib3.tar.gz"])
+            for nm in ("base","lib0","lib1","lib2","lib3"):
+                with open(os.path.join(env.cachedir,nm + ".tar.gz")) as f:
+                    self.assertEquals(f.read(),nm)
+
+    def test_concurrent_fetches_of_one_file_download_it_once(self):
+        (url,md5) = self._publish("src.tar.gz","source")
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            threads = [threading.Thread(target=env.fetch,args=(url,md5,))
+                       for _ in xrange(3)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEquals(SlowHandler.requests,["/src.tar.gz"])
+
+    def test_install_prefetches_without_threads(self):
+        (url,md5) = self._publish("src.tar.gz","source")
+        lib_threadcheck.SOURCE_URL = url
+        lib_threadcheck.SOURCE_MD5 = md5
+        lib_threadcheck.thread_counts = []
+        with util.tempdir() as rootdir:
+            env = ThreadCheckEnv(rootdir,"32bit")
+            nthreads = threading.active_count()
+            env.install_recipes(["lib_threadcheck"])
+            #  Builds may be forked, so there mustn't be any fetch
+            #  threads running in this process.
+            self.assertEquals(lib_threadcheck.thread_counts,[nthreads])
+            self.assertEquals(SlowHandler.requests,["/src.tar.gz"])
+            self.assertTrue(env.is_installed("lib_threadcheck"))
+
+    def test_failed_fetch_is_reported(self):
+        url = "http://127.0.0.1:%d/missing.tar.gz" % (self.server.server_port,)
+        with util.tempdir() as rootdir:
+            env = FakeEnv(rootdir,"32bit")
+            env.RECIPES = {"missing": ([],url,None)}
+            self.assertRaises(RuntimeError,env.fetch_recipes,["missing"])
+
+    def test_digests_are_cached_until_file_changes(self):
+        (url,md5) = self._publish("src.tar.gz","source")
+        sha256 = hashlib.sha256("source").hexdigest()
+        calls = []
+        hashfile_multi = util.hashfile_multi
+        def counting_hashfile_multi(path,algorithms):
+            calls.append(path)
+            return hashfile_multi(path,algorithms)
+        util.hashfile_multi = counting_hashfile_multi
+        try:
+            with util.tempdir() as rootdir:
+                env = MyppyEnv(rootdir,"32bit")
+                cachefile = env.fetch(url,md5,sha256)
+                env.fetch(url,md5,sha256)
+                env.fetch(url,md5)
+                self.assertEquals(len(calls),1)
+                self.assertEquals(SlowHandler.requests,["/src.tar.gz"])
+                #  A changed file is re-hashed, found bad and re-downloaded.
+                with open(cachefile,"wb") as f:
+                    f.write("corrupt")
+                env.fetch(url,None,sha256)
+                self.assertEquals(len(calls),3)
+                self.assertEquals(len(SlowHandler.requests),2)
+                self.assertRaises(RuntimeError,env.fetch,url,None,"0" * 64)
+        finally:
+            util.hashfile_multi = hashfile_multi
+
+    def test_mirrors_are_tried_first(self):
+        (url,md5) = self._publish("src.tar.gz","source")
+        with util.tempdir() as mirrordir:
+            with open(os.path.join(mirrordir,"src.tar.gz"),"wb") as f:
+                f.write("source")
+            with util.tempdir() as rootdir:
+                env = MyppyEnv(rootdir,"32bit")
+                env.mirrors = MirrorList(parse_mirrors(mirrordir))
+                with open(env.fetch(url,md5)) as f:
+                    self.assertEquals(f.read(),"source")
+                self.assertEquals(SlowHandler.requests,[])
+
+    def test_failed_mirrors_fall_through_to_upstream(self):
+        (url,md5) = self._publish("src.tar.gz","source")
+        with util.tempdir() as mirrordir:
+            #  One mirror lacks the file, the other has a bad copy.
+            bad = os.path.join(mirrordir,"bad")
+            os.mkdir(bad)
+            with open(os.path.join(bad,"src.tar.gz"),"wb") as f:
+                f.write("corrupt")
+            missing = os.path.join(mirrordir,"missing")
+            with util.tempdir() as rootdir:
+                env = MyppyEnv(rootdir,"32bit")
+                env.mirrors = MirrorList(parse_mirrors(missing + " " + bad))
+                with open(env.fetch(url,md5)) as f:
+                    self.assertEquals(f.read(),"source")
+                self.assertEquals(SlowHandler.requests,["/src.tar.gz"])
+                self.assertEquals([m for (m,_) in env.mirrors.urls(url)],
+                                  env.mirrors.mirrors + [None])
+
+    def test_partial_download_from_failed_mirror_is_not_resumed(self):
+        server = ThreadingHTTPServer(("127.0.0.1",0),MirrorHandler)
+        server.requests = []
+        server.ranges = True
+        server.fail_after = 3000
+        server.files = {"/a/src.tar.gz": "X" * 10000,
+                        "/b/src.tar.gz": DATA}
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            base = "http://127.0.0.1:%d" % (server.server_port,)
+            with util.tempdir() as rootdir:
+                env = MyppyEnv(rootdir,"32bit")
+                env.mirrors = MirrorList([base + "/a",base + "/b"])
+                #  The first mirror breaks off partway through a different
+                #  file, which mustn't be spliced onto the second's.
+                with open(env.fetch(self._publish("src.tar.gz","")[0])) as f:
+                    self.assertEquals(f.read(),DATA)
+                self.assertEquals(server.requests,[None,None])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_mirror_stats_are_shared_with_forked_fetches(self):
+        (url,md5) = self._publish("src.tar.gz","source")
+        with util.tempdir() as mirrordir:
+            missing = os.path.join(mirrordir,"missing")
+            good = os.path.join(mirrordir,"good")
+            os.mkdir(good)
+            with open(os.path.join(good,"src.tar.gz"),"wb") as f:
+                f.write("source")
+            with util.tempdir() as rootdir:
+                env = MyppyEnv(rootdir,"32bit")
+                env.mirrors = MirrorList(parse_mirrors(missing + " " + good))
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        env.fetch(url,md5)
+                    finally:
+                        os._exit(0)
+                os.waitpid(pid,0)
+                self.assertTrue(os.path.exists(env.cache_path(url)))
+                #  The failure seen by the child demotes the mirror here too.
+                env._load_mirror_stats()
+                self.assertEquals([m for (m,_) in env.mirrors.urls(url)],
+                                  env.mirrors.mirrors[::-1] + [None])
+                self.assertEquals(SlowHandler.requests,[])
+
+    def test_mirror_recipes_populates_mirror_dir(self):
+        (url1,md51) = self._publish("base.tar.gz","base")
+        (url2,md52) = self._publish("app.tar.gz","app")
+        with util.tempdir() as mirrordir:
+            with util.tempdir() as rootdir:
+                env = FakeEnv(rootdir,"32bit")
+                env.RECIPES = {"base": ([],url1,md51),
+                               "app": (["base"],url2,md52)}
+                #  A stale copy is replaced, even if it's the same size.
+                with open(os.path.join(mirrordir,"app.tar.gz"),"wb") as f:
+                    f.write("old")
+                env.mirror_recipes(mirrordir,["app"])
+                self.assertEquals(sorted(os.listdir(mirrordir)),
+                                  ["app.tar.gz","base.tar.gz"])
+                with open(os.path.join(mirrordir,"app.tar.gz")) as f:
+                    self.assertEquals(f.read(),"app")
+            #  A fresh env can now fetch everything from the mirror.
+            SlowHandler.requests = []
+            with util.tempdir() as rootdir:
+                env = FakeEnv(rootdir,"32bit")
+                env.RECIPES = {"base": ([],url1,md51),
+                               "app": (["base"],url2,md52)}
+                env.mirrors = MirrorList(parse_mirrors(mirrordir))
+                env.fetch_recipes(["app"])
+                self.assertEquals(SlowHandler.requests,[])
+
+    def _publish_tarball(self,nm,contents):
+        buf = StringIO()
+        tf = tarfile.open(fileobj=buf,mode="w:gz")
+        for (arcnm,data) in contents:
+            tinfo = tarfile.TarInfo(arcnm)
+            tinfo.size = len(data)
+            tf.addfile(tinfo,StringIO(data))
+        tf.close()
+        return self._publish(nm,buf.getvalue())
+
+    def test_unpack_streams_into_workdir(self):
+        (url,md5) = self._publish_tarball("pkg-1.0.tar.gz",
+                                          [("pkg-1.0/README","hello"),
+                                           ("pkg-1.0/src/a.c","int a;")])
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            workdir = os.path.join(env.builddir,"pkg-1.0.tar.gz")
+            updir = env.unpack(url,workdir,md5)
+            self.assertEquals(updir,os.path.join(workdir,"pkg-1.0"))
+            with open(os.path.join(updir,"src","a.c")) as f:
+                self.assertEquals(f.read(),"int a;")
+            self.assertTrue(os.path.exists(env.cache_path(url)))
+            self.assertEquals(SlowHandler.requests,["/pkg-1.0.tar.gz"])
+            #  A second unpack comes straight from the cache.
+            shutil.rmtree(workdir)
+            env.unpack(url,workdir,md5)
+            self.assertEquals(sorted(os.listdir(updir)),["README","src"])
+            self.assertEquals(SlowHandler.requests,["/pkg-1.0.tar.gz"])
+
+    def test_unpack_recovers_from_bad_partial_download(self):
+        (url,md5) = self._publish_tarball("pkg-1.0.tar.gz",
+                                          [("pkg-1.0/README","hello")])
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            #  The test server ignores range requests, so this junk will
+            #  be overwritten after it has been streamed to the extractor.
+            with open(env.cache_path(url) + ".part","wb") as f:
+                f.write("junk" * 1000)
+            workdir = os.path.join(env.builddir,"pkg-1.0.tar.gz")
+            updir = env.unpack(url,workdir,md5)
+            self.assertEquals(os.listdir(workdir),["pkg-1.0"])
+            with open(os.path.join(updir,"README")) as f:
+                self.assertEquals(f.read(),"hello")
+
+    def test_unpack_extracts_each_archive_once(self):
+        (url,md5) = self._publish_tarball("pkg-1.0.tar.gz",
+                                          [("pkg-1.0/README","hello"),
+                                           ("pkg-1.0/src/a.c","int a;")])
+        calls = []
+        def counting_extract_file(path,workdir,select=None):
+            calls.append(path)
+            return extract_file(path,workdir,select)
+        extract_file = envs_base.extract_file
+        envs_base.extract_file = counting_extract_file
+        try:
+            with util.tempdir() as rootdir:
+                env = MyppyEnv(rootdir,"32bit")
+                env.fetch(url,md5)
+                for nm in ("a","b"):
+                    workdir = os.path.join(env.builddir,nm)
+                    updir = env.unpack(url,workdir,md5)
+                    with open(os.path.join(updir,"README")) as f:
+                        self.assertEquals(f.read(),"hello")
+                self.assertEquals(len(calls),1)
+                self.assertEquals(len(os.listdir(env.sources.rootdir)),1)
+                #  A different selection of members is extracted separately.
+                workdir = os.path.join(env.builddir,"c")
+                select = MemberFilter(exclude=["README"])
+                env.unpack(url,workdir,md5,select=select)
+                self.assertEquals(os.listdir(os.path.join(workdir,"pkg-1.0")),
+                                  ["src"])
+                self.assertEquals(len(calls),2)
+                self.assertEquals(len(os.listdir(env.sources.rootdir)),2)
+        finally:
+            envs_base.extract_file = extract_file
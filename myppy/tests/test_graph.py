@@ -0,0 +1,52 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+
+from __future__ import with_statement
+
+import unittest
+
+from myppy.graph import RecipeGraph
+
+
+class FakeRecipe(object):
+    def __init__(self,deps,build_deps=()):
+        self.DEPENDENCIES = list(deps)
+        self.BUILD_DEPENDENCIES = list(build_deps)
+
+
+RECIPES = {
+    "python27": FakeRecipe(["lib_zlib","lib_bz2"]),
+    "lib_zlib": FakeRecipe([]),
+    "lib_bz2": FakeRecipe([]),
+    "py_pip": FakeRecipe(["python27"]),
+    "py_pyside": FakeRecipe(["python27"],["cmake"]),
+    "cmake": FakeRecipe([]),
+}
+
+
+class TestRecipeGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.loaded = []
+        def load_recipe(recipe):
+            self.loaded.append(recipe)
+            return RECIPES[recipe]
+        self.graph = RecipeGraph(load_recipe)
+
+    def test_closure_is_memoized(self):
+        closure = self.graph.closure(["py_pip"])
+        self.assertEquals(closure,set(["py_pip","python27","lib_zlib",
+                                       "lib_bz2"]))
+        self.assertEquals(self.graph.closure(["py_pip"]),closure)
+        self.assertEquals(sorted(self.loaded),sorted(closure))
+
+    def test_build_dependencies_arent_in_closure(self):
+        self.assertEquals(self.graph.build_dependencies("py_pyside"),
+                          ["python27","cmake"])
+        self.assertFalse("cmake" in self.graph.closure(["py_pyside"]))
+
+    def test_dependents(self):
+        among = ["python27","lib_zlib","lib_bz2","py_pip"]
+        self.assertEquals(self.graph.dependents("lib_zlib",among),
+                          set(["python27","py_pip"]))
+        self.assertEquals(self.graph.dependents("py_pip",among),set())
@@ -0,0 +1,114 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+
+from __future__ import with_statement
+
+import os
+import sys
+import fcntl
+import struct
+import termios
+import unittest
+
+from myppy import util
+from myppy.jobserver import JobServer
+from myppy.envs.base import MyppyEnv
+from myppy.recipes.base import Recipe
+
+
+def free_tokens(jobserver):
+    """Count the tokens waiting in the jobserver pipe, without taking them."""
+    buf = fcntl.ioctl(jobserver.rfd,termios.FIONREAD,struct.pack("i",0))
+    return struct.unpack("i",buf)[0]
+
+
+class TestJobServer(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = os.environ.copy()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def test_size_comes_from_environment(self):
+        os.environ["MYPPY_MAKE_JOBS"] = "3"
+        jobserver = JobServer()
+        try:
+            self.assertEquals(jobserver.size,3)
+            self.assertEquals(free_tokens(jobserver),3)
+        finally:
+            jobserver.close()
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            self.assertEquals(free_tokens(env.jobserver),3)
+
+    def test_makeflags_reach_subprocesses(self):
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            outfile = os.path.join(rootdir,"makeflags")
+            code = "import os\n"
+            code += "flags = os.environ['MAKEFLAGS']\n"
+            code += "fds = flags.split('--jobserver-fds=')[1].split()[0]\n"
+            code += "(rfd,wfd) = map(int,fds.split(','))\n"
+            code += "os.write(wfd,os.read(rfd,1))\n"
+            code += "open(%r,'w').write(flags)\n" % (outfile,)
+            env.do(sys.executable,"-c",code)
+            with open(outfile) as f:
+                flags = f.read().split()
+            self.assertEquals(flags[0],"-j")
+            fds = "--jobserver-fds=%d,%d" % (env.jobserver.rfd,
+                                             env.jobserver.wfd,)
+            self.assertTrue(fds in flags)
+            self.assertEquals(free_tokens(env.jobserver),env.jobserver.size)
+
+    def test_build_holds_one_token(self):
+        os.environ["MYPPY_MAKE_JOBS"] = "2"
+        with util.tempdir() as rootdir:
+            env = MyppyEnv(rootdir,"32bit")
+            seen = []
+            class Build(object):
+                def __init__(self,fail):
+                    self.fail = fail
+                def build(self):
+                    seen.append(free_tokens(env.jobserver))
+                    if self.fail:
+                        raise RuntimeError("build failed")
+            env._build_recipe("ok",Build(False))
+            self.assertRaises(RuntimeError,env._build_recipe,"bad",Build(True))
+            self.assertEquals(seen,[1,1])
+            self.assertEquals(free_tokens(env.jobserver),2)
+
+
+class lib_serial(Recipe):
+    PARALLEL_MAKE = False
+
+
+class lib_parallel(Recipe):
+    pass
+
+
+class CommandRecorder(object):
+    """Fake env recording the commands it's asked to run."""
+    def __init__(self):
+        self.commands = []
+    def do(self,*cmdline,**kwds):
+        self.commands.append((cmdline,kwds.get("env",{})))
+
+
+class TestParallelMake(unittest.TestCase):
+
+    def _make(self,cls):
+        target = CommandRecorder()
+        r = cls(target)
+        r._get_builddir = lambda: "/build"
+        r._generic_make()
+        return target.commands[0]
+
+    def test_serial_recipes_run_one_job(self):
+        (cmd,env) = self._make(lib_serial)
+        self.assertTrue("-j1" in cmd)
+        self.assertEquals(env["MAKEFLAGS"],"")
+        (cmd,env) = self._make(lib_parallel)
+        self.assertFalse("-j1" in cmd)
+        self.assertFalse("MAKEFLAGS" in env)
@@ -9,6 +9,7 @@ import unittest
 from os.path import dirname
 
 import myppy
+from myppy import util
 
 
 class TestMyppy(unittest.TestCase):
@@ -34,3 +35,30 @@ class TestMyppy(unittest.TestCase):
             f.write(myppy.__doc__.encode())
             f.close()
 
+
+
+class TestJobsOption(unittest.TestCase):
+
+  def test_jobs_option_forms(self):
+    for opts in (["-j4"],["-j","4"],["--jobs","4"],["--jobs=4"]):
+      (jobs,args) = myppy._extract_jobs_option(["lib_a"] + opts + ["lib_b"])
+      self.assertEquals(jobs,4)
+      self.assertEquals(args,["lib_a","lib_b"])
+    self.assertEquals(myppy._extract_jobs_option(["lib_a"]),(None,["lib_a"]))
+
+  def test_malformed_jobs_option(self):
+    for opts in (["-j"],["--jobs"],["-jfoo"],["--jobs=x"],["--jobs="],
+                 ["-j","foo"],["-j0"]):
+      self.assertRaises(ValueError,myppy._extract_jobs_option,["lib_a"]+opts)
+    self.assertEquals(myppy.main(["myppy",".","install","-jfoo"]),1)
+
+
+class TestUsageErrors(unittest.TestCase):
+
+  def test_mirror_needs_a_directory(self):
+    with util.tempdir() as rootdir:
+      self.assertEquals(myppy.main(["myppy",rootdir,"mirror"]),1)
+
+  def test_update_rejects_unknown_options(self):
+    with util.tempdir() as rootdir:
+      self.assertEquals(myppy.main(["myppy",rootdir,"update","--bogus"]),1)
@@ -0,0 +1,153 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+
+from __future__ import with_statement
+
+import os
+import re
+import json
+import inspect
+import unittest
+
+from myppy import util
+from myppy.graph import RecipeGraph
+from myppy.recipes.base import Recipe
+from myppy.unpack import MemberFilter
+
+
+class FakeTarget(object):
+    PREFIX = "/nonexistent"
+    CFLAGS = "-Os"
+    def __init__(self,rootdir):
+        self.builddir = os.path.join(rootdir,"build")
+        self.graph = RecipeGraph(lambda recipe: RECIPES[recipe](self))
+    def cache_path(self,url):
+        return os.path.join("/cache",os.path.basename(url))
+    def recipe_fingerprint(self,recipe):
+        return recipe
+
+
+class lib_phases(Recipe):
+    SOURCE_URL = "http://example.com/phases-1.0.tar.gz"
+    MAKE_VARS = ("V=1",)
+    def __init__(self,target):
+        super(lib_phases,self).__init__(target)
+        self.ran = []
+        self.fail = None
+    def _run(self,phase):
+        self.ran.append(phase)
+        if phase == self.fail:
+            raise RuntimeError("%s failed" % (phase,))
+    def _unpack(self):
+        self._run("unpack")
+        if not os.path.isdir(self._get_updir()):
+            os.makedirs(self._get_updir())
+    def _patch(self):
+        self._run("patch")
+    def _configure(self):
+        self._run("configure")
+    def _make(self):
+        self._run("make")
+
+
+class lib_other_phases(lib_phases):
+    pass
+
+
+RECIPES = {"lib_phases": lib_phases, "lib_other_phases": lib_other_phases}
+
+
+class TestBuildPhases(unittest.TestCase):
+
+    def test_completed_phases_are_skipped(self):
+        with util.tempdir() as rootdir:
+            target = FakeTarget(rootdir)
+            r = lib_phases(target)
+            r.build()
+            self.assertEquals(r.ran,["unpack","patch","configure","make"])
+            r = lib_phases(target)
+            r.build()
+            self.assertEquals(r.ran,[])
+
+    def test_failed_phase_is_resumed(self):
+        with util.tempdir() as rootdir:
+            target = FakeTarget(rootdir)
+            r = lib_phases(target)
+            r.fail = "make"
+            self.assertRaises(RuntimeError,r.build)
+            r = lib_phases(target)
+            r.build()
+            self.assertEquals(r.ran,["make"])
+
+    def test_changed_inputs_invalidate_later_phases(self):
+        with util.tempdir() as rootdir:
+            target = FakeTarget(rootdir)
+            lib_phases(target).build()
+            target.CFLAGS = "-O2"
+            r = lib_phases(target)
+            r.build()
+            self.assertEquals(r.ran,["configure","make"])
+            r = lib_phases(target)
+            r.MAKE_VARS = ("V=0",)
+            r.build()
+            self.assertEquals(r.ran,["make"])
+
+    def test_repatching_needs_a_fresh_tree(self):
+        with util.tempdir() as rootdir:
+            target = FakeTarget(rootdir)
+            r = lib_phases(target)
+            r.build()
+            stampfile = r._get_updir() + ".myppy-stamps"
+            with open(stampfile,"rb") as f:
+                info = json.load(f)
+            info["stamps"]["patch"] = "stale"
+            with open(stampfile,"wb") as f:
+                json.dump(info,f)
+            r = lib_phases(target)
+            r.build()
+            self.assertEquals(r.ran,["unpack","patch","configure","make"])
+
+    def test_stamps_are_ignored_without_the_build_dir(self):
+        with util.tempdir() as rootdir:
+            target = FakeTarget(rootdir)
+            r = lib_phases(target)
+            r.build()
+            os.rmdir(r._get_updir())
+            r = lib_phases(target)
+            r.build()
+            self.assertEquals(r.ran,["unpack","patch","configure","make"])
+
+    def test_stamps_belong_to_last_recipe_in_dir(self):
+        with util.tempdir() as rootdir:
+            target = FakeTarget(rootdir)
+            lib_phases(target).build()
+            r = lib_other_phases(target)
+            r.build()
+            self.assertEquals(r.ran,["unpack","patch","configure","make"])
+            r = lib_phases(target)
+            r.build()
+            self.assertEquals(r.ran,["unpack","patch","configure","make"])
+
+
+class TestSourceSelection(unittest.TestCase):
+
+    def test_patched_files_are_not_excluded(self):
+        from myppy.recipes import base, linux, macosx
+        patch_re = re.compile(r"_patch_build_file\(\s*[\"']([^\"']+)[\"']")
+        checked = 0
+        for mod in (base,linux,macosx):
+            for (nm,cls) in sorted(vars(mod).items()):
+                if not isinstance(cls,type) or not issubclass(cls,Recipe):
+                    continue
+                select = MemberFilter(cls.SOURCE_INCLUDE,cls.SOURCE_EXCLUDE)
+                if not select:
+                    continue
+                for klass in cls.__mro__:
+                    if not issubclass(klass,Recipe) or klass is Recipe:
+                        continue
+                    for relpath in patch_re.findall(inspect.getsource(klass)):
+                        checked += 1
+                        msg = "%s.%s patches excluded file %s"
+                        msg %= (mod.__name__,nm,relpath,)
+                        self.assertTrue(select("top/" + relpath),msg)
+        self.assertTrue(checked > 0)
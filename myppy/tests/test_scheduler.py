@@ -0,0 +1,81 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+
+from __future__ import with_statement
+
+import os
+import time
+import unittest
+
+from myppy import util
+from myppy.scheduler import Scheduler
+
+
+DEPS = {
+    "python27": set(["lib_zlib","lib_bz2","lib_readline"]),
+    "lib_zlib": set(),
+    "lib_bz2": set(),
+    "lib_readline": set(),
+    "py_pip": set(["python27"]),
+}
+
+ORDER = ["lib_zlib","lib_bz2","lib_readline","python27","py_pip"]
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_inline_run_follows_given_order(self):
+        calls = []
+        work = lambda node: calls.append(("work",node))
+        finish = lambda node: calls.append(("finish",node))
+        Scheduler(DEPS,ORDER).run(work,finish)
+        expected = []
+        for node in ORDER:
+            expected.extend([("work",node),("finish",node)])
+        self.assertEquals(calls,expected)
+
+    def test_forked_run_respects_dependencies(self):
+        with util.tempdir() as workdir:
+            def work(node):
+                start = time.time()
+                time.sleep(0.2)
+                with open(os.path.join(workdir,node),"w") as f:
+                    f.write("%r %r" % (start,time.time()))
+            finished = []
+            def finish(node):
+                with open(os.path.join(workdir,node)) as f:
+                    (start,end) = map(float,f.read().split())
+                for dep in DEPS[node]:
+                    self.assertTrue(dep in finished)
+                finished.append(node)
+            t0 = time.time()
+            Scheduler(DEPS,ORDER,jobs=3).run(work,finish)
+            self.assertEquals(sorted(finished),sorted(ORDER))
+            #  The three libs should have been built side-by-side.
+            self.assertTrue(time.time() - t0 < 0.2 * len(ORDER))
+
+    def test_nodes_with_same_key_dont_overlap(self):
+        deps = {"a": set(), "b": set()}
+        with util.tempdir() as workdir:
+            lockfile = os.path.join(workdir,"lock")
+            def work(node):
+                fd = os.open(lockfile,os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+                time.sleep(0.1)
+                os.close(fd)
+                os.unlink(lockfile)
+            sched = Scheduler(deps,jobs=2,keyfunc=lambda node: "shared")
+            sched.run(work,lambda node: None)
+
+    def test_failed_work_raises_error(self):
+        def work(node):
+            if node == "lib_bz2":
+                raise ValueError("broken")
+        finished = []
+        sched = Scheduler(DEPS,ORDER,jobs=2)
+        self.assertRaises(RuntimeError,sched.run,work,finished.append)
+        self.assertFalse("python27" in finished)
+
+    def test_cycle_is_detected(self):
+        deps = {"a": set(["b"]), "b": set(["a"])}
+        sched = Scheduler(deps)
+        self.assertRaises(RuntimeError,sched.run,lambda n:None,lambda n:None)
@@ -0,0 +1,324 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+
+from __future__ import with_statement
+
+import os
+import bz2
+import gzip
+import stat
+import time
+import shutil
+import tarfile
+import zipfile
+import hashlib
+import threading
+import unittest
+import subprocess
+from StringIO import StringIO
+
+from myppy import util
+from myppy import unpack
+
+
+def make_tree(srcdir):
+    os.makedirs(os.path.join(srcdir,"pkg-1.0","src"))
+    with open(os.path.join(srcdir,"pkg-1.0","configure"),"wb") as f:
+        f.write("#!/bin/sh\n")
+    os.chmod(os.path.join(srcdir,"pkg-1.0","configure"),0755)
+    with open(os.path.join(srcdir,"pkg-1.0","src","main.c"),"wb") as f:
+        f.write("int main() { return 0; }\n")
+    os.symlink("main.c",os.path.join(srcdir,"pkg-1.0","src","link.c"))
+
+
+def check_tree(test,workdir):
+    test.assertEquals(os.listdir(workdir),["pkg-1.0"])
+    updir = os.path.join(workdir,"pkg-1.0")
+    test.assertTrue(os.stat(os.path.join(updir,"configure")).st_mode
+                    & stat.S_IXUSR)
+    test.assertEquals(os.readlink(os.path.join(updir,"src","link.c")),
+                      "main.c")
+    with open(os.path.join(updir,"src","main.c")) as f:
+        test.assertEquals(f.read(),"int main() { return 0; }\n")
+
+
+class TestExtract(unittest.TestCase):
+
+    def _make_tarball(self,tmpdir,mode,ext):
+        srcdir = os.path.join(tmpdir,"src")
+        make_tree(srcdir)
+        path = os.path.join(tmpdir,"pkg-1.0.tar" + ext)
+        tf = tarfile.open(path,mode)
+        tf.add(os.path.join(srcdir,"pkg-1.0"),"pkg-1.0")
+        tf.close()
+        return path
+
+    def _check_extract(self,mode,ext):
+        with util.tempdir() as tmpdir:
+            path = self._make_tarball(tmpdir,mode,ext)
+            workdir = os.path.join(tmpdir,"work")
+            os.mkdir(workdir)
+            unpack.extract_file(path,workdir)
+            check_tree(self,workdir)
+
+    def test_extract_gz(self):
+        self._check_extract("w:gz",".gz")
+
+    def test_extract_bz2(self):
+        self._check_extract("w:bz2",".bz2")
+
+    def test_extract_tar(self):
+        self._check_extract("w","")
+
+    def test_extract_xz(self):
+        if util.which("xz") is None:
+            return
+        with util.tempdir() as tmpdir:
+            path = self._make_tarball(tmpdir,"w","")
+            subprocess.check_call(["xz",path])
+            workdir = os.path.join(tmpdir,"work")
+            os.mkdir(workdir)
+            unpack.extract_file(path + ".xz",workdir)
+            check_tree(self,workdir)
+
+    def test_extract_zip(self):
+        with util.tempdir() as tmpdir:
+            srcdir = os.path.join(tmpdir,"src")
+            make_tree(srcdir)
+            path = os.path.join(tmpdir,"pkg-1.0.zip")
+            zf = zipfile.ZipFile(path,"w")
+            for (dirnm,_,filenms) in os.walk(srcdir):
+                for nm in filenms:
+                    fpath = os.path.join(dirnm,nm)
+                    arcnm = os.path.relpath(fpath,srcdir)
+                    if os.path.islink(fpath):
+                        zinfo = zipfile.ZipInfo(arcnm)
+                        zinfo.external_attr = (stat.S_IFLNK | 0777) << 16
+                        zf.writestr(zinfo,os.readlink(fpath))
+                    else:
+                        zf.write(fpath,arcnm)
+            zf.close()
+            workdir = os.path.join(tmpdir,"work")
+            os.mkdir(workdir)
+            unpack.extract_file(path,workdir)
+            check_tree(self,workdir)
+
+    def test_extract_selected_members(self):
+        with util.tempdir() as tmpdir:
+            path = self._make_tarball(tmpdir,"w:gz",".gz")
+            workdir = os.path.join(tmpdir,"work")
+            os.mkdir(workdir)
+            select = unpack.MemberFilter(exclude=["src/*.c"])
+            unpack.extract_file(path,workdir,select)
+            self.assertEquals(sorted(os.listdir(os.path.join(workdir,
+                                                             "pkg-1.0"))),
+                              ["configure","src"])
+            self.assertEquals(os.listdir(os.path.join(workdir,"pkg-1.0",
+                                                      "src")),[])
+
+    def test_member_filter(self):
+        select = unpack.MemberFilter(include=["src","doc/*.txt"],
+                                     exclude=["src/3rdparty"])
+        self.assertTrue(select("pkg/"))
+        self.assertTrue(select("./pkg/src/main.c"))
+        self.assertTrue(select("pkg/doc/README.txt"))
+        self.assertFalse(select("pkg/doc/index.html"))
+        self.assertFalse(select("pkg/src/3rdparty/zlib/zlib.h"))
+        self.assertFalse(select("pkg/examples"))
+        self.assertFalse(unpack.MemberFilter())
+        self.assertEquals(unpack.MemberFilter().key,"")
+        self.assertNotEquals(select.key,
+                             unpack.MemberFilter(include=["src"]).key)
+
+    def test_unsafe_paths_are_refused(self):
+        with util.tempdir() as tmpdir:
+            path = os.path.join(tmpdir,"evil.tar")
+            tf = tarfile.open(path,"w")
+            tinfo = tarfile.TarInfo("../evil")
+            tf.addfile(tinfo)
+            tf.close()
+            workdir = os.path.join(tmpdir,"work")
+            os.mkdir(workdir)
+            self.assertRaises(ValueError,unpack.extract_file,path,workdir)
+            self.assertFalse(os.path.exists(os.path.join(tmpdir,"evil")))
+
+    def test_symlinks_out_of_workdir_are_not_followed(self):
+        with util.tempdir() as tmpdir:
+            outside = os.path.join(tmpdir,"outside")
+            os.mkdir(outside)
+            for members in ([("pkg/a",tarfile.SYMTYPE,outside),
+                             ("pkg/a/x",tarfile.REGTYPE,"evil")],
+                            [("pkg/a",tarfile.SYMTYPE,outside + "/x"),
+                             ("pkg/a",tarfile.REGTYPE,"evil")]):
+                path = os.path.join(tmpdir,"evil.tar")
+                tf = tarfile.open(path,"w")
+                for (name,type,data) in members:
+                    tinfo = tarfile.TarInfo(name)
+                    tinfo.type = type
+                    if type == tarfile.SYMTYPE:
+                        tinfo.linkname = data
+                        tf.addfile(tinfo)
+                    else:
+                        tinfo.size = len(data)
+                        tf.addfile(tinfo,StringIO(data))
+                tf.close()
+                workdir = os.path.join(tmpdir,"work")
+                os.mkdir(workdir)
+                try:
+                    unpack.extract_file(path,workdir)
+                except ValueError:
+                    pass
+                self.assertEquals(os.listdir(outside),[])
+                shutil.rmtree(workdir)
+
+
+class TestDecompressors(unittest.TestCase):
+
+    DATA = ["block %d " % (i,) * 5000 for i in xrange(20)]
+
+    def _read(self,decompressor,compressed,fmt):
+        stream = decompressor.open(StringIO(compressed),fmt)
+        output = []
+        chunk = stream.read()
+        while chunk:
+            output.append(chunk)
+            chunk = stream.read()
+        stream.close()
+        self.assertEquals(stream.nbytes_in,len(compressed))
+        self.assertEquals(stream.nbytes_out,len("".join(output)))
+        return (stream,"".join(output))
+
+    def _gzip(self,data):
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf,mode="wb")
+        f.write(data)
+        f.close()
+        return buf.getvalue()
+
+    def test_python_handles_multiple_members(self):
+        d = unpack.PythonDecompressor()
+        compressed = "".join(self._gzip(data) for data in self.DATA)
+        (_,output) = self._read(d,compressed + "\0" * 100,"gz")
+        self.assertEquals(output,"".join(self.DATA))
+        compressed = "".join(bz2.compress(data) for data in self.DATA)
+        (_,output) = self._read(d,compressed,"bz2")
+        self.assertEquals(output,"".join(self.DATA))
+
+    def test_parallel_bz2_multi_stream(self):
+        d = unpack.ParallelBZ2Decompressor(threads=4)
+        compressed = "".join(bz2.compress(data) for data in self.DATA)
+        (stream,output) = self._read(d,compressed,"bz2")
+        self.assertEquals(output,"".join(self.DATA))
+        self.assertEquals(stream.name,"python-parallel")
+
+    def test_parallel_bz2_single_stream_is_serial(self):
+        d = unpack.ParallelBZ2Decompressor(threads=4)
+        (stream,output) = self._read(d,bz2.compress("".join(self.DATA)),"bz2")
+        self.assertEquals(output,"".join(self.DATA))
+        self.assertEquals(stream.name,"python")
+
+    def test_parallel_bz2_truncated_stream(self):
+        d = unpack.ParallelBZ2Decompressor(threads=4)
+        compressed = "".join(bz2.compress(data) for data in self.DATA)
+        self.assertRaises(IOError,self._read,d,compressed[:-10],"bz2")
+
+    def test_command_decompressor(self):
+        d = unpack.CommandDecompressor("gzip",("gz",),["gzip","-dc"])
+        (_,output) = self._read(d,self._gzip("".join(self.DATA)),"gz")
+        self.assertEquals(output,"".join(self.DATA))
+        d = unpack.CommandDecompressor("gzip",("gz",),["gzip","-dc"])
+        self.assertRaises(subprocess.CalledProcessError,
+                          self._read,d,"not gzipped","gz")
+
+    def test_preferred_decompressor(self):
+        os.environ["MYPPY_DECOMPRESSOR"] = "python"
+        try:
+            self.assertEquals(unpack.find_decompressor("bz2").name,"python")
+        finally:
+            del os.environ["MYPPY_DECOMPRESSOR"]
+        self.assertRaises(RuntimeError,unpack.find_decompressor,"lzma")
+
+
+class TestFollowFile(unittest.TestCase):
+
+    def test_follows_file_until_renamed(self):
+        with util.tempdir() as tmpdir:
+            path = os.path.join(tmpdir,"data")
+            chunks = ["chunk%d" % (i,) for i in xrange(5)]
+            def write():
+                with open(path + ".part","wb") as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                        f.flush()
+                        time.sleep(0.02)
+                os.rename(path + ".part",path)
+            writer = threading.Thread(target=write)
+            writer.start()
+            f = unpack.FollowFile(path + ".part",path,writer.isAlive)
+            data = []
+            chunk = f.read(3)
+            while chunk:
+                data.append(chunk)
+                chunk = f.read(3)
+            f.close()
+            writer.join()
+            self.assertEquals("".join(data),"".join(chunks))
+            sha256 = hashlib.sha256("".join(chunks)).hexdigest()
+            self.assertTrue(f.matches(len("".join(chunks)),sha256))
+
+    def test_abandoned_download_is_an_error(self):
+        with util.tempdir() as tmpdir:
+            path = os.path.join(tmpdir,"data")
+            with open(path + ".part","wb") as f:
+                f.write("partial")
+            f = unpack.FollowFile(path + ".part",path,lambda: False)
+            self.assertEquals(f.read(),"partial")
+            self.assertRaises(IOError,f.read)
+            f.close()
+
+
+class TestPristineStore(unittest.TestCase):
+
+    def _make_store(self,tmpdir,mode):
+        store = unpack.PristineStore(os.path.join(tmpdir,"store"),mode)
+        srcdir = store.tempdir()
+        make_tree(srcdir)
+        store.commit(srcdir,"key")
+        return store
+
+    def _check_checkout(self,mode):
+        with util.tempdir() as tmpdir:
+            store = self._make_store(tmpdir,mode)
+            self.assertTrue(store.has("key"))
+            workdir = os.path.join(tmpdir,"work")
+            #  Stale files from an earlier build are replaced.
+            os.makedirs(os.path.join(workdir,"pkg-1.0"))
+            with open(os.path.join(workdir,"pkg-1.0","configure"),"wb") as f:
+                f.write("stale")
+            store.checkout("key",workdir)
+            check_tree(self,workdir)
+            fpath = os.path.join(workdir,"pkg-1.0","src","main.c")
+            pristine = os.path.join(store.path("key"),"pkg-1.0","src","main.c")
+            linked = os.path.samefile(fpath,pristine)
+            self.assertEquals(linked,mode == "hardlink")
+
+    def test_checkout_reflink(self):
+        self._check_checkout("reflink")
+
+    def test_checkout_copy(self):
+        self._check_checkout("copy")
+
+    def test_checkout_hardlink(self):
+        self._check_checkout("hardlink")
+
+    def test_concurrent_commit_is_discarded(self):
+        with util.tempdir() as tmpdir:
+            store = self._make_store(tmpdir,"copy")
+            other = store.tempdir()
+            open(os.path.join(other,"other"),"w").close()
+            store.commit(other,"key")
+            self.assertFalse(os.path.exists(other))
+            self.assertEquals(os.listdir(store.path("key")),["pkg-1.0"])
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError,unpack.PristineStore,"store","overlay")
@@ -0,0 +1,103 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+
+from __future__ import with_statement
+
+import os
+import stat
+import unittest
+
+from myppy import util
+from myppy.recipes.base import Recipe
+
+
+def replace(old,new):
+    def filter(lines):
+        for ln in lines:
+            yield ln.replace(old,new)
+    return filter
+
+
+def drop_line_after(marker):
+    def filter(lines):
+        for ln in lines:
+            yield ln
+            if ln.strip() == marker:
+                lines.next()
+    return filter
+
+
+class FakeTarget(object):
+    PREFIX = "/nonexistent"
+
+
+class TestPatchSession(unittest.TestCase):
+
+    def _write(self,tmpdir,content,mode=0644):
+        fpath = os.path.join(tmpdir,"Makefile")
+        with open(fpath,"wt") as f:
+            f.write(content)
+        os.chmod(fpath,mode)
+        return fpath
+
+    def _read(self,fpath):
+        with open(fpath,"rt") as f:
+            return f.read()
+
+    def test_filters_are_chained_in_one_write(self):
+        with util.tempdir() as tmpdir:
+            fpath = self._write(tmpdir,"CFLAGS=-O2\nskip:\ngone\nend\n",0755)
+            ino = os.stat(fpath).st_ino
+            with util.PatchSession() as session:
+                session.add(fpath,replace("-O2","-Os"))
+                session.add(fpath,drop_line_after("skip:"))
+                session.add(fpath,replace("-Os","-Os -g"))
+                #  Nothing is written until the session ends.
+                self.assertEquals(os.stat(fpath).st_ino,ino)
+            self.assertEquals(self._read(fpath),"CFLAGS=-Os -g\nskip:\nend\n")
+            self.assertNotEquals(os.stat(fpath).st_ino,ino)
+            self.assertEquals(stat.S_IMODE(os.stat(fpath).st_mode),0755)
+            self.assertEquals(os.listdir(tmpdir),["Makefile"])
+
+    def test_unchanged_file_is_not_rewritten(self):
+        with util.tempdir() as tmpdir:
+            fpath = self._write(tmpdir,"CFLAGS=-Os\n")
+            ino = os.stat(fpath).st_ino
+            session = util.PatchSession()
+            session.add(fpath,replace("-O2","-Os"))
+            self.assertEquals(session.apply(),[])
+            self.assertEquals(os.stat(fpath).st_ino,ino)
+
+    def test_failed_filter_leaves_file_alone(self):
+        def broken(lines):
+            for ln in lines:
+                yield ln
+            raise ValueError("broken")
+        with util.tempdir() as tmpdir:
+            fpath = self._write(tmpdir,"CFLAGS=-O2\n")
+            session = util.PatchSession()
+            session.add(fpath,replace("-O2","-Os"))
+            session.add(fpath,broken)
+            self.assertRaises(ValueError,session.apply)
+            self.assertEquals(self._read(fpath),"CFLAGS=-O2\n")
+            self.assertEquals(os.listdir(tmpdir),["Makefile"])
+
+    def test_recipe_patches_are_batched(self):
+        with util.tempdir() as tmpdir:
+            fpath = self._write(tmpdir,"CFLAGS=-O2\n")
+            r = Recipe(FakeTarget())
+            applied = []
+            def record(lines):
+                applied.append(fpath)
+                return lines
+            with r._patching():
+                r._patch_file(fpath,replace("-O2","-Os"))
+                with r._patching():
+                    r._patch_file(fpath,record)
+                self.assertEquals(applied,[])
+                self.assertEquals(self._read(fpath),"CFLAGS=-O2\n")
+            self.assertEquals(applied,[fpath])
+            self.assertEquals(self._read(fpath),"CFLAGS=-Os\n")
+            #  Outside of a batch, patches are applied immediately.
+            r._patch_file(fpath,replace("-Os","-O3"))
+            self.assertEquals(self._read(fpath),"CFLAGS=-O3\n")
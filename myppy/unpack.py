@@ -0,0 +1,700 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.unpack:  in-process extraction and storage of source archives
+
+"""
+
+from __future__ import with_statement
+
+import os
+import stat
+import time
+import errno
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import re
+import bz2
+import zlib
+import fnmatch
+import posixpath
+import threading
+import subprocess
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from myppy import util
+
+
+#  Size of the chunks read from archives and the pipes feeding them.
+CHUNK_SIZE = 1024 * 64
+
+
+def archive_format(name):
+    """Get the format of an archive from its filename.
+
+    This is one of "gz", "bz2", "xz", "zip" or "tar".
+    """
+    if name.endswith(".bz2") or name.endswith(".tbz"):
+        return "bz2"
+    if name.endswith(".gz") or name.endswith(".tgz"):
+        return "gz"
+    if name.endswith(".xz") or name.endswith(".txz"):
+        return "xz"
+    if name.endswith(".zip"):
+        return "zip"
+    return "tar"
+
+
+def can_stream(name):
+    """Check whether an archive can be extracted as its bytes arrive.
+
+    Zipfiles keep their index at the end, so they can't be.
+    """
+    return archive_format(name) != "zip"
+
+
+def extract_file(path,workdir,select=None):
+    """Extract the archive at the given path into workdir.
+
+    If given, select is a function that's called with the path of each
+    member of the archive, and returns false for those to be skipped.
+    """
+    if archive_format(path) == "zip":
+        _extract_zip(path,workdir,select)
+    else:
+        with open(path,"rb") as f:
+            extract_stream(f,path,workdir,select)
+
+
+def extract_stream(fileobj,name,workdir,select=None):
+    """Extract a tarball into workdir, reading it sequentially from fileobj.
+
+    The compression is determined from the given filename, and undone by
+    the best available decompressor for that format.  Once the tarball
+    has been extracted, the rest of fileobj is read and discarded, so that
+    anything watching the bytes go past sees all of them.  Members can be
+    skipped using a select function, as for extract_file().
+    """
+    fmt = archive_format(name)
+    if fmt == "zip":
+        raise ValueError("can't extract a zipfile from a stream: %s" % (name,))
+    if fmt == "tar":
+        _extract_tar_stream(fileobj,workdir,select)
+    else:
+        decompressor = find_decompressor(fmt)
+        t0 = time.time()
+        stream = decompressor.open(fileobj,fmt)
+        try:
+            _extract_tar_stream(stream,workdir,select)
+            _drain(stream)
+        finally:
+            stream.close()
+        _report(name,stream,time.time() - t0)
+    _drain(fileobj)
+
+
+def _report(name,stream,elapsed):
+    """Print the throughput achieved by a decompressor."""
+    mb_in = stream.nbytes_in / (1024.0 * 1024)
+    mb_out = stream.nbytes_out / (1024.0 * 1024)
+    print "DECOMPRESSED %s WITH %s: %.1fMB -> %.1fMB in %.2fs (%.1fMB/s)" \
+          % (os.path.basename(name),stream.name,mb_in,mb_out,elapsed,
+             mb_out / max(elapsed,0.001),)
+
+
+def _extract_tar_stream(fileobj,workdir,select=None):
+    tf = tarfile.open(fileobj=fileobj,mode="r|",bufsize=CHUNK_SIZE)
+    try:
+        tf.extractall(workdir,members=_safe_members(tf,workdir,select))
+    finally:
+        tf.close()
+
+
+def _safe_members(tf,workdir,select=None):
+    """Iterate over the selected members of a tarfile, refusing any that
+    would be extracted outside of workdir.
+
+    Each member is extracted before the next is read, so symlinks from
+    earlier members are on disk and can be checked for here.
+    """
+    root = os.path.abspath(workdir) + os.sep
+    realroot = os.path.realpath(workdir)
+    for tinfo in tf:
+        target = os.path.abspath(os.path.join(workdir,tinfo.name))
+        if not (target + os.sep).startswith(root):
+            raise ValueError("unsafe path in archive: %s" % (tinfo.name,))
+        #  Don't follow symlinks from earlier members out of the workdir.
+        parent = os.path.realpath(os.path.dirname(target))
+        if parent != realroot and not parent.startswith(realroot + os.sep):
+            raise ValueError("unsafe path in archive: %s" % (tinfo.name,))
+        if select is None or select(tinfo.name):
+            #  Replace a symlink rather than writing through it.
+            if os.path.islink(target):
+                os.unlink(target)
+            yield tinfo
+
+
+def _extract_zip(path,workdir,select=None):
+    """Extract a zipfile, keeping unix file modes and symlinks."""
+    zf = zipfile.ZipFile(path)
+    try:
+        for zinfo in zf.infolist():
+            if select is not None and not select(zinfo.filename):
+                continue
+            target = zf.extract(zinfo,workdir)
+            mode = zinfo.external_attr >> 16
+            if stat.S_ISLNK(mode):
+                with open(target,"rb") as f:
+                    link = f.read()
+                os.unlink(target)
+                os.symlink(link,target)
+            elif mode and not os.path.isdir(target):
+                os.chmod(target,stat.S_IMODE(mode))
+    finally:
+        zf.close()
+
+
+class MemberFilter(object):
+    """Select archive members by include and exclude patterns.
+
+    Patterns are matched with fnmatch against member paths relative to
+    the top-level directory of the archive, e.g. "doc" or "examples/*",
+    and a member is matched if its own path or that of any directory it's
+    in matches.  If any include patterns are given, only the members they
+    match are selected.  Members matched by an exclude pattern never are.
+    """
+
+    def __init__(self,include=None,exclude=()):
+        if include is not None:
+            include = tuple(include)
+        self.include = include
+        self.exclude = tuple(exclude)
+
+    def __nonzero__(self):
+        return self.include is not None or bool(self.exclude)
+
+    @property
+    def key(self):
+        """A short string identifying this filter, "" if it selects all."""
+        if not self:
+            return ""
+        return hashlib.sha1(repr((self.include,self.exclude))).hexdigest()[:12]
+
+    def __call__(self,name):
+        parts = posixpath.normpath(name).split("/")[1:]
+        if not parts:
+            return True
+        paths = ["/".join(parts[:i]) for i in xrange(1,len(parts)+1)]
+        for pattern in self.exclude:
+            for path in paths:
+                if fnmatch.fnmatchcase(path,pattern):
+                    return False
+        if self.include is None:
+            return True
+        for pattern in self.include:
+            for path in paths:
+                if fnmatch.fnmatchcase(path,pattern):
+                    return True
+        return False
+
+
+def _drain(fileobj):
+    while fileobj.read(CHUNK_SIZE):
+        pass
+
+
+def find_decompressor(fmt):
+    """Find the best available decompressor for the given format.
+
+    Decompressors are tried in the order of DECOMPRESSORS, except that one
+    named in $MYPPY_DECOMPRESSOR is tried first.
+    """
+    preferred = os.environ.get("MYPPY_DECOMPRESSOR")
+    candidates = sorted(DECOMPRESSORS,key=lambda d: d.name != preferred)
+    for decompressor in candidates:
+        if fmt in decompressor.formats and decompressor.available():
+            return decompressor
+    raise RuntimeError("no decompressor available for %s files" % (fmt,))
+
+
+class Decompressor(object):
+    """A way to decompress one or more compressed formats.
+
+    Calling open() with a file-like object of compressed data and its format
+    gives a DecompressedStream from which the decompressed data can be read.
+    """
+
+    def __init__(self,name,formats):
+        self.name = name
+        self.formats = formats
+
+    def available(self):
+        return True
+
+    def open(self,fileobj,fmt):
+        raise NotImplementedError
+
+
+class DecompressedStream(object):
+    """A file-like object of decompressed data, for reading sequentially.
+
+    This counts the bytes read in and out, so the throughput of each
+    decompressor can be reported.  Subclasses implement _decompress(),
+    which returns the next chunk of decompressed data or "" at the end.
+    """
+
+    def __init__(self,name,fileobj):
+        self.name = name
+        self.fileobj = fileobj
+        self.nbytes_in = 0
+        self.nbytes_out = 0
+
+    def _read_input(self,size=CHUNK_SIZE):
+        data = self.fileobj.read(size)
+        self.nbytes_in += len(data)
+        return data
+
+    def read(self,size=CHUNK_SIZE):
+        data = self._decompress()
+        self.nbytes_out += len(data)
+        return data
+
+    def _decompress(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CommandDecompressor(Decompressor):
+    """Decompress by piping the data through an external command."""
+
+    def __init__(self,name,formats,cmdline):
+        super(CommandDecompressor,self).__init__(name,formats)
+        self.cmdline = cmdline
+
+    def available(self):
+        return util.which(self.cmdline[0]) is not None
+
+    def open(self,fileobj,fmt):
+        return _CommandStream(self.name,fileobj,self.cmdline)
+
+
+class _CommandStream(DecompressedStream):
+
+    def __init__(self,name,fileobj,cmdline):
+        super(_CommandStream,self).__init__(name,fileobj)
+        self.cmdline = cmdline
+        self._proc = subprocess.Popen(cmdline,stdin=subprocess.PIPE,
+                                              stdout=subprocess.PIPE)
+        self._errors = []
+        self._feeder = threading.Thread(target=self._feed)
+        self._feeder.start()
+
+    def _feed(self):
+        try:
+            try:
+                chunk = self._read_input()
+                while chunk:
+                    self._proc.stdin.write(chunk)
+                    chunk = self._read_input()
+            finally:
+                self._proc.stdin.close()
+        except Exception, e:
+            self._errors.append(e)
+
+    def _decompress(self):
+        return os.read(self._proc.stdout.fileno(),CHUNK_SIZE)
+
+    def close(self):
+        self._proc.stdout.close()
+        self._feeder.join()
+        retcode = self._proc.wait()
+        if self._errors:
+            raise self._errors[0]
+        if retcode != 0:
+            raise subprocess.CalledProcessError(retcode,self.cmdline)
+
+
+#  Leading bytes of each gzip member or bzip2 stream.
+_MAGIC = {"gz":"\x1f\x8b","bz2":"BZh"}
+
+
+class PythonDecompressor(Decompressor):
+    """Decompress in-process with the zlib and bz2 modules."""
+
+    def __init__(self,name="python",formats=("gz","bz2",)):
+        super(PythonDecompressor,self).__init__(name,formats)
+
+    def open(self,fileobj,fmt):
+        return _PythonStream(self.name,fileobj,fmt)
+
+
+class _PythonStream(DecompressedStream):
+    """Decompress gzip or bzip2 data that may have several members.
+
+    Anything after the last member that doesn't look like the start of
+    another one is ignored, just like the gzip tool does.
+    """
+
+    def __init__(self,name,fileobj,fmt):
+        super(_PythonStream,self).__init__(name,fileobj)
+        self.fmt = fmt
+        self._decomp = None
+        self._tail = ""
+        self._garbage = False
+
+    def _new_decompressor(self):
+        if self.fmt == "gz":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return bz2.BZ2Decompressor()
+
+    def _decompress(self):
+        while True:
+            data = self._read_input()
+            if not data:
+                return ""
+            if self._garbage:
+                continue
+            out = self._decompress_data(self._tail + data)
+            if out:
+                return out
+
+    def _decompress_data(self,data):
+        self._tail = ""
+        output = []
+        magic = _MAGIC[self.fmt]
+        while data:
+            if self._decomp is None:
+                if len(data) < len(magic) and magic.startswith(data):
+                    self._tail = data
+                    break
+                if not data.startswith(magic):
+                    self._garbage = True
+                    break
+                self._decomp = self._new_decompressor()
+            try:
+                output.append(self._decomp.decompress(data))
+            except EOFError:
+                #  A bzip2 stream ended exactly at the previous chunk.
+                self._decomp = None
+                continue
+            data = self._decomp.unused_data
+            if data:
+                self._decomp = None
+        return "".join(output)
+
+
+class ParallelBZ2Decompressor(PythonDecompressor):
+    """Decompress multi-stream bzip2 data with a pool of threads.
+
+    Files compressed by pbzip2 and friends are made up of many independent
+    bzip2 streams, which can be decompressed in parallel; the bz2 module
+    releases the GIL while it works.  Ordinary bzip2 files are a single
+    stream, and are detected early and decompressed serially.
+    """
+
+    def __init__(self,name="python-parallel",threads=None):
+        super(ParallelBZ2Decompressor,self).__init__(name,("bz2",))
+        if threads is None:
+            threads = multiprocessing.cpu_count()
+        self.threads = threads
+
+    def available(self):
+        return self.threads > 1
+
+    def open(self,fileobj,fmt):
+        return _ParallelBZ2Stream(self.name,fileobj,self.threads)
+
+
+#  Start of a bzip2 stream, including the magic number of its first block.
+_BZ2_STREAM_RE = re.compile(r"BZh[1-9]1AY&SY")
+
+#  Give up looking for a second bzip2 stream after this many bytes.
+_BZ2_MAX_PROBE = 4 * 1024 * 1024
+
+
+class _ParallelBZ2Stream(DecompressedStream):
+
+    def __init__(self,name,fileobj,threads):
+        super(_ParallelBZ2Stream,self).__init__(name,fileobj)
+        self.threads = threads
+        self._pool = None
+        self._results = collections.deque()
+        self._segments = None
+        self._serial = None
+        self._buf = ""
+        self._eof = False
+
+    def _start(self):
+        """Read ahead until a second stream is found, or give up."""
+        while not self._eof and len(self._buf) < _BZ2_MAX_PROBE:
+            if _BZ2_STREAM_RE.search(self._buf,1) is not None:
+                self._pool = ThreadPool(self.threads)
+                self._segments = self._split()
+                return
+            self._fill()
+        self._serial = _PythonStream(self.name,_Prefixed(self._buf,self),"bz2")
+        self.name = "python"
+        self._buf = ""
+
+    def _fill(self):
+        data = self._read_input(1024*256)
+        if data:
+            self._buf += data
+        else:
+            self._eof = True
+
+    def _split(self):
+        """Generate the compressed data of each bzip2 stream."""
+        while True:
+            m = _BZ2_STREAM_RE.search(self._buf,1)
+            if m is not None:
+                yield self._buf[:m.start()]
+                self._buf = self._buf[m.start():]
+            elif self._eof:
+                if self._buf:
+                    yield self._buf
+                self._buf = ""
+                return
+            else:
+                self._fill()
+
+    def _decompress(self):
+        if self._pool is None and self._serial is None:
+            self._start()
+        if self._serial is not None:
+            return self._serial._decompress()
+        while len(self._results) < self.threads * 2:
+            try:
+                segment = self._segments.next()
+            except StopIteration:
+                break
+            result = self._pool.apply_async(_decompress_bz2_stream,(segment,))
+            self._results.append(result)
+        if not self._results:
+            return ""
+        return self._results.popleft().get()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+
+
+class _Prefixed(object):
+    """Read some buffered data, then the rest of a stream's input."""
+
+    def __init__(self,prefix,stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self,size=CHUNK_SIZE):
+        if self.prefix:
+            (data,self.prefix) = (self.prefix,"")
+            return data
+        return self.stream._read_input(size)
+
+
+def _decompress_bz2_stream(data):
+    """Decompress data that must hold one complete bzip2 stream.
+
+    A sentinel byte is appended, which only ends up in unused_data if the
+    stream was complete.  Any other trailing data is ignored.
+    """
+    decomp = bz2.BZ2Decompressor()
+    output = decomp.decompress(data + "\0")
+    if not decomp.unused_data:
+        raise IOError("truncated bzip2 stream")
+    return output
+
+
+#  The available decompressors, in order of preference.
+DECOMPRESSORS = [
+    CommandDecompressor("pigz",("gz",),["pigz","-dc"]),
+    CommandDecompressor("pbzip2",("bz2",),["pbzip2","-dc"]),
+    CommandDecompressor("lbzip2",("bz2",),["lbzip2","-dc"]),
+    CommandDecompressor("xz",("xz",),["xz","-dc","-T0"]),
+    ParallelBZ2Decompressor(),
+    PythonDecompressor(),
+]
+
+
+class FollowFile(object):
+    """Read a file that's still being downloaded, as the data arrives.
+
+    The download is written to partfile, which is renamed to path once
+    it's complete.  Reads block until more data is available, and return
+    an empty string once the renamed file has been read to the end.  The
+    function is_active is polled while waiting; if it returns false before
+    the download is complete, IOError is raised.
+
+    Every byte read is counted and hashed, so the caller can check that
+    it saw the same data that ended up in the completed file.
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self,partfile,path,is_active):
+        self.partfile = partfile
+        self.path = path
+        self.is_active = is_active
+        self.nbytes = 0
+        self.sha256 = hashlib.sha256()
+        self._fd = None
+
+    def _open(self):
+        for path in (self.partfile,self.path,):
+            try:
+                return os.open(path,os.O_RDONLY)
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return None
+
+    def _is_complete(self):
+        try:
+            st = os.stat(self.path)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        fst = os.fstat(self._fd)
+        if (st.st_dev,st.st_ino,) != (fst.st_dev,fst.st_ino,):
+            return False
+        return self.nbytes >= fst.st_size
+
+    def read(self,size=CHUNK_SIZE):
+        while True:
+            #  Check for activity before reading, so that data written just
+            #  before the download finished isn't missed.
+            active = self.is_active()
+            if self._fd is None:
+                self._fd = self._open()
+            if self._fd is not None:
+                data = os.read(self._fd,size)
+                if data:
+                    self.nbytes += len(data)
+                    self.sha256.update(data)
+                    return data
+                if self._is_complete():
+                    return ""
+            if not active:
+                raise IOError("download of %s did not complete" % (self.path,))
+            time.sleep(self.POLL_INTERVAL)
+
+    def matches(self,size,sha256):
+        """Check whether the data read matches the given size and digest."""
+        return self.nbytes == size and self.sha256.hexdigest() == sha256
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class PristineStore(object):
+    """A store of pristine unpacked source trees, keyed by archive hash.
+
+    Each archive is extracted only once, into a temporary directory that's
+    renamed into place when complete.  Build directories are then checked
+    out from the store, so recipes that share a tarball, or rebuild from
+    it, don't have to extract it again.  The checkout mode is one of:
+
+        * "reflink":  copy-on-write clones where the filesystem supports
+                      them, and plain copies otherwise
+        * "copy":     plain copies
+        * "hardlink": hard links to the pristine files
+
+    Hard links are the fastest, but anything that writes into an existing
+    file in the build dir also changes the pristine copy.  Recipe patches
+    are safe, since they replace the file they're patching; some build
+    scripts aren't.
+    """
+
+    CHECKOUT_MODES = ("reflink","copy","hardlink",)
+
+    def __init__(self,rootdir,mode="reflink"):
+        if mode not in self.CHECKOUT_MODES:
+            raise ValueError("unknown checkout mode: %s" % (mode,))
+        self.rootdir = rootdir
+        self.mode = mode
+
+    def path(self,key):
+        return os.path.join(self.rootdir,key)
+
+    def has(self,key):
+        return os.path.isdir(self.path(key))
+
+    def tempdir(self):
+        """Make a temporary dir in which to extract a new pristine tree."""
+        if not os.path.isdir(self.rootdir):
+            os.makedirs(self.rootdir)
+        return tempfile.mkdtemp(prefix="tmp-",dir=self.rootdir)
+
+    def commit(self,tmpdir,key):
+        """Move a newly-extracted tree into place under the given key.
+
+        If another process got there first, the new tree is discarded.
+        """
+        try:
+            os.rename(tmpdir,self.path(key))
+        except EnvironmentError, e:
+            if e.errno not in (errno.EEXIST,errno.ENOTEMPTY,):
+                raise
+            shutil.rmtree(tmpdir)
+
+    def checkout(self,key,workdir):
+        """Populate workdir with the pristine tree for the given key.
+
+        Any files already in workdir are replaced, just as if the archive
+        had been extracted over the top of them.
+        """
+        srcdir = self.path(key)
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        if self.mode == "reflink":
+            cmd = ["cp","-a","--reflink=auto",srcdir + "/.",workdir]
+            try:
+                with open(os.devnull,"w") as devnull:
+                    subprocess.check_call(cmd,stderr=devnull)
+            except (EnvironmentError,subprocess.CalledProcessError,):
+                #  Not GNU cp; fall back to plain copies.
+                pass
+            else:
+                return
+        _copy_tree(srcdir,workdir,self.mode == "hardlink")
+
+
+def _copy_tree(srcdir,dstdir,link=False):
+    """Copy or hardlink the contents of srcdir into dstdir."""
+    for (dirnm,subdirs,filenms) in os.walk(srcdir):
+        reldir = os.path.relpath(dirnm,srcdir)
+        dstsubdir = os.path.normpath(os.path.join(dstdir,reldir))
+        for nm in list(subdirs):
+            spath = os.path.join(dirnm,nm)
+            dpath = os.path.join(dstsubdir,nm)
+            if os.path.islink(spath):
+                #  os.walk lists symlinks to dirs as subdirs.
+                subdirs.remove(nm)
+                filenms.append(nm)
+            elif not os.path.isdir(dpath):
+                os.mkdir(dpath)
+                shutil.copymode(spath,dpath)
+        for nm in filenms:
+            spath = os.path.join(dirnm,nm)
+            dpath = os.path.join(dstsubdir,nm)
+            if os.path.lexists(dpath):
+                os.unlink(dpath)
+            if os.path.islink(spath):
+                os.symlink(os.readlink(spath),dpath)
+            elif link:
+                os.link(spath,dpath)
+            else:
+                shutil.copy2(spath,dpath)
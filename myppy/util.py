@@ -10,7 +10,9 @@ from __future__ import with_statement
 
 import os
 import sys
+import stat
 import errno
+import fcntl
 import tempfile
 import subprocess
 import shutil
@@ -52,6 +54,115 @@ class tempdir:
             else:
                 shutil.rmtree(self.path)
 
+
+class FileLock(object):
+    """An exclusive advisory lock on a file, taken using flock().
+
+    The lock belongs to the open file rather than to the process, so it's
+    shared with any child processes forked while the file is open.  This
+    means a lock acquired by a child stays held after the child exits,
+    until the parent releases it.  Use it as a context manager, or call
+    acquire() and release() directly.
+    """
+
+    def __init__(self,path):
+        self.path = path
+        self.fd = os.open(path,os.O_RDWR|os.O_CREAT,0644)
+
+    def acquire(self,blocking=True):
+        """Acquire the lock, returning False if it's not available.
+
+        Unless blocking is false, this waits until the lock is available.
+        """
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        while True:
+            try:
+                fcntl.flock(self.fd,flags)
+            except EnvironmentError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EAGAIN,errno.EACCES,) and not blocking:
+                    return False
+                raise
+            else:
+                return True
+
+    def release(self):
+        fcntl.flock(self.fd,fcntl.LOCK_UN)
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.release()
+
+
+class PatchSession(object):
+    """Queue up linewise patches to files, and apply them all in one go.
+
+    Each filter is a function taking an iterator over the lines of a file,
+    and generating the lines of the patched file.  All the filters queued
+    for a file are chained together and applied in a single pass, in the
+    order they were added; the result is written to a temp file that's
+    renamed over the original.  Files that aren't changed by their filters
+    aren't rewritten at all.  Use it as a context manager to apply the
+    queued patches at the end of the block, or call apply() directly.
+    """
+
+    def __init__(self):
+        self._paths = []
+        self._filters = {}
+
+    def add(self,fpath,filter):
+        """Queue a linewise patch function for the specified file."""
+        if fpath not in self._filters:
+            self._paths.append(fpath)
+            self._filters[fpath] = []
+        self._filters[fpath].append(filter)
+
+    def apply(self):
+        """Apply all queued patches, returning the list of changed files."""
+        changed = []
+        while self._paths:
+            fpath = self._paths.pop(0)
+            if self._apply(fpath,self._filters.pop(fpath)):
+                changed.append(fpath)
+        return changed
+
+    def _apply(self,fpath,filters):
+        with open(fpath,"rt") as fIn:
+            orig = fIn.readlines()
+        lines = iter(orig)
+        for filter in filters:
+            lines = filter(lines)
+        lines = list(lines)
+        if lines == orig:
+            return False
+        (fd,tf) = tempfile.mkstemp(dir=os.path.dirname(fpath))
+        try:
+            with os.fdopen(fd,"wt") as fOut:
+                fOut.writelines(lines)
+            os.chmod(tf,stat.S_IMODE(os.stat(fpath).st_mode))
+            os.rename(tf,fpath)
+        except:
+            os.unlink(tf)
+            raise
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is None:
+            self.apply()
+
+
 @contextlib.contextmanager
 def chstdin(new_stdin):
     """Context manager changing standard input"""
@@ -79,13 +190,27 @@ def which(name):
 
 def md5file(path):
     """Calculate md5 of given file."""
-    hash = hashlib.md5()
+    return hashfile(path,"md5")
+
+
+def hashfile(path,algorithm="sha256"):
+    """Calculate the hex digest of given file, using the named algorithm."""
+    return hashfile_multi(path,(algorithm,))[algorithm]
+
+
+def hashfile_multi(path,algorithms):
+    """Calculate several hex digests of given file in a single pass.
+
+    Returns a dict mapping each algorithm name to the digest.
+    """
+    hashes = [(nm,hashlib.new(nm)) for nm in algorithms]
     with open(path,"rb") as f:
         chunk = f.read(1024*512)
         while chunk:
-            hash.update(chunk)
+            for (_,hash) in hashes:
+                hash.update(chunk)
             chunk = f.read(1024*512)
-    return hash.hexdigest()
+    return dict((nm,hash.hexdigest()) for (nm,hash) in hashes)
 
 
 def do(*cmdline):
@@ -173,6 +298,22 @@ def isrealdir(path):
     return (os.path.isdir(path) and not os.path.islink(path))
 
 
+def movefile(src,dst):
+    """Move a file or symlink into place, replacing any existing file."""
+    try:
+        os.rename(src,dst)
+    except EnvironmentError, e:
+        if e.errno != errno.EXDEV:
+            raise
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        if os.path.islink(src):
+            os.symlink(os.readlink(src),dst)
+        else:
+            shutil.copy2(src,dst)
+        os.unlink(src)
+
+
 def python_architecture():
     """Check architecture (32/64 bit) of python interpreter."""
     if sys.platform.startswith('darwin'):
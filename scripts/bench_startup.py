@@ -0,0 +1,102 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  bench_startup.py:  measure interpreter startup time of myppy envs
+
+Usage:  python bench_startup.py [--runs=N] ENV [ENV...]
+
+For each given env this times "python -c pass" and "import PySide.QtGui",
+running each the given number of times and reporting the fastest and the
+median run.  To see what a link profile buys you, build one env with the
+default profile and another with e.g. MYPPY_LINK_PROFILE=startup, then
+pass both envs to this script.
+
+On glibc systems it also reports the time the dynamic loader spent
+starting each command, as measured by LD_DEBUG=statistics.
+
+"""
+
+from __future__ import with_statement
+
+import os
+import re
+import sys
+import time
+import subprocess
+
+
+COMMANDS = [
+    ("python -c pass", "pass"),
+    ("import PySide.QtGui", "import PySide.QtGui"),
+]
+
+_LOADER_TIME_RE = re.compile(r"total startup time in dynamic loader:\s*(\d+)")
+
+
+def time_command(python,code):
+    """Time a single run of the given code, in seconds."""
+    with open(os.devnull,"w") as devnull:
+        t0 = time.time()
+        retcode = subprocess.call([python,"-c",code],stderr=devnull)
+        t1 = time.time()
+    if retcode != 0:
+        return None
+    return t1 - t0
+
+
+def loader_cycles(python,code):
+    """Get the clock cycles spent in the dynamic loader, if reported."""
+    env = os.environ.copy()
+    env["LD_DEBUG"] = "statistics"
+    p = subprocess.Popen([python,"-c",code],env=env,stderr=subprocess.PIPE)
+    (_,stderr) = p.communicate()
+    #  The statistics are printed for every exec'd binary.  The "python"
+    #  script in the env execs the real interpreter last.
+    cycles = _LOADER_TIME_RE.findall(stderr)
+    if p.returncode != 0 or not cycles:
+        return None
+    return int(cycles[-1])
+
+
+def bench(envdir,runs):
+    python = os.path.join(envdir,"python")
+    print envdir
+    for (label,code) in COMMANDS:
+        times = []
+        for _ in xrange(runs):
+            t = time_command(python,code)
+            if t is None:
+                break
+            times.append(t)
+        if not times:
+            print "  %-22s  FAILED" % (label,)
+            continue
+        times.sort()
+        median = times[len(times) // 2]
+        msg = "  %-22s  min %7.1fms  median %7.1fms"
+        msg %= (label,times[0] * 1000,median * 1000,)
+        cycles = loader_cycles(python,code)
+        if cycles is not None:
+            msg += "  loader %d cycles" % (cycles,)
+        print msg
+
+
+def main(argv):
+    runs = 20
+    envdirs = []
+    for arg in argv[1:]:
+        if arg.startswith("--runs="):
+            runs = int(arg.split("=",1)[1])
+        else:
+            envdirs.append(arg)
+    if not envdirs:
+        print >>sys.stderr, __doc__
+        return 1
+    for envdir in envdirs:
+        bench(envdir,runs)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))